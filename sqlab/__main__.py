@@ -1,5 +1,7 @@
 import argparse
 import importlib
+import os
+import sys
 from textwrap import dedent, TextWrapper
 
 from .config import get_config
@@ -24,8 +26,8 @@ def main():
     msg = "SQL Adventure Builder: create a standalone relational database out of a sequence of SQL exercises or adventures."
     parser = argparse.ArgumentParser(description=msg, formatter_class=CustomHelpFormatter)
 
-    msg = "A directory containing a file named `config.py`, which defines a dictionary named `config`."
-    parser.add_argument("CONFIG_DIR", help=msg)
+    msg = "A directory containing a file named `config.py`, which defines a dictionary named `config`. With --batch, several directories or glob patterns (e.g., 'courses/*')."
+    parser.add_argument("CONFIG_DIR", nargs="+", help=msg)
 
     msg = """\
         • create: create or recreate a database and populate it using the TSV files of the subfolder "dataset" (if any). All dataset tables are extended with a column containing a hash of each row. Parse the notebook (if any). Generate the messages (if any), encrypt and insert them in the added table "sqlab_msg".
@@ -46,7 +48,33 @@ def main():
         "--json", action="store_true", help="With 'create', generate messages in JSON format for debugging purposes."
     )
 
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--follow", action="store_true", help="With 'report', keep tailing the logs and refreshing the report until interrupted (Ctrl-C)."
+    )
+    group.add_argument(
+        "--shards", nargs="+", metavar="LOG", help="With 'report', aggregate in parallel the given CSV logs (e.g., one per database server) instead of 'logs.csv'."
+    )
+
+    parser.add_argument(
+        "--batch", action="store_true", help="With 'create', 'parse' or 'report', run the command on all the CONFIG_DIR in parallel, log each build in its output directory, and print a summary."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(), help="With --batch, the maximal number of builds running at the same time."
+    )
+    parser.add_argument(
+        "--cache", metavar="PATH", help="The SQLite file where the intermediate results are cached, instead of the one of the configuration. With --batch, it defaults to 'sqlab_cache.sqlite'."
+    )
+
     args = parser.parse_args()
+    if args.batch:
+        if args.CMD == "shell" or args.follow:
+            parser.error("--batch cannot run an interactive command.")
+        batch = importlib.import_module(".batch", package="sqlab")
+        sys.exit(1 if batch.run(args) else 0)
+    if len(args.CONFIG_DIR) > 1:
+        parser.error("Several CONFIG_DIR require --batch.")
+    args.CONFIG_DIR = args.CONFIG_DIR[0]
     module = importlib.import_module(f".cmd_{args.CMD}", package="sqlab")
     config = get_config(args)
     module.run(config)
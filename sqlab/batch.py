@@ -0,0 +1,180 @@
+"""
+Run the same command on several configuration directories, in parallel processes.
+
+The builds sharing a notebook or a database are run sequentially in the same task, since they
+would otherwise overwrite each other's work. All the builds share the same cache of intermediate
+results, so that, e.g., a notebook cell parsed by one build is not parsed again by the others.
+"""
+
+import argparse
+import glob
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+from pathlib import Path
+
+from .config import get_config, reload_config
+from .text_tools import FAIL, OK, RESET
+
+DEFAULT_CACHE_PATH = "sqlab_cache.sqlite"  # in the current working directory
+
+
+def expand_config_dirs(patterns: list[str]) -> list[str]:
+    """Expand the glob patterns, keep the directories containing a `config.py`, without duplicates."""
+    config_dirs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if Path(path, "config.py").is_file() and path not in config_dirs:
+                config_dirs.append(path)
+    return config_dirs
+
+
+def shared_resources(config: dict) -> set[tuple]:
+    """
+    Return the resources of a build that another build may use too: its database and its notebook.
+    A SQLite database lives in the memory of its process, and is loaded from the dump written by
+    the command `create`: only this file can be shared.
+    """
+    if config["sqlab_dbms_module"] == "sqlite":
+        resources = {("dump", Path(config["sql_dump_path"]).resolve())}
+    else:
+        cnx = config["cnx"]
+        resources = {("database", config["sqlab_dbms_module"], cnx.get("host"), cnx.get("port"), cnx.get("database"))}
+    if source_path := config.get("source_path"):
+        resources.add(("notebook", Path(source_path).resolve()))
+    return resources
+
+
+def group_builds(builds: list[dict]) -> list[list[dict]]:
+    """
+    Partition the builds into groups which can run in parallel: two builds whose configurations
+    share a resource (cf. `shared_resources()`) end up in the same group.
+    """
+    groups = []  # list of (set of shared resources, list of builds)
+    for build in builds:
+        resources = set(build["resources"])
+        merged = [group for group in groups if group[0] & resources]
+        for group in merged:
+            groups.remove(group)
+            resources |= group[0]
+        groups.append((resources, [b for group in merged for b in group[1]] + [build]))
+    return [members for (_, members) in groups]
+
+
+def run_build(cli_args: dict, cmd: str, log_path: Path) -> tuple[float, str]:
+    """
+    Run a single build, with its standard output and error (including those of the subprocesses)
+    redirected to the given log file. Return its duration and its error message ("" on success).
+    """
+    start = time.perf_counter()
+    with log_path.open("w", encoding="utf8") as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            config = reload_config(cli_args)
+            module = importlib.import_module(f".cmd_{cmd}", package="sqlab")
+            module.run(config)
+            error = ""
+        except BaseException as e:  # including the SystemExit's
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return (time.perf_counter() - start, error)
+
+
+def run_group(group: list[dict], cmd: str) -> list[tuple[str, float, str]]:
+    """Run the builds of a group one after the other, in the same worker process."""
+    results = []
+    for build in group:
+        (duration, error) = run_build(build["cli_args"], cmd, build["log_path"])
+        results.append((build["config_dir"], duration, error))
+    return results
+
+
+def run_group_in_process(group: list[dict], cmd: str, connection):
+    """Target of a worker process: run the builds of a group, and send back their results."""
+    connection.send(run_group(group, cmd))
+    connection.close()
+
+
+def run_groups(groups: list[list[dict]], cmd: str, jobs: int):
+    """
+    Run each group in a fresh process, since a build may leave some global state behind it, with
+    at most `jobs` processes at a time. Yield the results of the builds as the groups complete.
+    """
+    (waiting, running) = (list(groups), {})  # process sentinel -> (process, group, connection)
+    while waiting or running:
+        while waiting and len(running) < jobs:
+            group = waiting.pop(0)
+            (receiver, sender) = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_group_in_process, args=(group, cmd, sender))
+            process.start()
+            sender.close()  # the child has its own copy
+            running[process.sentinel] = (process, group, receiver)
+        for sentinel in wait(list(running)):
+            (process, group, receiver) = running.pop(sentinel)
+            try:
+                group_results = receiver.recv()
+            except EOFError:  # the process has died without sending its results
+                process.join()
+                group_results = [(build["config_dir"], 0.0, f"Worker process exited with code {process.exitcode}.") for build in group]
+            receiver.close()
+            process.join()
+            yield from group_results
+
+
+def print_summary(results: list[tuple[str, float, str]], log_paths: dict):
+    width = max(len("CONFIG_DIR"), *(len(config_dir) for (config_dir, _, _) in results))
+    print(f"\n{'CONFIG_DIR':{width}}  STATUS  DURATION  LOG")
+    for (config_dir, duration, error) in sorted(results):
+        status = f"{OK}OK     {RESET}" if not error else f"{FAIL}FAILED {RESET}"
+        print(f"{config_dir:{width}}  {status} {duration:7.1f}s  {log_paths[config_dir]}")
+        if error:
+            print(f"{'':{width}}  {FAIL}{error}{RESET}")
+    failures = sum(1 for (_, _, error) in results if error)
+    total = sum(duration for (_, duration, _) in results)
+    color = FAIL if failures else OK
+    print(f"{color}{len(results) - failures} succeeded, {failures} failed, {total:.1f}s of cumulated build time.{RESET}")
+
+
+def run(args: argparse.Namespace) -> int:
+    """Build all the configuration directories matching `args.CONFIG_DIR`. Return the number of failures."""
+    config_dirs = expand_config_dirs(args.CONFIG_DIR)
+    if not config_dirs:
+        print(f"{FAIL}No configuration directory matches {' '.join(args.CONFIG_DIR)}.{RESET}")
+        return 1
+    args.cache = args.cache or DEFAULT_CACHE_PATH
+
+    # Load the configurations in the main process, which may have to ask for some passwords.
+    (builds, results, log_paths) = ([], [], {})
+    for config_dir in config_dirs:
+        try:
+            config = get_config(argparse.Namespace(**{**vars(args), "CONFIG_DIR": config_dir}))
+        except Exception as e:
+            results.append((config_dir, 0.0, f"Invalid configuration. {type(e).__name__}: {e}"))
+            log_paths[config_dir] = "-"
+            continue
+        builds.append({
+            "config_dir": config_dir,
+            "cli_args": config["cli_args"],
+            "log_path": Path(config["log_path"]).with_name(f"{args.CMD}.log"),
+            "resources": shared_resources(config),
+        })
+    log_paths.update((build["config_dir"], build["log_path"]) for build in builds)
+    groups = group_builds(builds)
+    print(f"Running '{args.CMD}' on {len(builds)} configurations ({len(groups)} independent groups)...")
+
+    for (config_dir, duration, error) in run_groups(groups, args.CMD, args.jobs or os.cpu_count() or 1):
+        color = FAIL if error else OK
+        print(f"{color}{config_dir}: {'failed' if error else 'done'} in {duration:.1f}s.{RESET}", flush=True)
+        results.append((config_dir, duration, error))
+    print_summary(results, log_paths)
+    print(f"Intermediate results cached in '{args.cache}'.")
+    return sum(1 for (_, _, error) in results if error)
@@ -0,0 +1,86 @@
+"""
+Persistent caches stored in a single SQLite file, and partitioned into namespaces (one per client).
+The keys are content hashes, so that the same file can be safely shared between several builds.
+"""
+
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+
+def digest(*parts) -> str:
+    """Return a hash of the given JSON-serializable parts."""
+    text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+MAX_PENDING_VALUES = 1000  # beyond which `Cache.set()` commits by itself, to bound the memory
+
+
+class Cache:
+    """
+    The new values are kept in memory until `commit()`, which writes them in a single short
+    transaction: a long one would lock the file for the other processes sharing it (e.g., the
+    shards of a report or the builds of a batch).
+    """
+
+    def __init__(self, path: Path, namespace: str):
+        self.namespace = namespace
+        self.pending = {}  # key -> JSON text of the values set since the last commit
+        # Wait for the concurrent writers, if any. Allow the connection to be passed to another thread
+        # (e.g., a background formatter), the callers ensuring that it is used by one thread at a time.
+        self.cnx = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.cnx.execute("PRAGMA journal_mode = WAL")  # Don't block the readers while writing
+        self.cnx.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID
+        """)
+
+    def get(self, key: str):
+        """Return the value stored under the given key, or None if there is no such key."""
+        if (text := self.pending.get(key)) is None:
+            query = "SELECT value FROM cache WHERE namespace = ? AND key = ?"
+            row = self.cnx.execute(query, (self.namespace, key)).fetchone()
+            text = row[0] if row else None
+        return json.loads(text) if text is not None else None
+
+    def set(self, key: str, value):
+        """Store a JSON-serializable value under the given key. It is written on disk by `commit()`."""
+        self.pending[key] = json.dumps(value, ensure_ascii=False)
+        if len(self.pending) >= MAX_PENDING_VALUES:
+            self.commit()
+
+    def commit(self):
+        """Write the pending values on disk."""
+        if not self.pending:
+            return
+        query = "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)"
+        with self.cnx:  # commit on exit
+            self.cnx.executemany(query, ((self.namespace, key, text) for (key, text) in self.pending.items()))
+        self.pending.clear()
+
+    def close(self):
+        """Write the pending values on disk, and close the connection."""
+        self.commit()
+        self.cnx.close()
+
+
+class NullCache:
+    """Drop-in replacement for Cache when no cache file is configured."""
+
+    def get(self, key): return None
+    def set(self, key, value): pass
+    def commit(self): pass
+    def close(self): pass
+
+
+def open_cache(config: dict, namespace: str):
+    """Return the cache of the given namespace, or a null cache if the configuration has no cache_path."""
+    if cache_path := config.get("cache_path"):
+        return Cache(cache_path, namespace)
+    return NullCache()
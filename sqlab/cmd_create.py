@@ -1,3 +1,4 @@
+import hashlib
 import json
 import random
 import re
@@ -6,14 +7,15 @@ from pathlib import Path
 from importlib import resources
 
 from . import __version__
-from .cmd_parse import run as parse_notebook
-from .compose_inserts import compose_data_inserts, compose_message_inserts, compose_metadata_inserts
+from .cmd_parse import run as parse_notebook, wait_for_graph_renderings
+from .compose_inserts import compose_data_inserts, iter_message_inserts, compose_metadata_inserts
 from .database import database_factory
 from .message_builder import MessageBuilder
-from .message_formatter import create_message_formatter
+from .message_formatter import format_messages, iter_formatted_messages, iter_in_background
 from .text_tools import OK, RESET, WARNING
 from .token_table import TokenTable
 from .run_notebook import run_notebook
+from .web_bundles import WebBundleWriter
 
 
 def run(config: dict):
@@ -112,7 +114,7 @@ def run(config: dict):
             # Add temporarily the foreign key constraints to the core tables, before executing the
             # notebook, in case they are exploited by some question or exercise.
             db.execute_non_select(db.fk_constraints_queries)
-            notebook_is_up_to_date = run_notebook(config)
+            notebook_is_up_to_date = run_notebook(config, sql_dump.fingerprint(config), db)
             # In case the adventure contains queries like `INSERT INTO`, `UPDATE`, `DELETE FROM`, etc.,
             # the core tables may have been changed. Restore them. This requires the foreign key
             # constraints to be dropped (PostgreSQL does not allow SET FOREIGN_KEY_CHECKS=0).
@@ -120,7 +122,7 @@ def run(config: dict):
             db.execute_non_select(db.drop_fk_constraints_queries)
             db.execute_non_select(data_inserts_queries)
             if notebook_is_up_to_date:
-                records = parse_notebook(config)
+                records = parse_notebook(config, wait_for_graph=False)  # awaited at the end of the build
             else:
                 print(f"{WARNING}The notebook needs some work before I can convert it.{RESET}")
         elif source_path.name == "records.json":
@@ -135,47 +137,35 @@ def run(config: dict):
     db.execute_non_select(db.fk_constraints_queries)
 
     message_builder = MessageBuilder(config)
+    documents = message_builder.compile_documents(records, with_activities=(config["markdown_to"] == "web"))
 
-    # Dump the compiled exercises to a dedicated file
-    exercises = message_builder.compile_exercises(records)
-    if exercises:
-        config["exercises_path"].write_text(exercises, encoding="utf-8")
-        print(f"Exercises compiled to '{config['exercises_path']}'.")
-
-    # Dump the storyline to a dedicated file
-    storyline = message_builder.compile_storyline(records)
-    if storyline:
-        config["storyline_path"].write_text(storyline, encoding="utf-8")
-        print(f"Storyline compiled to '{config['storyline_path']}'.")
-
-    # Dump the compiled cheat_sheet to a dedicated file
-    cheat_sheet = message_builder.compile_cheat_sheet(records)
-    if cheat_sheet:
-        config["cheat_sheet_path"].write_text(cheat_sheet, encoding="utf-8")
-        print(f"Cheat sheet compiled to '{config['cheat_sheet_path']}'.")
-    
-    # Dump the check list to a dedicated file
-    check_list = message_builder.compile_check_list(records)
-    if check_list:
-        config["check_list_path"].write_text(check_list, encoding="utf-8")
-        print(f"Check list compiled to '{config['check_list_path']}'.")
+    # Dump the compiled exercises, storyline, cheat sheet and check list to dedicated files
+    for (name, label) in [("exercises", "Exercises"), ("storyline", "Storyline"), ("cheat_sheet", "Cheat sheet"), ("check_list", "Check list")]:
+        if documents[name]:
+            config[f"{name}_path"].write_text(documents[name], encoding="utf-8")
+            print(f"{label} compiled to '{config[f'{name}_path']}'.")
 
-    # Populate the `sqlab_msg` table.
+    # Populate the `sqlab_msg` table. The messages are formatted in the background (and possibly
+    # in a process pool), while the previous batches are encrypted and inserted by the database.
     messages = message_builder.run(records)
     if messages:
-        format_message = create_message_formatter(config)
-        for (token, data) in messages.items():
-            messages[token] = format_message(data)
-        
+
         # Uncomment the next 4 lines to help debugging the output
         # Path(f"../messages.{config['markdown_to']}").write_text(
-        #     "\n".join(f"[{token}]\n\n{message}\n\n" for (token, message) in messages.items()),
+        #     "\n".join(f"[{token}]\n\n{message}\n\n" for (token, message) in format_messages(config, messages).items()),
         #     encoding="utf-8",
         # )
 
-        message_inserts = compose_message_inserts(db, messages.items())
-        sql_dump.write(message_inserts)
-        db.execute_non_select(message_inserts)
+        # For SQLab online, bundle also the encrypted messages in static files, to be fetched on demand.
+        web_bundle = WebBundleWriter(config) if config["markdown_to"] == "web" else None
+
+        batch_size = config["message_batch_size"]
+        formatted_messages = iter_in_background(iter_formatted_messages(config, messages), batch_size)
+        for message_inserts in iter_message_inserts(db, formatted_messages, batch_size, web_bundle and web_bundle.add):
+            sql_dump.write(message_inserts)
+            db.execute_non_select(message_inserts)
+        if web_bundle:
+            web_bundle.write()
     
     
     # Populate the `sqlab_metadata` table.
@@ -194,7 +184,7 @@ def run(config: dict):
         "created_at": datetime.now().isoformat()
     }
     if config["markdown_to"] == "web":
-        kwargs["activities"] = message_builder.compile_activities(records)
+        kwargs["activities"] = documents["activities"]
     metadata_inserts = compose_metadata_inserts(db, **dict(sorted(kwargs.items())))
     sql_dump.write(metadata_inserts)
     db.execute_non_select(metadata_inserts)
@@ -202,6 +192,7 @@ def run(config: dict):
     sql_dump.close()
 
     db.close()
+    wait_for_graph_renderings()
     print(f"""{OK}{config["dbms"]} database '{db_name}' created and populated.{RESET}\n""")
 
 
@@ -211,6 +202,7 @@ class Dump:
         self.path = config["sql_dump_path"]
         self.path.unlink(missing_ok=True)
         self.file = self.path.open("a", encoding="utf-8")
+        self.hash = hashlib.sha256()  # of everything written so far
         self.file.write(f"-- Generated by SQL Adventure Builder. Any changes will be overwritten.\n")
         self.file.write(f"-- See at the end of the file for more information.\n\n")
 
@@ -220,6 +212,13 @@ class Dump:
         text = text.strip() + "\n\n\n"
         self.file.write(text)
         self.file.flush()
+        self.hash.update(text.encode("utf-8"))
+
+    def fingerprint(self, config: dict) -> str:
+        """Identify the database built so far, by the queries dumped and the server they ran on."""
+        cnx = config["cnx"]
+        server = (config["sqlab_dbms_module"], cnx.get("host"), cnx.get("port"), cnx.get("database"))
+        return f"{server}:{self.hash.hexdigest()}"
 
     def close(self):
         self.file.close()
@@ -1,26 +1,140 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import contextlib
+from dataclasses import dataclass
 import json
 from pathlib import Path
 import re
 from typing import Optional
 import importlib
+import multiprocessing
 
+from .cache import digest, open_cache
 from .text_tools import FAIL, OK, RESET, WARNING
 from .text_tools import separate_label_salt_and_text, split_sql_source, separate_query_formula_and_salt
 
 REWARD_UNIT = 10
+PARSE_CACHE_VERSION = 2  # To be incremented whenever the result of `analyse_cell()` changes
+NOTEBOOK_CHUNK_SIZE = 1 << 20
 
-def run(config: dict):
+# The activity maps being converted in the background, as a list of futures.
+graph_renderings = []
+
+def run(config: dict, wait_for_graph: bool = True):
+    """
+    Parse the notebook and update the records. Unless `wait_for_graph` is False, wait for the
+    activity map, which is converted in the background. Otherwise, it is up to the caller to call
+    `wait_for_graph_renderings()` before exiting.
+    """
     parser = NotebookParser(config)
     print(f"Updating the records...")
-    ipynb = json.loads(config["source_path"].read_text(encoding="utf8"))
-    records = parser(ipynb["cells"])
+    records = parser(iter_notebook_cells(config["source_path"]))
     print(f"{OK}The records are up to date.{RESET}")
     text = json.dumps(records, indent=2, ensure_ascii=False)
     Path(config["records_path"]).write_text(text, encoding="utf-8")
+    if wait_for_graph:
+        wait_for_graph_renderings()
     return records
 
+def render_graph(text: str, format_paths: dict) -> list:
+    """Convert a Graphviz source into the given formats. Executed in a worker process."""
+    graphviz = importlib.import_module("graphviz")
+    source = graphviz.Source(text)
+    for (format, path) in format_paths.items():
+        source.render(filename=path.stem, directory=path.parent, format=format, cleanup=True)
+    return list(format_paths)
+
+def wait_for_graph_renderings():
+    while graph_renderings:
+        future = graph_renderings.pop(0)
+        try:
+            for format in future.result():
+                print(f"Activity map converted into {format.upper()}.")
+        except Exception as e:
+            print(f"{WARNING}The activity map could not be converted. {type(e).__name__}: {e}{RESET}")
+
+def prune_notebook_node(node: dict) -> dict:
+    """
+    Object hook stripping the notebook nodes of the fields the parser never uses. Since the hooks
+    are called bottom-up, the outputs are reduced to their HTML data before their cell is built.
+    """
+    if "output_type" in node:
+        html = node.get("data", {}).get("text/html")
+        return {} if html is None else {"data": {"text/html": html}}
+    if "cell_type" in node:
+        return {key: node[key] for key in ("cell_type", "source", "outputs") if key in node}
+    return node
+
+def iter_notebook_cells(path: Path, chunk_size: int = NOTEBOOK_CHUNK_SIZE):
+    """
+    Read the given notebook by chunks, and yield its (pruned) cells one by one, so that no more
+    than one cell is held in memory. The other top-level fields of the notebook are skipped.
+    """
+    decoder = json.JSONDecoder(object_hook=prune_notebook_node)
+    with open(path, encoding="utf8") as file:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def refill():
+            nonlocal buffer, pos, eof
+            chunk = file.read(max(chunk_size, len(buffer) - pos))  # at least double a pending value
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def peek() -> str:
+            """Skip the whitespace and return the next character, or an empty string at the end."""
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\n\r":
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos + 1]
+                refill()
+
+        def consume(expected: str) -> str:
+            nonlocal pos
+            char = peek()
+            if not char or char not in expected:
+                raise json.JSONDecodeError(f"Expecting one of {expected!r}", buffer, pos)
+            pos += 1
+            return char
+
+        def decode():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    (value, end) = decoder.raw_decode(buffer, pos)
+                    if end < len(buffer) or eof:  # otherwise, a number may have been truncated
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                refill()
+
+        consume("{")
+        if peek() == "}":
+            return
+        while True:
+            key = decode()
+            consume(":")
+            if key != "cells":
+                decode()  # metadata, nbformat, etc.
+            else:
+                consume("[")
+                if peek() == "]":
+                    consume("]")
+                else:
+                    while True:
+                        yield decode()
+                        if consume(",]") == "]":
+                            break
+            if consume(",}") == "}":
+                return
+
 def dequalified(formula: str) -> str:
     """
     Transform the formula by removing the qualification of the hash fields.
@@ -32,6 +146,73 @@ def dequalified(formula: str) -> str:
     """
     return re.sub(r"\b[A-Z][_\.]hash", "hash", formula)
 
+@dataclass
+class HtmlTableScan:
+    token: Optional[str]  # the first token of the result, if any
+    columns: list  # the column names, except token, or ["*"] if there is a column hash
+    row_count: int  # the number of rows, header excluded
+    head: str  # the table truncated after its first rows, followed by the row count
+
+def scan_html_table(
+    html: str,
+    head_size: int = 3,  # including the header row
+    match_token_row=re.compile(r"(?m)^ *<td>(\d+)</td>\s+</tr>").search,
+) -> HtmlTableScan:
+    """
+    Extract together everything the parser needs from an HTML output. The text is scanned forward,
+    and no regular expression is allowed to backtrack over more than one row.
+    """
+    # Token: a cell ending a row, on one of the lines immediately following a <th>token</th> line.
+    token = None
+    candidate = None
+    start = 0
+    while (i := html.find("<th>token</th>\n", start)) >= 0:
+        p = i + 15  # start of the line following the header cell
+        if candidate is None or candidate.start() < p:
+            candidate = match_token_row(html, p)
+        if candidate is None:
+            break  # no more candidate rows after p
+        # The chain of lines from p to the candidate row must not be broken by an empty line.
+        if (j := html.find("\n\n", p - 1, candidate.start())) < 0:
+            token = candidate[1]
+            break
+        start = max(i + 1, j - 13)  # the previous headers would lead to the same empty line
+
+    # Head: the <table> line, the first rows (each ending a line) and the last </table>.
+    row_count = html.count("<tr>") - 1  # Don't rely on the number of affected rows
+                                        # displayed by MySQL or PostgreSQL, since SQLite
+                                        # displays it only for the DML statements.
+    head = html
+    last = html.rfind("</table>")
+    if (s := html.find("<table>\n")) >= 0 and last >= s + 8:
+        e = s + 8
+        for _ in range(head_size):
+            if (q := html.find("<tr>", e)) < 0:
+                break
+            r = html.find("</tr>\n", q + 5)
+            if r < 0 or r + 6 > last:
+                break
+            e = r + 6
+        count_str = f"\nTotal: {row_count} row{'s'[:row_count^1]} affected."
+        head = f"{html[:e]}</table>{count_str}{html[last + 8:]}"
+
+    # Columns: the contents of the single-line <th> cells of the first row.
+    columns = []
+    if (q := html.find("<tr>")) >= 0 and (r := html.find("</tr>", q + 5)) >= 0:
+        header_row = html[q + 4 : r]
+        pos = 0
+        while (a := header_row.find("<th>", pos)) >= 0:
+            b = header_row.find("</th>", a + 5)
+            if b < 0 or header_row.startswith("token", a + 4) or "\n" in header_row[a + 4 : b]:
+                pos = a + 1
+                continue
+            columns.append(header_row[a + 4 : b])
+            pos = b + 5
+        if "hash" in columns:
+            columns = ["*"]
+
+    return HtmlTableScan(token, columns, row_count, head)
+
 class NoDataFieldError(Exception):
     pass
 
@@ -49,6 +230,7 @@ class NotebookParser:
             "pdf": config["activity_map_pdf_path"],
             "svg": config["activity_map_svg_path"],
         }
+        self.cache = open_cache(config, "parse")
 
         
     def __call__(self, cells):
@@ -68,14 +250,13 @@ class NotebookParser:
             if not source:
                 # Ignore empty cells.
                 continue
+            analysis = self.analyse_cell_through_cache(cell)
 
             if cell["cell_type"] == "markdown":
                 source = "".join(source)
 
-                if m := re.match(r"(#{1,3}) (.+)", cell["source"][0]):
-                    depth = len(m[1]) - 1
-                    title = m[2].strip()
-                    subtitle = "".join(cell["source"][1:]).strip()  # the rest of the cell may consist in a subtitle
+                if heading := analysis.get("heading"):
+                    (depth, title, subtitle) = heading
                     section_path[depth:] = [(title, subtitle)]
                     if not db_metadata:
                         db_metadata["kind"] = "db_metadata"
@@ -83,7 +264,7 @@ class NotebookParser:
                         db_metadata["pitch"] = subtitle
                     continue
 
-                (label, salt, text) = separate_label_salt_and_text(source)
+                (label, salt, text) = analysis["label_salt_and_text"]
                 if not label:
                     continue
                 assert salt not in salts, f"{FAIL}Salt '{salt}' already used.\n{source}.{RESET}"
@@ -135,32 +316,31 @@ class NotebookParser:
             elif cell["cell_type"] == "code":
 
                 # If the cell starts by raising a EOFError, ignore everything after it.
-                if source[0].startswith("raise EOFError"):
+                if analysis.get("eof"):
                     break
 
                 # If the cell starts with a Python assignement of the form x = ... # ..., store
                 # the instruction for replacing the (0) placeholder with the value of x.
-                if m := re.match(r"x *= *.+ *# *(.+)", source[0]):
+                if tweak := analysis.get("tweak"):
                     assert segments, f"{FAIL}A tweak must be preceded by an exercise or an episode.\n{source}.{RESET}"
                     assert not segments[-1]["tweak"], f"{FAIL}{segments[-1]['kind']} [{segments[-1]['salt']}] already has a tweak.\n{source}.{RESET}"
                     if not segments[-1]["tweak"]:
-                        segments[-1]["tweak"] = m[1] # store the first tweak as the default one
-                        for line in source[1:]: # add the non-natural language tweaks
-                            if m := re.match(r"# (\w+): (.+)", line):
-                                segments[-1][f"tweak_{m[1].lower()}"] = m[2].strip()
+                        segments[-1]["tweak"] = tweak # store the first tweak as the default one
+                        for (name, value) in analysis["tweak_extras"]: # add the non-natural language tweaks
+                            segments[-1][f"tweak_{name}"] = value
 
                 # Ignore all the cells that do not start with the magic command %%sql.
-                if not source[0].startswith("%%sql"):
+                if not (sql := analysis.get("sql")):
                     continue
 
                 # Now we have a code cell that starts with %%sql.
                 source = "".join(source[1:])  # strips the magic command
-                (label, text, raw_query, next_salt) = split_sql_source(source)
+                (label, text, raw_query, next_salt) = (sql["label"], sql["text"], sql["raw_query"], sql["next_salt"])
                 kind = self.labels_to_kinds.get(label.lower(), "")
                 if kind == "action": # This query is not meant to be recorded, but to bring the DB to a certain state
                     continue
-                (query, formula, salt) = separate_query_formula_and_salt(raw_query)
-                token = self.extract_first_token_from_output(cell)
+                (query, formula, salt) = (sql["query"], sql["formula"], sql["salt"])
+                token = sql["token"]
 
                 if salt:
                     assert salt != next_salt, f"{FAIL}Self-reference with salt {salt}.\n{source}{RESET}"
@@ -198,12 +378,15 @@ class NotebookParser:
                     token = token or segments[-1]["default_token"]
                     if label:
                         text = f"{label}. {text}"
-                    html_table = self.find_html_table(cell)
+                    if not sql["has_table"]:
+                        print(f"{WARNING}No table in the output.{RESET}")
+                        print(cell["outputs"])
+                        print()
                     solution = {
                         "intro": text, # a "sticky" annotation, useful for a variant with a different token
                         "query": query,
-                        "columns": self.extract_column_names(html_table),
-                        "result_head": self.extract_result_head(html_table),
+                        "columns": sql["columns"],
+                        "result_head": sql["result_head"],
                         "next_salt": next_salt,
                         "token": token
                     }
@@ -247,7 +430,8 @@ class NotebookParser:
         records = {}
         non_hint_tokens = set()
         hint_tokens = set()
-        for segment in segments:
+        for (record_id, segment) in enumerate(segments, 1):
+            segment["record_id"] = record_id  # identifies the record across its tokens, even after a JSON round trip
             salt = segment["salt"]
             main_token = salt  # the salt serves as its own token in an exercise or a first episode
             if tokens := tokens_by_salt.get(salt):
@@ -273,56 +457,82 @@ class NotebookParser:
         self.dump_graph(records)
 
         records["db_metadata"] = db_metadata
+        self.cache.commit()
         return records
-    
-    @staticmethod
-    def extract_first_token_from_output(
-        code_cell: dict,
-        search_token= re.compile(r"<th>token</th>\n(?:.+\n)*? *<td>(\d+)</td>\s+</tr>").search,
-    ) -> Optional[str]:
-        for output in code_cell["outputs"]:
-            if "text/html" in output.get("data", ""):
-                table = "".join(output["data"]["text/html"])
-                if m := search_token(table):
-                    return(m[1])
 
+    def analyse_cell_through_cache(self, cell: dict) -> dict:
+        """Analyse the given cell, unless it has not changed since its last analysis."""
+        key = digest(PARSE_CACHE_VERSION, cell["cell_type"], cell["source"], cell.get("outputs"))
+        analysis = self.cache.get(key)
+        if analysis is None:
+            analysis = self.analyse_cell(cell)
+            self.cache.set(key, analysis)
+        return analysis
+
+    @classmethod
+    def analyse_cell(cls, cell: dict) -> dict:
+        """
+        Run the regular expressions and the HTML extractors on a non-empty cell. The result depends
+        neither on the other cells nor on the configuration, and is JSON-serializable, which makes
+        it cacheable. The stateful checks and the resolution of the salts are left to the caller.
+        """
+        source = cell["source"]
+        analysis = {}
+        if cell["cell_type"] == "markdown":
+            if m := re.match(r"(#{1,3}) (.+)", source[0]):
+                subtitle = "".join(source[1:]).strip()  # the rest of the cell may consist in a subtitle
+                analysis["heading"] = (len(m[1]) - 1, m[2].strip(), subtitle)
+            else:
+                analysis["label_salt_and_text"] = separate_label_salt_and_text("".join(source))
+        elif cell["cell_type"] == "code":
+            if source[0].startswith("raise EOFError"):
+                analysis["eof"] = True
+                return analysis
+            if m := re.match(r"x *= *.+ *# *(.+)", source[0]):
+                analysis["tweak"] = m[1]
+                analysis["tweak_extras"] = []
+                for line in source[1:]:
+                    if m := re.match(r"# (\w+): (.+)", line):
+                        analysis["tweak_extras"].append((m[1].lower(), m[2].strip()))
+            if source[0].startswith("%%sql"):
+                (label, text, raw_query, next_salt) = split_sql_source("".join(source[1:]))
+                (query, formula, salt) = separate_query_formula_and_salt(raw_query)
+                (token, table_scan) = cls.scan_outputs(cell)
+                analysis["sql"] = {
+                    "label": label,
+                    "text": text,
+                    "raw_query": raw_query,
+                    "next_salt": next_salt,
+                    "query": query,
+                    "formula": formula,
+                    "salt": salt,
+                    "token": token,
+                    "has_table": table_scan is not None,
+                    "columns": table_scan.columns if table_scan else [],
+                    "result_head": table_scan.head if table_scan else "",
+                }
+        return analysis
+    
     @staticmethod
-    def find_html_table(code_cell: dict) -> str:
-        """Find the first output which contains an HTML table and return it."""
+    def scan_outputs(code_cell: dict) -> tuple[Optional[str], Optional["HtmlTableScan"]]:
+        """
+        Return the first token found in the HTML outputs of the cell, and the scan of the first
+        output consisting in an HTML table (None if there is no such output).
+        """
+        (token, table_scan) = (None, None)
         for output in code_cell["outputs"]:
-            if "data" in output:
-                table = "".join(output["data"]["text/html"])
-                if table.startswith("<table>"):
-                    return table
-        print(f"{WARNING}No table in the output.{RESET}")
-        print(code_cell["outputs"])
-        print()
-        return ""
-
-    @staticmethod
-    def extract_result_head(table: str) -> str:
-        """Keep only the first two rows of the table."""
-        if not table:
-            return ""
-        n = table.count("<tr>") - 1  # Don't rely on the number of affected rows
-                                     # displayed by MySQL or PostgreSQL, since SQLite
-                                     # displays it only for the DML statements.
-        count_str = f"\nTotal: {n} row{'s'[:n^1]} affected."
-        return re.sub(r"(?s)(<table>\n(?:.*?<tr>.+?</tr>\n){,3}).*(</table>)", fr"\1\2{count_str}", table)
+            if "text/html" not in output.get("data", ""):
+                continue
+            html = "".join(output["data"]["text/html"])
+            scan = scan_html_table(html)
+            if token is None:
+                token = scan.token
+            if table_scan is None and html.startswith("<table>"):
+                table_scan = scan
+            if token is not None and table_scan is not None:
+                break
+        return (token, table_scan)
 
-    @staticmethod
-    def extract_column_names(table: str) -> list:
-        """Extract column names from the HTML table, except token."""
-        if not table:
-            return []
-        # Find the header row (first <tr> tag)
-        header_row = re.search(r"(?s)<tr>(.+?)</tr>", table).group(1)
-        # Extract text from each <th> tag
-        columns = re.findall(r"<th>(?!token)(.+?)</th>", header_row)
-        if "hash" in columns:
-            columns = ["*"]
-        return columns
-    
     @staticmethod
     def actual_solutions(segment_or_record):
         """Filter out the annotations (strings) and return the actual solutions (dictionaries)."""
@@ -354,12 +564,12 @@ class NotebookParser:
         has_exercises = False
         seen_records = set()
         for (token, record) in records.items():
-            record_hash = hash(str(record))
-            if record_hash in seen_records:
-                continue
-            seen_records.add(record_hash)
             if isinstance(record, str):
                 continue
+            record_id = record.get("record_id", token)  # a hint has a single token
+            if record_id in seen_records:
+                continue
+            seen_records.add(record_id)
             x = record["salt"]
             if record["kind"] == "exercise":
                 has_exercises = True
@@ -439,14 +649,10 @@ class NotebookParser:
         self.activity_map_gv_path.write_text(text)
         print(f"Graph written to '{self.activity_map_gv_path}'.")
         with contextlib.suppress(ImportError):
-            graphviz = importlib.import_module("graphviz")
-            source = graphviz.Source(text)
-            for format in ("pdf", "svg"):
-                source.render(
-                    filename=self.graph_format_path[format].stem,
-                    directory=self.graph_format_path[format].parent,
-                    format=format,
-                    cleanup=True
-                )
-                print(f"Activity map converted into {format.upper()}.")
+            importlib.import_module("graphviz")
+            # The layout may take seconds: let the caller go on with its work in the meantime.
+            # The worker is spawned rather than forked, since the caller may hold a connection.
+            executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            graph_renderings.append(executor.submit(render_graph, text, self.graph_format_path))
+            executor.shutdown(wait=False)  # The pending conversion is still carried out
 
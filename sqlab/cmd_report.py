@@ -1,20 +1,24 @@
 """
 Parse the CSV file student_logs.csv.
-For each call to the function `decrypt()`, check if the `token` argument is in `records.json`.
+For each call to the function `decrypt()`, check if the `token` argument is in `token_table.tsv`.
 If not, print the previous query.
 """
 
 import csv
+import io
 import itertools
 import json
+import os
 import re
-from collections import Counter, defaultdict
-from hashlib import md5
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from .database import database_factory, SQLError
+from .config import reload_config
+from .database import database_factory, QueryTimeoutError
 from .text_tools import FAIL, OK, RESET, WARNING, SQLFormatter
-from .cmd_parse import run as parse_notebook
+from .report_store import ReportStore, merge_partials
+from .token_table import Item, TokenTable
 
 def parse_tsv(log_path: Path) -> list[tuple]:
     result = []
@@ -25,130 +29,272 @@ def parse_tsv(log_path: Path) -> list[tuple]:
             result.append((timestamp, query))
     return result
 
-def init_report(records: list[dict]) -> dict:
+def describe(item: Item) -> str:
+    """Describe the role of a token, e.g. "exercise 3", "exercise 3, hint", "adventure 1, episode 2, solution"."""
+    label = "exercise" if item.activity == 0 else f"adventure {item.activity}, episode"
+    if item.action == "enter":
+        return f"{label} {item.target}"
+    if item.action == "hint":
+        return f"{label} {item.source}, hint"
+    return f"{label} {item.source}, solution"
+
+
+def collect_queries_and_formulas(records: dict) -> dict[str, tuple]:
+    """
+    Map the tokens produced by the solutions and the hints of the given records to their query and
+    to the formula of their task (None for a hint).
+    """
     result = {}
-    exercise_counter = itertools.count(1)
-    question_counter = itertools.count(1)
-    for record in records:
+    for (token, record) in records.items():
         kind = record.get("kind")
-        if "output_token" in record:
-            token = record.get("output_token")
-            if kind == "exercise":
-                i = next(exercise_counter)
-                sub_counter = itertools.count(1)
-            elif kind in ("question", "adventure"):
-                i = next(question_counter)
-                sub_counter = itertools.count(1)
-            if kind in ("exercise", "adventure"):
-                result[record["entry_token"]] = {
-                    "kind": f"{kind} {i}",
-                    "hits": 0,
-                    "produced_at": defaultdict(int),
-                    "decrypted_at": defaultdict(int),
-                }
-            result[token] = {
-                "kind": f"{kind} {i}",
-                "query": record.get("query"),
-                "formula": record.get("formula"),
-                "hits": 0,
-                "produced_at": defaultdict(int),
-                "decrypted_at": defaultdict(int),
-            }
-        elif "entry_token" in record:
-            token = record["entry_token"]
-            result[token] = {
-                "kind": f"{kind} {i}.{next(sub_counter)}",
-                "hits": 0,
-                "produced_at": defaultdict(int),
-                "decrypted_at": defaultdict(int),
-            }
+        if kind in ("exercise", "episode"):
+            for solution in record["solutions"]:
+                if not isinstance(solution, str):
+                    result[str(int(solution["token"]))] = (solution["query"], record.get("formula"))
+        elif kind == "hint":
+            result[str(int(token))] = (record.get("query"), None)
     return result
 
 
-def run(config: dict):
+def init_report(config: dict, token_table: TokenTable, store: ReportStore):
+    """
+    Register the tokens of the token table. Those produced by a solution or a hint come with their
+    query and formula, when the records of the last parse are available.
+    """
+    records_path = Path(config["records_path"])
+    records = json.loads(records_path.read_text(encoding="utf8")) if records_path.is_file() else {}
+    queries_and_formulas = collect_queries_and_formulas(records)
+    for item in token_table:
+        token = str(item.token)
+        store.add_task(token, describe(item), *queries_and_formulas.get(token, (None, None)))
+
+
+def tail_csv(log_path: Path, poll_interval: float):
+    """
+    Poll the given CSV file forever, and yield the list of (timestamp, query) rows appended since
+    the previous iteration (possibly an empty list). A row is yielded only when complete, i.e. when
+    its final newline is outside any quoted field, since the queries may span several lines. The
+    blank lines and the rows lacking a query are skipped.
+    """
+    with log_path.open(encoding="utf8", newline="") as file:
+        buffer = ""
+        header_skipped = False
+        while True:
+            if log_path.stat().st_size < file.tell():  # The file has been truncated or rotated
+                file.seek(0)
+                (buffer, header_skipped) = ("", False)
+            buffer += file.read()
+            end = 0
+            in_quotes = False
+            for (i, char) in enumerate(buffer):
+                if char == '"':
+                    in_quotes = not in_quotes
+                elif char == "\n" and not in_quotes:
+                    end = i + 1
+            rows = list(csv.reader(io.StringIO(buffer[:end])))
+            buffer = buffer[end:]
+            if rows and not header_skipped:
+                rows.pop(0)
+                header_skipped = True
+            rows = [row for row in rows if len(row) >= 2]  # Skip the blank lines, as DictReader does
+            yield [(row[0], row[1]) for row in rows]
+            time.sleep(poll_interval)
+
+
+def write_report(store: ReportStore, report_path: Path):
+    """Compile the report and replace the previous one atomically."""
+    report = store.compile_report()
+    tmp_path = report_path.with_name(f"{report_path.name}.tmp")
+    tmp_path.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    os.replace(tmp_path, report_path)
+
+
+class LogAnalyzer:
+    """
+    Feed the rows of the logs to the report store. The tokens passed to `decrypt()` are recorded
+    directly, while the queries calling a salt function are replayed to retrieve their token.
+    All tokens are normalized as integers in decimal notation.
+    The state is kept between the calls, so that the logs can be processed incrementally: a token
+    missing from the token table is reported once both produced and decrypted, in whatever order
+    and whichever calls these events occur. When the logs are sharded, this is deferred to the
+    merge of the shards (cf. `reduce_partials()`).
+    """
+
+    def __init__(self, config: dict, db, store: ReportStore, token_table: TokenTable, verbose=False, defer_unknown_tokens=False):
+        self.db = db
+        self.store = store
+        self.token_table = token_table
+        self.verbose = verbose  # Print the errors as they happen
+        self.defer_unknown_tokens = defer_unknown_tokens
+        self.format_sql = SQLFormatter(config)
+        ignored_tokens = Path(config["ignored_tokens_path"]).read_text(encoding="utf8").split()
+        self.ignored_tokens = {str(int(token)) for token in ignored_tokens}
+        self.unknown_decrypted_tokens = set()  # not produced yet
+        self.unknown_produced_queries = {}  # token -> query, for the tokens not decrypted yet
+        self.reported_tokens = set()
+        self.todo_count = 0
+
+    def __call__(self, timestamps_and_queries: list[tuple]):
+        store = self.store
+        for (timestamp, query) in timestamps_and_queries:
+            day = timestamp[:10]
+            if m:= re.match(r"(?is)select\b.+?\bdecrypt\b.+?(\d+)\)", query):
+                token = str(int(m[1]))  # Strip the leading zeros, as in the token table
+                if token in self.ignored_tokens:
+                    continue
+                if token not in self.token_table and not self.defer_unknown_tokens:
+                    store.add_task(token, "unknown") # not produced by any query
+                    if token in self.unknown_produced_queries:  # by a query of a previous call
+                        self.report_unknown_token(token, self.unknown_produced_queries.pop(token))
+                    elif token not in self.reported_tokens:
+                        self.unknown_decrypted_tokens.add(token)
+                store.add_event(token, day, "decrypted")
+
+        for (timestamp, query) in timestamps_and_queries:
+            day = timestamp[:10]
+            if "salt_" in query:
+                query = self.format_sql(query)
+                query = query.replace("LIMIT 0, 25", "LIMIT 1")
+                try:
+                    (headers, datatypes, rows) = self.db.execute_select(query)
+                except QueryTimeoutError:
+                    print(f"\n{WARNING}Query timed out:{RESET}\n{query}", flush=True)
+                    store.add_error("timeout", query)
+                    continue
+                except Exception as e:
+                    cause = e.__cause__ or e
+                    message = getattr(cause, "msg", None) or str(cause)  # msg: without the error code of mysql.connector
+                    message = re.sub(r"'\S+'", "'...'", message)
+                    if self.verbose:
+                        print(f"\n{FAIL}{timestamp} SQL error: {message}{RESET}", flush=True)
+                    store.add_error("sql", message)
+                    continue
+                if "token" not in headers:
+                    store.add_error("no_token")
+                    continue
+                if not rows:
+                    store.add_error("empty_result")
+                    continue
+                try:
+                    token = str(int(rows[0][headers.index("token")]))  # e.g., Decimal("42"), "0042" or 42.0
+                except (TypeError, ValueError):
+                    store.add_error("no_token")
+                    continue
+                if token in self.ignored_tokens:
+                    continue
+                store.add_task(token, "TODO", query)
+                if token in self.unknown_decrypted_tokens:
+                    self.unknown_decrypted_tokens.remove(token)
+                    self.report_unknown_token(token, query)
+                else:
+                    if token not in self.token_table and token not in self.reported_tokens and not self.defer_unknown_tokens:
+                        self.unknown_produced_queries.setdefault(token, query)
+                    print(f"{OK}.{RESET}", end="", flush=True)
+                store.add_event(token, day, "produced")
+        self.format_sql.commit()
+
+    def report_unknown_token(self, token: str, query: str):
+        print_unknown_token(token, query)
+        self.todo_count += 1
+        self.reported_tokens.add(token)
+
+
+def print_unknown_token(token: str, query: str):
+    """Print the query producing a token missing from the token table, as a hint to be written."""
+    print(f"\n{WARNING}Unknown token {token}{RESET}")
+    query = query.replace("LIMIT 0, 1", "")
+    query = f"%%sql\n-- Indication. TODO.\n{query}\n"
+    print(query, flush=True)
+
+
+def map_shard(cli_args: dict, log_path: Path, partial_path: Path):
+    """
+    Map phase of the report, executed in a worker process: replay the given log file in a store of
+    its own, and dump the result as a partial aggregate. The unknown tokens are left to the reduce
+    phase, since a token may be produced in a shard and decrypted in another.
+    """
+    config = reload_config(cli_args)
     db = database_factory(config)
-    db.use(config["db_name"])
+    db.connect()
+    db.set_query_budget(config["report_query_timeout"], config["report_row_limit"])
+    store = ReportStore(partial_path.with_suffix(".sqlite"))
+    token_table = TokenTable(Path(config["token_table_path"]))
+    init_report(config, token_table, store)
+    analyze = LogAnalyzer(config, db, store, token_table, defer_unknown_tokens=True)
+    analyze(parse_tsv(log_path))
+    db.close()
+    partial_path.write_text(json.dumps(store.dump_partial(), ensure_ascii=False))
+    store.close()
+    partial_path.with_suffix(".sqlite").unlink()
+
+
+def reduce_partials(store: ReportStore, partials: list[dict]) -> int:
+    """
+    Reduce phase of the report: load the merged partial aggregates into the given store, and report
+    the unknown tokens produced and decrypted in any of the shards. Return their number.
+    """
+    store.load_partial(merge_partials(*partials))
+    unknown_tokens = store.resolve_unknown_tokens()
+    for (token, query) in unknown_tokens:
+        print_unknown_token(token, query)
+    return len(unknown_tokens)
 
+
+def run_shards(config: dict, store: ReportStore) -> int:
+    """
+    Map the shards in a process pool, and reduce their partial aggregates into the given store.
+    Return the number of unknown tokens.
+    """
+    partial_dir = Path(config["report_path"]).parent / "partials"
+    partial_dir.mkdir(exist_ok=True)
+    log_paths = config["shard_log_paths"]
+    partial_paths = [partial_dir / f"shard_{i:02d}.json" for i in range(len(log_paths))]
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(map_shard, itertools.repeat(config["cli_args"]), log_paths, partial_paths))
+    partials = [json.loads(path.read_text(encoding="utf8")) for path in partial_paths]
+    print(f"\n{len(partials)} partial reports merged from '{partial_dir}'.")
+    return reduce_partials(store, partials)
+
+
+def analyze_log(config: dict, store: ReportStore, token_table: TokenTable) -> int:
+    """Replay the single log file into the given store. Return the number of unknown tokens."""
+    db = database_factory(config)
+    db.connect()
+    db.set_query_budget(config["report_query_timeout"], config["report_row_limit"])
     log_path = Path(config["base_dir"], "logs.csv")
-    format_sql = SQLFormatter(config)
-
-    records = parse_notebook(config)
-    report = init_report(records)
-
-    ignored_tokens = set(Path(config["ignored_tokens_path"]).read_text(encoding="utf8").split())
-    unknown_decrypted_tokens = set()
-    timestamps_and_queries = parse_tsv(log_path)
-    for (timestamp, query) in timestamps_and_queries:
-        day = timestamp[:10]
-        if m:= re.match(r"(?is)select\b.+?\bdecrypt\b.+?(\d+)\)", query):
-            token = m[1]
-            if token in ignored_tokens:
-                continue
-            if token not in report:
-                report[token] = {
-                    "kind": "unknown", # not produced by any query
-                    "hits": 0,
-                    "produced_at": defaultdict(int),
-                    "decrypted_at": defaultdict(int),
-                }
-                unknown_decrypted_tokens.add(token)
-            report[token]["decrypted_at"][day] += 1
-            report[token]["hits"] += 1
-
-    sql_errors = []
-    no_token_errors = 0
-    empty_result_errors = 0
-    todo_count = 0
-    for (timestamp, query) in timestamps_and_queries:
-        day = timestamp[:10]
-        if "salt_" in query:
-            digest = md5(query.encode()).hexdigest()
-            if digest in report:
-                continue
-            query = format_sql(query)
-            query = query.replace("LIMIT 0, 25", "LIMIT 1")
-            try:
-                (headers, datatypes, rows) = db.execute_select(query)
-            except Exception as e:
-                sql_errors.append(re.sub(r"'\S+'", "'...'", e.__cause__.msg))
-                continue
-            if "token" not in headers:
-                no_token_errors += 1
-                continue
-            if not rows:
-                empty_result_errors += 1
-                continue
-            token = str(rows[0][headers.index("token")])
-            if token in ignored_tokens:
-                continue
-            if token not in report:
-                report[token] = {
-                    "kind": "TODO",
-                    "query": query,
-                    "hits": 0,
-                    "produced_at": defaultdict(int),
-                    "decrypted_at": defaultdict(int),
-                }
-            if token in unknown_decrypted_tokens:
-                print(f"\n{WARNING}Unknown token {token}{RESET}")
-                query = query.replace("LIMIT 0, 1", "")
-                query = f"%%sql\n-- Indication. TODO.\n{query}\n"
-                print(query, flush=True)
-                todo_count += 1
-                unknown_decrypted_tokens.remove(token)
-            else:
-                print(f"{OK}.{RESET}", end="", flush=True)
-            report[token]["produced_at"][day] += 1
-            report[token]["hits"] += 1
+    analyze = LogAnalyzer(config, db, store, token_table, verbose=config["follow"])
+    if config["follow"]:
+        print(f"Following '{log_path}'. Press Ctrl-C to stop.")
+        report_path = Path(config["report_path"])
+        flush_interval = config["report_flush_interval"]
+        next_flush = time.monotonic()
+        try:
+            for timestamps_and_queries in tail_csv(log_path, config["report_poll_interval"]):
+                analyze(timestamps_and_queries)
+                if time.monotonic() >= next_flush:
+                    store.commit()
+                    write_report(store, report_path)
+                    next_flush = time.monotonic() + flush_interval
+        except KeyboardInterrupt:
+            pass
+    else:
+        analyze(parse_tsv(log_path))
     db.close()
+    return analyze.todo_count
+
 
+def run(config: dict):
+    token_table_path = Path(config["token_table_path"])
+    if not token_table_path.is_file():
+        raise FileNotFoundError(f"Token table '{token_table_path}' not found. Run the command 'create' first.")
+    store = ReportStore(Path(config["report_store_path"]))
+    if config["shard_log_paths"]:
+        todo_count = run_shards(config, store)
+    else:
+        token_table = TokenTable(token_table_path)
+        init_report(config, token_table, store)
+        todo_count = analyze_log(config, store, token_table)
     print(f"\n{todo_count} to do.")
-    report["hits"] = dict(sorted(
-        [(f"{token} ({v['kind']})", v['hits']) for (token, v) in report.items()],
-        key=lambda x: x[1],
-        reverse=True,
-    ))
-    report["sql_errors"] = dict(Counter(sorted(sql_errors)).most_common())
-    report["no_token_errors"] = no_token_errors
-    report["empty_result_errors"] = empty_result_errors
-    Path(config["report_path"]).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    write_report(store, Path(config["report_path"]))
+    store.close()
+    print(f"Log events stored in '{store.path}' for further queries.")
@@ -1,4 +1,9 @@
+import heapq
+import re
 import sys
+import time
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 
 from cmd2 import Cmd, Settable, Statement
 from cmd2.table_creator import Column, HorizontalAlignment, SimpleTable
@@ -7,6 +12,9 @@ from .database import database_factory
 from .text_tools import OK, RESET, WARNING, FAIL
 
 
+STREAMING_PAGE_SIZE = 1000  # number of rows fetched at once when the display is not paged
+
+
 class Shell(Cmd):
     """
     An SQL shell specialized for an SQL Adventure Builder database.
@@ -14,12 +22,19 @@ class Shell(Cmd):
     - When a query returns a table having a column 'token', the corresponding
     message is automatically displayed.
     - A command containing only digits is interpreted as a call to `decrypt`.
+    - The rows are fetched and displayed page by page. Quitting the pager stops the fetching.
+    - The queries run on a worker thread: Ctrl-C asks the server to cancel the current one,
+    and returns immediately to the prompt.
+    - On demand, the execution and fetch times and the execution plan of the queries are
+    displayed, and the command `slowest` summarizes the most expensive queries of the session.
     """
 
     def __init__(self, db):
         # Empty the remaining args before passing them to the shell.
         sys.argv[1:] = []
         self.db = db
+        self.worker = ThreadPoolExecutor(max_workers=1)  # all the queries, in order, on the same connection
+        self.cancelled = False  # whether the last query run by `run_in_worker()` has been cancelled
         multiline_commands = ["select", "insert", "update", "delete", "alter", "create", "drop"]
         multiline_commands.extend(cmd.upper() for cmd in multiline_commands[:])
         super().__init__(multiline_commands=multiline_commands)
@@ -36,19 +51,91 @@ class Shell(Cmd):
                 settable_attrib_name="max_total_width",
             )
         )
+        self.page_size = 50
+        self.add_settable(
+            Settable(
+                "page_size",
+                int,
+                "Number of rows displayed before asking for more (0 to display them all)",
+                self,
+            )
+        )
+        self.explain = "off"
+        self.add_settable(
+            Settable(
+                "explain",
+                str,
+                "Display the plan of the SELECT queries: never, always, or when slower than slow_threshold",
+                self,
+                choices=["off", "on", "slow"],
+            )
+        )
+        self.slow_threshold = 1.0
+        self.add_settable(
+            Settable(
+                "slow_threshold",
+                float,
+                "Duration (in seconds) above which a query is considered as slow",
+                self,
+            )
+        )
+        self.query_times = []  # (total duration, execution duration, fetch duration, row count, query)
+        self.last_duration = 0.0  # of the last call made by `run_in_worker()`, in seconds
         self.debug = True
         self.do_exit = self.do_quit
         self.do_SELECT = self.do_select
 
     def do_select(self, statement: Statement):
-        """Run the given query, print the resulting table and the decrypted message, if any."""
-        (headers, datatypes, rows) = self.db.execute_select(statement.command_and_args)
-        self.print_table(headers, datatypes, rows)
-        n = len(rows)
-        self.poutput(f"{n} row{'s'[:n^1]} in set\n")
+        """
+        Run the given query, print the resulting table and the decrypted message, if any. The
+        column widths are computed on the first page, and the following pages are fetched only
+        when the user asks for them.
+        """
+        page_size = self.page_size if self.page_size > 0 else STREAMING_PAGE_SIZE
+        result = self.run_in_worker(self.db.iter_select, statement.command_and_args, page_size)
+        if result is None:
+            return
+        (headers, datatypes, pages) = result
+        (execution_time, fetch_time) = (self.last_duration, 0.0)
+        (n, first_row, interrupted) = (0, None, False)
+        try:
+            while (page := self.run_in_worker(next, pages, None)) is not None:
+                fetch_time += self.last_duration
+                if first_row is None:
+                    first_row = page[0]
+                    columns = self.create_columns(headers, datatypes, page)
+                elif self.page_size > 0 and not self.ask_for_more():
+                    interrupted = True
+                    break
+                self.print_table(columns, page, include_header=(n == 0))
+                n += len(page)
+            else:
+                interrupted = self.cancelled
+                fetch_time += self.last_duration
+        finally:
+            self.worker.submit(pages.close)  # after the fetching, which may still be running if cancelled
+        if first_row is None:
+            self.print_table(self.create_columns(headers, datatypes, []), [])
+        self.poutput()
+        timing = self.format_timing(execution_time, fetch_time)
+        if interrupted:
+            self.poutput(f"{n} row{'s'[:n^1]} displayed, the remaining ones have not been fetched{timing}\n")
+        else:
+            self.poutput(f"{n} row{'s'[:n^1]} in set{timing}\n")
+        self.record_query_time(statement.command_and_args, execution_time, fetch_time, n)
+        if self.explain == "on" or (self.explain == "slow" and execution_time + fetch_time > self.slow_threshold):
+            self.print_plan(statement.command_and_args)
         if n and "token" in headers:
-            token = rows[0][headers.index("token")]
+            token = first_row[headers.index("token")]
             self.decrypt(token)
+
+    def ask_for_more(self) -> bool:
+        """Prompt the user for the next page. Any answer starting with q (or EOF) means quit."""
+        try:
+            answer = self.read_input("-- More -- (Enter: next page, q: quit) ")
+        except (EOFError, KeyboardInterrupt):
+            return False
+        return not answer.strip().lower().startswith("q")
     
     def default(self, statement: Statement):
         """Called when the command is not recognized as a do_* method."""
@@ -56,13 +143,98 @@ class Shell(Cmd):
         if full_command.isdigit():
             self.decrypt(full_command)
         else:
-            n = self.db.execute_non_select(full_command)
-            self.poutput(f"\n{n} row{'s'[:n^1]} affected")
+            n = self.run_in_worker(self.db.execute_non_select, full_command)
+            if n is not None:
+                self.poutput(f"\n{n} row{'s'[:n^1]} affected{self.format_timing(self.last_duration)}")
+                self.record_query_time(full_command, self.last_duration, 0.0, n)
+
+    def do_slowest(self, statement: Statement):
+        """Print the slowest queries of the session (by default, the ten slowest ones)."""
+        count = int(statement.args) if statement.args.isdigit() else 10
+        slowest = heapq.nlargest(count, self.query_times)
+        if not slowest:
+            self.poutput("No query timed yet.")
+            return
+        for (rank, (total, execution, fetch, n, query)) in enumerate(slowest, 1):
+            color = WARNING if total > self.slow_threshold else ""
+            self.poutput(f"{color}{rank:>3}. {total:.3f} s{RESET if color else ''} (execution: {execution:.3f} s, fetch: {fetch:.3f} s, {n} row{'s'[:n^1]})")
+            self.poutput(f"     {query[:self.max_total_width - 5]}")
 
     def decrypt(self, token):
         """Execute the `decrypt` function with the given token."""
-        result = self.db.call_function("decrypt", token)
-        self.poutput(result[0].replace("\\n", "\n").replace("''", "'"))
+        result = self.run_in_worker(self.db.call_function, "decrypt", token)
+        if result is not None:
+            self.poutput(result[0].replace("\\n", "\n").replace("''", "'"))
+
+    def format_timing(self, execution_time: float, fetch_time: float = None) -> str:
+        """
+        Return the durations to be appended to the row count, if the built-in settable `timing` of
+        cmd2 is on (the total elapsed time is then displayed too). Note that the execution time
+        includes the fetching of the first page: some drivers only actually execute the query when
+        its first rows are requested.
+        """
+        if not self.timing:
+            return ""
+        if fetch_time is None:
+            return f" ({execution_time:.3f} s)"
+        return f" (execution: {execution_time:.3f} s, fetch: {fetch_time:.3f} s)"
+
+    def record_query_time(self, query: str, execution_time: float, fetch_time: float, n: int):
+        query = re.sub(r"\s+", " ", query).strip()
+        self.query_times.append((execution_time + fetch_time, execution_time, fetch_time, n, query))
+
+    def print_plan(self, query: str):
+        """Print the execution plan of the given query, as provided by the backend."""
+        result = self.run_in_worker(self.db.explain, query)
+        if result is None:
+            return
+        (headers, datatypes, rows) = result
+        self.poutput("Query plan:")
+        self.print_table(self.create_columns(headers, datatypes, rows), rows)
+        self.poutput()
+
+    def run_in_worker(self, function, *args):
+        """
+        Call the given function on the worker thread and return its result. Its duration, measured
+        on the worker thread, is stored in `self.last_duration`. On Ctrl-C, ask the server to
+        cancel the query, and return None without waiting for the worker: its error, if any, is
+        ignored, and the next query will run once it is done.
+        """
+
+        def timed_call():
+            start = time.perf_counter()
+            result = function(*args)
+            return (result, time.perf_counter() - start)
+
+        self.cancelled = False
+        future = self.worker.submit(timed_call)
+        try:
+            (result, self.last_duration) = future.result()
+            return result
+        except KeyboardInterrupt:
+            self.cancelled = True
+            future.add_done_callback(self.release_abandoned_result)
+            if not future.cancel():  # already running
+                try:
+                    self.db.cancel()
+                except NotImplementedError as e:
+                    self.poutput(f"{WARNING}{e} Waiting for the server in the background.{RESET}")
+                    return None
+            self.poutput(f"\n{WARNING}Query cancelled.{RESET}")
+            return None
+
+    def release_abandoned_result(self, future):
+        """
+        When the result of a cancelled call is a SELECT which has completed anyway, close its pages
+        to release its cursor (on PostgreSQL, a named cursor in a transaction). This callback runs
+        on the worker thread, or on the main thread if the call had already completed: in both
+        cases, no other call is using the connection.
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        (result, _) = future.result()
+        if isinstance(result, tuple) and isinstance(result[-1], Generator):
+            result[-1].close()
 
     # https://github.com/PyMySQL/PyMySQL/blob/main/pymysql/constants/FIELD_TYPE.py
     NUMERIC_TYPE_CODES = {
@@ -84,7 +256,8 @@ class Shell(Cmd):
         else:
             return HorizontalAlignment.LEFT
 
-    def print_table(self, headers, datatypes, rows):
+    def create_columns(self, headers, datatypes, rows) -> list[Column]:
+        """Size the columns after the given rows. The longer cells of the subsequent rows will be truncated."""
         widths = [len(header) for header in headers]
         for row in rows:
             for i, cell in enumerate(row):
@@ -102,13 +275,18 @@ class Shell(Cmd):
                 data_horiz_align=align,
             )
             columns.append(column)
-        table = SimpleTable(columns)
-        self.poutput(table.generate_table(rows, row_spacing=0))
-        self.poutput()
+        return columns
 
+    def print_table(self, columns, rows, include_header=True):
+        table = SimpleTable(columns)
+        self.poutput(table.generate_table(rows, include_header=include_header, row_spacing=0))
 
 def run(config: dict):
     db = database_factory(config)
     db.connect()
-    Shell(db).cmdloop()
+    shell = Shell(db)
+    shell.cmdloop()
+    if shell.timing:
+        shell.onecmd("slowest")
+    shell.worker.shutdown()  # wait for a cancelled query to actually stop
     db.close()
@@ -1,6 +1,7 @@
 import unicodedata
 from ast import literal_eval
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
 import json
 
 from .text_tools import WARNING, RESET, OK
@@ -11,13 +12,30 @@ def compose_message_inserts(db, rows: list[str]) -> str:
     insert their encrypted version in the `sqlab_msg` table. No actual insertion is
     performed. The db argument is only required to use the encrypt() method.
     """
-    commands = ["\nDELETE FROM sqlab_msg;"]
-    commands.append("\nINSERT INTO sqlab_msg (msg) VALUES")
+    return "\n".join(iter_message_inserts(db, rows))
+
+
+def iter_message_inserts(
+    db,
+    rows: Iterable[tuple[str, str]],
+    batch_size: Optional[int] = None,
+    on_encrypted: Optional[Callable[[str, str], None]] = None,
+) -> Iterator[str]:
+    """
+    Same as `compose_message_inserts()`, but yield the commands as soon as possible: first the
+    suppression of the existing messages, then an INSERT for each batch of rows (a single one if no
+    batch size is given), so that the rows can be produced and inserted in a pipeline.
+    The optional callback is called with each token and its encrypted message.
+    """
+    yield "\nDELETE FROM sqlab_msg;"
     round_trip_errors = 0
+    values = []
     for (token, plain) in rows:
         plain = plain.replace("\u00A0", " ") # Non-breaking spaces with normal spaces cause a round-trip error.
         encrypted = db.encrypt(plain, token)
-        commands.append(f"  ({encrypted}),")
+        values.append(f"  ({encrypted}),")
+        if on_encrypted:
+            on_encrypted(token, encrypted)
         # Check the round trip
         decrypted = db.decrypt(encrypted, token)
         if decrypted != plain:
@@ -29,14 +47,21 @@ def compose_message_inserts(db, rows: list[str]) -> str:
                 print(f"{WARNING}Unexpected decrypted message for token {token}{RESET}")
                 print(f"Decrypted: {repr(decrypted)}")
             round_trip_errors += 1
+        if len(values) == batch_size:
+            yield compose_insert_into_sqlab_msg(values)
+            values = []
+    if values or batch_size is None:
+        yield compose_insert_into_sqlab_msg(values)
     if round_trip_errors:
         print(f"{WARNING}Round-trip errors have been detected (see above).{RESET}")
     else:
         print(f"{OK}Round-trip test successful.{RESET}")
 
-    commands[-1] = commands[-1].rstrip(",")
-    commands.append(";")
-    return "\n".join(commands)
+
+def compose_insert_into_sqlab_msg(values: list[str]) -> str:
+    if values:
+        values[-1] = values[-1].rstrip(",")
+    return "\n".join(["\nINSERT INTO sqlab_msg (msg) VALUES", *values, ";"])
 
 
 def compose_data_inserts(config: dict, db, trigger_template) -> str:
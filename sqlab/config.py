@@ -1,3 +1,5 @@
+import argparse
+import copy
 import getpass
 import importlib
 import os
@@ -24,13 +26,25 @@ defaults = { # Not a JSON object because it contains comments and Python lambda
     "activity_map_svg_path": "./output/activity_map.svg",
     "log_path": "./output/msg.log",
     "records_path": "./output/records.json",
+    "web_bundle_path": "./output/web_bundles", # with --web, directory of the static shards of the encrypted messages, created on demand
+    "web_bundle_prefix_length": 2, # number of hexadecimal digits of the token hashes naming the shards
+    "cache_path": "./output/cache.sqlite", # intermediate results reused between builds
     "token_table_path": "./output/token_table.tsv",
     "report_path": "./output/report.json",
+    "report_store_path": "./output/report.sqlite",
+    "report_query_timeout": 5, # in seconds, for each student query replayed by the report
+    "report_row_limit": 1000, # maximal number of rows fetched for each replayed query
+    "report_poll_interval": 1, # in seconds, for checking the logs with `report --follow`
+    "report_flush_interval": 5, # in seconds, for rewriting the report with `report --follow`
     "storyline_path": "./output/storyline.md",
     "salt_seed": 42,
     "salt_bound": 100,
     "column_width": 100, # for wrapping text in the `sqlab_msg` table
+    "formatting_jobs": None, # number of processes formatting the messages (None: one per CPU)
+    "message_batch_size": 500, # number of messages encrypted and inserted at once
     "reformat_sql": True, # Reformat the SQL queries in the notebook
+    "notebook_runner": "kernel", # or "direct": execute the %%sql cells through sqlab instead of jupysql
+    "notebook_jobs": 1, # with the direct runner, number of exercises or adventures executed in parallel
     "sqlparse_kwargs": {
         "keyword_case": "upper",  # Limitation: https://github.com/andialbrecht/sqlparse/pull/501
         "identifier_case": "lower",
@@ -104,8 +118,9 @@ defaults = { # Not a JSON object because it contains comments and Python lambda
 
 def get_config(args):
 
-    # Initialize the configuration with the default values.
-    config = defaults.copy()
+    # Initialize the configuration with the default values. The copy is deep, since the nested
+    # dictionaries are updated below, and several configurations may be built in the same process.
+    config = copy.deepcopy(defaults)
 
     # Use an undocumented feature simulating an import from anywhere,
     # cf. https://stackoverflow.com/a/68361215/173003.
@@ -136,6 +151,14 @@ def get_config(args):
     # Create a entry "strings" with the appropriate language, defaulting to English.
     config["strings"] = config.get(f"strings_{config['language']}", config[f"strings_en"])
 
+    # With the command `report`, keep following the logs, or aggregate the logs of several servers.
+    config["follow"] = args.follow
+    config["shard_log_paths"] = [Path(path) for path in args.shards or []]
+
+    # Share the cache of intermediate results with other configurations (e.g., in a batch).
+    if args.cache:
+        config["cache_path"] = args.cache
+
     # Set the output format based on the command-line arguments.
     config["markdown_to"] = "txt"
     if args.web:
@@ -201,4 +224,13 @@ def get_config(args):
             svg_source = path.read_text(encoding="utf-8")
             svg_source = rex.sub('fill="none"', svg_source, 1)
             config["metadata"][f"relational_schema_{suffix}"] = svg_source
+
+    # Keep the arguments (with the password resolved) to rebuild the configuration in a worker
+    # process: the configuration itself cannot be pickled, since it may contain lambda functions.
+    config["cli_args"] = {**vars(args), "password": cnx["password"]}
     return config
+
+
+def reload_config(cli_args: dict) -> dict:
+    """Rebuild a configuration from the command-line arguments stored in its entry "cli_args"."""
+    return get_config(argparse.Namespace(**cli_args))
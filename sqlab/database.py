@@ -1,5 +1,5 @@
 import importlib
-from typing import Any
+from typing import Any, Iterator
 
 def database_factory(config: dict):
     """Return a Database object according to the dbms specified in the configuration."""
@@ -7,6 +7,10 @@ def database_factory(config: dict):
     return db.Database(config)
 
 
+class QueryTimeoutError(RuntimeError):
+    """Raised when a query exceeds the execution time set by `set_query_budget()`."""
+
+
 class AbstractDatabase:
     """
     To be inherited by the dbms-specific database classes.
@@ -16,6 +20,8 @@ class AbstractDatabase:
     def __init__(self, config: dict):
         """Just store the configuration. The connection will be created later."""
         self.config = config
+        self.query_timeout = None  # in seconds, None for no limit
+        self.row_limit = None  # maximal number of rows fetched, None for no limit
 
     def connect(self):
         """
@@ -66,18 +72,84 @@ class AbstractDatabase:
         """Execute the queries of the given text and return the number of affected rows."""
         raise NotImplementedError
 
+    def set_query_budget(self, timeout: float = None, row_limit: int = None):
+        """
+        Limit the wall-clock time and the number of fetched rows of the subsequent queries
+        executed by `execute_select()`. The timeout is enforced by the server when possible.
+        Subclasses extend this method to apply the limits to the current session.
+        """
+        self.query_timeout = timeout
+        self.row_limit = row_limit
+
+    def is_timeout_error(self, error: Exception) -> bool:
+        """Tell whether the given exception results from exceeding the query timeout."""
+        return False
+
     def execute_select(self, query_text: str) -> tuple[list[str], list[str], list[tuple]]:
         """Execute the given query and return the headers, datatypes and rows of the result."""
         cursor = self.cnx.cursor()
         try:
             cursor.execute(query_text)
+            if self.row_limit is None:
+                rows = cursor.fetchall()
+            else:
+                rows = cursor.fetchmany(self.row_limit)
         except Exception as e:
+            if self.is_timeout_error(e):
+                raise QueryTimeoutError(f"Query timed out after {self.query_timeout} s: {query_text}") from e
             raise RuntimeError(f"Error executing query: {query_text}") from e
-        rows = cursor.fetchall()
         headers = [desc[0] for desc in cursor.description]
         datatypes = [desc[1] for desc in cursor.description]
         return (headers, datatypes, rows)
 
+    explain_prefix = "EXPLAIN "  # prepended to a query to get its execution plan
+
+    def explain(self, query_text: str) -> tuple[list[str], list[str], list[tuple]]:
+        """Return the execution plan of the given query, without executing it."""
+        return self.execute_select(self.explain_prefix + query_text)
+
+    def iter_select(self, query_text: str, page_size: int) -> tuple[list[str], list[str], Iterator[list[tuple]]]:
+        """
+        Same as `execute_select()`, but fetch the rows lazily, by pages of the given size. The first
+        page is fetched immediately. Closing the page iterator, even before its first page, stops
+        the fetching and releases the cursor.
+        """
+
+        def iter_pages():
+            """Yield the headers and datatypes of the result, then its pages."""
+            cursor = self.open_streaming_cursor()
+            try:
+                try:
+                    cursor.execute(query_text)
+                    page = cursor.fetchmany(page_size)
+                except Exception as e:
+                    raise RuntimeError(f"Error executing query: {query_text}") from e
+                yield ([desc[0] for desc in cursor.description], [desc[1] for desc in cursor.description])
+                while page:
+                    yield page
+                    page = cursor.fetchmany(page_size)
+            finally:
+                self.close_streaming_cursor(cursor)
+
+        pages = iter_pages()
+        (headers, datatypes) = next(pages)  # a started generator runs its finally clause when closed
+        return (headers, datatypes, pages)
+
+    def open_streaming_cursor(self):
+        """Return a cursor fetching the rows from the server on demand, rather than all at once."""
+        return self.cnx.cursor()
+
+    def close_streaming_cursor(self, cursor):
+        """Close a cursor returned by `open_streaming_cursor()`, possibly before its last row."""
+        cursor.close()
+
+    def cancel(self):
+        """
+        Ask the server to stop the query currently executed on the connection. To be called from
+        another thread than the one waiting for the result, which will then receive an error.
+        """
+        raise NotImplementedError(f"{self.config['dbms']} queries cannot be cancelled.")
+
     def call_function(self, function_name, *args):
         """Call the given function with the given arguments and return the first row of the result."""
         cursor = self.cnx.cursor()
@@ -100,6 +172,19 @@ class AbstractDatabase:
     def create_database(self):
         raise NotImplementedError
 
+    def create_clones(self, count: int) -> list["AbstractDatabase"]:
+        """
+        Return the given number of connected copies of the current database, to be modified
+        independently of it and of each other. Raise NotImplementedError if there is no cheap way to
+        clone a database with the DBMS.
+        """
+        raise NotImplementedError(f"{self.config['dbms']} databases cannot be cloned.")
+
+    def drop_clones(self, clones: list["AbstractDatabase"]):
+        """Close and delete the clones created by `create_clones()`."""
+        for clone in clones:
+            clone.close()
+
     @staticmethod
     def reset_table_statement(table: str) -> str:
         """Return a query suppressing all rows and resetting the auto increment."""
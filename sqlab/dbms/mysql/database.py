@@ -1,3 +1,4 @@
+import contextlib
 import re
 import mysql.connector
 import json
@@ -59,6 +60,59 @@ class Database(AbstractDatabase):
         query = f"SELECT CONVERT(UNCOMPRESS(AES_DECRYPT({encrypted}, {token})) USING utf8mb4)"
         return self.execute_select(query)[2][0][0]
     
+    def set_query_budget(self, timeout=None, row_limit=None):
+        """
+        The timeout applies to the SELECT statements only. MariaDB ignores MAX_EXECUTION_TIME, and
+        provides instead max_statement_time, expressed in seconds. The row limit is enforced by the
+        server too, which bounds the number of rows transferred.
+        """
+        super().set_query_budget(timeout, row_limit)
+        if "mariadb" in self.dbms_version.lower():
+            statement = f"SET SESSION max_statement_time = {timeout or 0}"
+        else:
+            statement = f"SET SESSION MAX_EXECUTION_TIME = {round(timeout * 1000) if timeout else 0}"
+        with self.cnx.cursor() as cursor:
+            cursor.execute(statement)
+            cursor.execute(f"SET SESSION sql_select_limit = {row_limit or 'DEFAULT'}")
+
+    def execute_select(self, query_text):
+        """
+        The default cursor of mysql.connector is unbuffered: fetching the first `row_limit` rows
+        stops before the end of the result, even if it has no other row. The end of the result must
+        be read, otherwise the next query fails with "Unread result found".
+        """
+        try:
+            return super().execute_select(query_text)
+        finally:
+            if self.cnx.unread_result:
+                self.cnx.consume_results()
+
+    def is_timeout_error(self, error):
+        # 3024: ER_QUERY_TIMEOUT (MySQL), 1969: ER_STATEMENT_TIMEOUT (MariaDB)
+        return getattr(error, "errno", None) in (3024, 1969)
+
+    def cancel(self):
+        """The connection is busy waiting for the result: kill the query through a side connection."""
+        side_cnx = mysql.connector.connect(**self.config["cnx"])
+        try:
+            with side_cnx.cursor() as cursor:
+                cursor.execute(f"KILL QUERY {self.cnx.connection_id}")
+        finally:
+            side_cnx.close()
+
+    def close_streaming_cursor(self, cursor):
+        """
+        The default cursor of mysql.connector is unbuffered, and thus streams the rows. But those
+        which have not been fetched must be read before closing it, otherwise the next query fails
+        with "Unread result found". The query is killed first, so that the server stops sending
+        them: the result is then ended by an error ("Query execution was interrupted").
+        """
+        if self.cnx.unread_result:
+            self.cancel()
+            with contextlib.suppress(mysql.connector.Error):
+                self.cnx.consume_results()
+        cursor.close()
+
     def execute_non_select(self, text):
         if not text.strip():
             return None
@@ -1,8 +1,9 @@
 import re
 import psycopg2
 import json
+from contextlib import closing
 
-from ...database import AbstractDatabase
+from ...database import AbstractDatabase, QueryTimeoutError
 from ...text_tools import FAIL, OK, RESET, WARNING
 from ...text_tools import repr_single
 
@@ -70,6 +71,57 @@ class Database(AbstractDatabase):
         query = fr"SELECT pgp_sym_decrypt({encrypted}, {repr(token)}, 'cipher-algo=aes')"
         return self.execute_select(query)[2][0][0]
 
+    def set_query_budget(self, timeout=None, row_limit=None):
+        super().set_query_budget(timeout, row_limit)
+        milliseconds = round(timeout * 1000) if timeout else 0  # 0 disables the timeout
+        with self.cnx.cursor() as cursor:
+            cursor.execute(f"SET statement_timeout = {milliseconds}")
+
+    def is_timeout_error(self, error):
+        return isinstance(error, psycopg2.extensions.QueryCanceledError)
+
+    def execute_select(self, query_text):
+        """
+        The default cursor of psycopg2 receives the whole result set, which the server computes
+        entirely. With a row limit, read instead the first page of a streaming cursor.
+        """
+        if self.row_limit is None:
+            return super().execute_select(query_text)
+        try:
+            (headers, datatypes, pages) = self.iter_select(query_text, self.row_limit)
+        except RuntimeError as e:
+            if self.is_timeout_error(e.__cause__):
+                raise QueryTimeoutError(f"Query timed out after {self.query_timeout} s: {query_text}") from e.__cause__
+            raise
+        with closing(pages):
+            rows = next(pages, [])
+        return (headers, datatypes, rows)
+
+    def cancel(self):
+        """Same as calling pg_cancel_backend() on the backend of the connection, without needing a second one."""
+        self.cnx.cancel()
+
+    def open_streaming_cursor(self):
+        """
+        The default cursor of psycopg2 transfers the whole result set at execution time. A named
+        cursor is declared on the server, which computes and sends the rows as they are fetched.
+        It must live in a transaction (WITH HOLD would materialize the whole result set when the
+        transaction commits): suspend the autocommit mode until `close_streaming_cursor()`.
+        """
+        self.cnx.autocommit = False
+        return self.cnx.cursor(name="sqlab_streaming_cursor")
+
+    def close_streaming_cursor(self, cursor):
+        """End the transaction of the cursor, keeping its side effects (if any) as in autocommit mode."""
+        try:
+            if self.cnx.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                self.cnx.rollback()  # which also closes the cursor on the server
+            else:
+                cursor.close()
+                self.cnx.commit()
+        finally:
+            self.cnx.autocommit = True
+
     def execute_non_select(self, text):
         if not text.strip():
             return None
@@ -102,6 +154,46 @@ class Database(AbstractDatabase):
     def create_database(self):
         self.execute_non_select(self.db_creation_queries)
 
+    def connect_to_maintenance_database(self):
+        cnx = psycopg2.connect(**{**self.config["cnx"], "database": "postgres"})
+        cnx.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return cnx
+
+    def create_clones(self, count):
+        """
+        Copy the database with `CREATE DATABASE ... TEMPLATE`, which is a file-level copy. Since
+        PostgreSQL refuses to copy a database having other connections, the current one is closed
+        during the operation.
+        """
+        db_name = self.config["cnx"]["database"]
+        clone_names = [f"{db_name}_clone_{i}" for i in range(1, count + 1)]
+        self.cnx.close()
+        cnx = self.connect_to_maintenance_database()
+        try:
+            with cnx.cursor() as cursor:
+                for clone_name in clone_names:
+                    cursor.execute(f"DROP DATABASE IF EXISTS {clone_name}")
+                    cursor.execute(f"CREATE DATABASE {clone_name} TEMPLATE {db_name}")
+        finally:
+            cnx.close()
+            self.connect()
+        clones = []
+        for clone_name in clone_names:
+            clone = Database({**self.config, "cnx": {**self.config["cnx"], "database": clone_name}})
+            clone.connect()
+            clones.append(clone)
+        return clones
+
+    def drop_clones(self, clones):
+        super().drop_clones(clones)
+        cnx = self.connect_to_maintenance_database()
+        try:
+            with cnx.cursor() as cursor:
+                for clone in clones:
+                    cursor.execute(f"DROP DATABASE IF EXISTS {clone.config['cnx']['database']}")
+        finally:
+            cnx.close()
+
     @staticmethod
     def to_json(value):
         s = json.dumps(value, ensure_ascii=False)
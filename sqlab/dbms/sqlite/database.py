@@ -1,5 +1,6 @@
 import re
 import sqlite3
+import time
 from pathlib import Path
 import json
 
@@ -8,20 +9,44 @@ from ...text_tools import FAIL, OK, RESET, WARNING
 
 class Database(AbstractDatabase):
 
+    explain_prefix = "EXPLAIN QUERY PLAN "  # EXPLAIN alone lists the bytecode of the virtual machine
+
     def connect(self):
         self.dbms_version = sqlite3.sqlite_version
-        self.cnx = sqlite3.connect(":memory:")
+        self.cnx = sqlite3.connect(":memory:", check_same_thread=False)  # the shell queries it from a worker thread
         print(f"{OK}Connected to SQLite {self.dbms_version} with in-memory database.{RESET}")
         if "database" in self.config["cnx"]:
-            self.cnx.enable_load_extension(True)
             print(f"Loading SQLite extensions...")
-            for path in self.config["extensions"]:
-                path = str(Path(path).expanduser().resolve())
-                self.cnx.load_extension(path)
-                print(f"  {path}")
+            self.load_extensions(verbose=True)
             script = self.config["sql_dump_path"].read_text(encoding="utf8")
             self.cnx.executescript(script)
 
+    def load_extensions(self, verbose=False):
+        self.cnx.enable_load_extension(True)
+        for path in self.config["extensions"]:
+            path = str(Path(path).expanduser().resolve())
+            self.cnx.load_extension(path)
+            if verbose:
+                print(f"  {path}")
+
+    def create_clones(self, count):
+        """
+        Copy the in-memory database with the backup API. The extensions are loaded afterwards, so
+        that sqlean-define registers the functions stored in the copied table `sqlean_define`.
+        The clones are to be used in other threads than the current one, but by only one at a time.
+        """
+        foreign_keys = self.cnx.execute("PRAGMA foreign_keys").fetchone()[0]
+        clones = []
+        for _ in range(count):
+            clone = Database(self.config)
+            clone.dbms_version = self.dbms_version
+            clone.cnx = sqlite3.connect(":memory:", check_same_thread=False)
+            self.cnx.backup(clone.cnx)
+            clone.load_extensions()
+            clone.cnx.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+            clones.append(clone)
+        return clones
+
     def get_headers(self, table: str, keep_auto_increment_columns=True) -> list[str]:
         # Get table info
         cursor = self.cnx.cursor()
@@ -66,6 +91,26 @@ class Database(AbstractDatabase):
         query = f"SELECT replace(cast(brotli_decode(decode({repr(encrypted[65:-1])}, 'hex')) as text), '\\\n', x'0A')"
         return self.execute_select(query)[2][0][0]
     
+    def is_timeout_error(self, error):
+        return isinstance(error, sqlite3.OperationalError) and str(error) == "interrupted"
+
+    def cancel(self):
+        self.cnx.interrupt()
+
+    def execute_select(self, query_text):
+        """
+        SQLite has no statement timeout: a progress handler, called every few thousands of virtual
+        machine instructions, interrupts the query when its deadline is exceeded.
+        """
+        if not self.query_timeout:
+            return super().execute_select(query_text)
+        deadline = time.monotonic() + self.query_timeout
+        self.cnx.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            return super().execute_select(query_text)
+        finally:
+            self.cnx.set_progress_handler(None, 0)
+
     def execute_non_select(self, text):
         if not text.strip():
             return None
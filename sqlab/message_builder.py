@@ -173,256 +173,304 @@ class MessageBuilder:
                 return solution.get("columns", [])
         return []
 
-    def compile_activities(self, records):
-        activities = {}
+    def compile_documents(self, records: dict, with_activities: bool = False) -> dict:
+        """
+        Compile in a single pass over the records the documents accompanying the database: the
+        exercises, the storyline, the cheat sheet, the check list and, for the web, the activities
+        and their TOCs. Return a dictionary mapping each document name on its content (None for an
+        empty document). A record accessed by several tokens is recognized by its ID.
+        """
+        documents = {
+            "exercises": ExercisesDocument(self.strings),
+            "storyline": StorylineDocument(self.strings),
+            "cheat_sheet": CheatSheetDocument(self.strings),
+            "check_list": CheckListDocument(self.strings),
+        }
+        if with_activities:
+            documents["activities"] = ActivitiesDocument(self.strings)
+        seen_record_ids = set()
         for (token, record) in records.items():
-            if isinstance(record, str):
-                continue
-            if record["kind"] in ("exercise", "episode"):
-                activity_number = record["activity_number"]
-                activity = activities.get(activity_number, {})
-                if not activity:
-                    activities[activity_number] = {
-                        "kind": "exercises" if record["kind"] == "exercise" else "adventure",
-                        "label": self.strings[f"{record['kind']}_collection_label"],
-                        "activity_number": activity_number,
-                        "title": record["section_path"][0][0],
-                        "activity_pitch": record["section_path"][0][1],
-                        "tasks": [],
-                        "task_count": 0,
-                        "hint_count": 0,
-                    }
-                if activities[activity_number]["task_count"] == record["task_number"]:
-                    continue # Already added: occurs when one variant produces a different token than the first query
-                activities[activity_number]["task_count"] = record["task_number"]
-                activities[activity_number]["tasks"].append({
-                    "access": (record["kind"] == "exercise" or record["task_number"] == 1) and token,
-                    "reward": record["reward"],
-                    "number": record["task_number"],
-                    "salt": record["salt"],
-                    "task_title": record["section_path"][-1][0],
-                    "columns": self.extract_column_names_from_first_solution(record["solutions"])
-                })
-                if intro := record["section_path"][-1][1]:
-                    activities[activity_number]["tasks"][-1]["task_intro"] = intro
-                if formula := record.get("formula"):  # This is not the last episode of an adventure
-                    activities[activity_number]["tasks"][-1]["formula"] = formula
-                if tweak_javascript := record.get("tweak_javascript"):
-                    activities[activity_number]["tasks"][-1]["tweak_javascript"] = tweak_javascript
-            elif record["kind"] == "hint":
-                activities[activity_number]["hint_count"] += 1
-        tocs = self.compile_tocs(records)
-        for (activity_number, toc) in zip(activities, tocs.values()):
-            activities[activity_number]["toc"] = json.dumps(toc, ensure_ascii=False)
-        return activities
-
-    def compile_tocs(self, records):
-        result = {}
-        current_activity = None
-        current_section = None
-        current_task_title = None
-        current_section_data = None
-        current_task_group = None
-        
-        for record in records.values():
-            if isinstance(record, str) or record["kind"] not in ("exercise", "episode"):
+            if isinstance(record, str): # an alias
                 continue
+            if "record_id" in record:
+                record_id = record["record_id"]
+            else: # records.json produced by a previous version
+                record_id = json.dumps(record, sort_keys=True, ensure_ascii=False)
+            first_occurrence = record_id not in seen_record_ids
+            seen_record_ids.add(record_id)
+            for document in documents.values():
+                document.feed(token, record, first_occurrence)
+        return {name: document.result() for (name, document) in documents.items()}
 
-            # Uncomment the following line to skip all but the first task of each episode
-            if record["kind"] == "episode" and record["task_number"] > 1:
-                continue
 
-            activity_number = record["activity_number"]
-            task_number = record["task_number"]
-            (section_title, section_intro) = record["section_path"][1]
-            (task_title, task_intro) = ("", None)
-            if len(record["section_path"]) > 2:
-                (task_title, task_intro) = record["section_path"][2]
-                task_title = task_title.split(" (")[0]
-            
-            # Start a new activity if needed
-            if current_activity != activity_number:
-                # Finalize previous section for previous activity
-                if current_activity is not None and current_section_data is not None:
-                    result[current_activity].append(current_section_data)
-                
-                current_activity = activity_number
-                if activity_number not in result:
-                    result[activity_number] = []
-                current_section = None
-                current_section_data = None
-            
-            # Start a new section if needed
-            if current_section != section_title:
-                # Finalize previous section
-                if current_section_data is not None:
-                    result[current_activity].append(current_section_data)
-                
-                # Start new section
-                current_section = section_title
-                current_section_data = {
-                    "title": section_title,
-                    "intro": section_intro or "",
-                    "taskGroups": []
-                }
-                current_task_title = None
-                current_task_group = None
-            
-            # Start a new task group if needed
-            if current_task_title != task_title:
-                current_task_title = task_title
-                group_title = task_title or self.strings["tasks_label"]
-                current_task_group = {
-                    "groupTitle": group_title,
-                    "tasks": []
-                }
-                current_section_data["taskGroups"].append(current_task_group)
-            
-            # Add task number to current group
-            current_task_group["tasks"].append(task_number)
-        
-        # Finalize the last section
-        if current_activity is not None and current_section_data is not None:
-            result[current_activity].append(current_section_data)
-        
-        return result
+class Document:
+    """A document compiled incrementally by a sequence of calls to `feed()`, then `result()`."""
 
-    def compile_check_list(self, records):
-        """
-        For every query (including variants), returns a dictionary with the following keys:
-        - `id`: a concatenation of the activity number, task number, and a counter starting at 0;
-        - `query`: the raw SQL query to execute, deprived from any reference to a hash value;
-        - `formula`: the formula to inject in the query;
-        - `columns`: the expected column names;
-        - `tweak`: the JavaScript tweak to apply to the query, if any;
-        - `ok`: a boolean indicating whether the query is a solution or a hint;
-        - `token`: the expected token.
-        """
-        result = []
-        sub_spaces = re.compile(r"\s+").sub
-        sub_hashes = re.compile(r"(?mi)^ +, .*\b(hash|as token)\b.*\n?").sub
-        id_prefix = "UNDEFINED-UNDEFINED-"
-        counter = "UNDEFINED"
-        for (token, record) in records.items():
-            if isinstance(record, str):
-                continue
-            if record["kind"] in ("episode", "exercise"):
-                if not (formula := record.get("formula")):
-                    break  # The epilogue of an adventure has no formula
-                id_prefix = f"{record['activity_number']}-{record['task_number']}-"
-                counter = 0
-                formula = formula.replace("{{x}}", "(0)")
-                tweak = record.get("tweak_javascript")
-                for solution in record["solutions"]:
-                    if isinstance(solution, str):
-                        continue
-                    query = sub_hashes("", solution["query"])
-                    query = sub_spaces(" ", query).replace(" ,", ",")
-                    columns = solution["columns"]
-                    result.append({
-                        "id": f"{id_prefix}{counter}",
-                        "query": query,
-                        "formula": formula,
-                        "columns": columns,
-                        "tweak": tweak,
-                        "kind": "solution",
-                        "token": solution["token"]
-                    })
-                    counter += 1
-            elif record["kind"] == "hint":
-                query = sub_hashes("", record["query"])
-                query = sub_spaces(" ", query).replace(" ,", ",")
-                result.append({
-                    "id": f"{id_prefix}{counter}",
-                    "query": query,
-                    "formula": formula,
-                    "columns": columns,
-                    "tweak": tweak,
-                    "kind": "hint",
-                    "token": token
-                })
-                counter += 1
-        text = json.dumps(result, ensure_ascii=False, indent=2)
-        return text.replace("\n      ", " ").replace("\n    ]", " ]")
+    def __init__(self, strings):
+        self.strings = strings
+        self.lines = []
 
-    def compile_storyline(self, records):
-        result = []
-        previous_records_hashes = set() # Cf. compile_cheat_sheet
-        for (token, record) in records.items():
-            if isinstance(record, str) or record["kind"] != "episode":
-                continue
-            record_hash = hash(json.dumps(record, sort_keys=True, ensure_ascii=False))
-            if record_hash in previous_records_hashes:
-                continue
-            previous_records_hashes.add(record_hash)
-            result.append(f"\n{record['context']}\n")
-            if solutions := record["solutions"]:
-                result.append(f"<details><summary>{self.strings['statement_label']}</summary>{record['statement']}<br><br>")
-                for solution in self.actual_solutions(solutions):
-                    if result_head := solution.get("result_head"):
-                        result.append(f"\n{result_head}\n")
-                        break
-                result.append("</details><br>\n")
-        if result:
-            result.append("")
-            return "\n".join(result)
-
-    def compile_exercises(self, records):
-        result = []
-        for (token, record) in records.items():
-            if isinstance(record, str) or record["kind"] != "exercise":
-                continue
-            if section := record.get("section"):
-                result.append(f"\n{section}\n")
-            statement_start = record["statement"].split("\n")[0]
-            i = record["task_number"]
-            result.append(f"- **{self.strings['exercise_label']} {i}**. {statement_start}  ")
-            first_token = self.get_first_token_from_solutions(record["solutions"])
-            result.append("  " + self.strings["exercise_tokens"].format(salt=record["salt"], token=first_token))
-        if result:
-            result.append("")
-            return "\n".join(result)
-    
-    def compile_cheat_sheet(self, records):
-        result = []
-        previous_records_hashes = set() # When a variant produces a different token than the first
-                                        # query, the next episode needs to be accessed through the
-                                        # two tokens. In records.json, the episode dictionary is
-                                        # duplicated and associated with these two tokens. In
-                                        # cheat_sheet.md, this duplication is avoided.
-        for (token, record) in records.items():
-            if isinstance(record, str):
-                continue
-            if record["kind"] in ("hint", "db_metadata"):
-                continue
-            record_hash = hash(json.dumps(record, sort_keys=True, ensure_ascii=False))
-            if record_hash in previous_records_hashes:
-                continue
-            previous_records_hashes.add(record_hash)
-            counter = record["task_number"]
-            if counter == 1:
-                if record["kind"] == "episode":
-                    result.append(f"## {self.strings['adventure_label']}\n")
-                    label = self.strings['episode_label']
-                else:
-                    result.append(f"## {self.strings['exercises_label']}\n")
-                    label = self.strings['exercise_label']
-            result.append(f"### {label} {counter}\n")
-            result.append(f"**Token.** {token}.\n")
-            result.append(record['statement'].replace("\\n", "\n"))
-            if record.get("formula"):
-                if tweak := record.get("tweak", ""):
-                    tweak = f" ({self.strings['tweak_instruction'].format(repl=tweak)})"
-                formula = record["formula"].replace("{{x}}", "(0)")
-                result.append(f"\n**{self.strings['formula_label']}**{tweak}. `{formula}`\n")
+    def feed(self, token: str, record: dict, first_occurrence: bool):
+        raise NotImplementedError
+
+    def result(self):
+        if self.lines:
+            self.lines.append("")
+            return "\n".join(self.lines)
+
+
+class ExercisesDocument(Document):
+
+    def feed(self, token, record, first_occurrence):
+        if record["kind"] != "exercise":
+            return
+        if section := record.get("section"):
+            self.lines.append(f"\n{section}\n")
+        statement_start = record["statement"].split("\n")[0]
+        i = record["task_number"]
+        self.lines.append(f"- **{self.strings['exercise_label']} {i}**. {statement_start}  ")
+        first_token = MessageBuilder.get_first_token_from_solutions(record["solutions"])
+        self.lines.append("  " + self.strings["exercise_tokens"].format(salt=record["salt"], token=first_token))
+
+
+class StorylineDocument(Document):
+
+    def feed(self, token, record, first_occurrence):
+        if record["kind"] != "episode" or not first_occurrence: # Cf. CheatSheetDocument
+            return
+        self.lines.append(f"\n{record['context']}\n")
+        if solutions := record["solutions"]:
+            self.lines.append(f"<details><summary>{self.strings['statement_label']}</summary>{record['statement']}<br><br>")
+            for solution in MessageBuilder.actual_solutions(solutions):
+                if result_head := solution.get("result_head"):
+                    self.lines.append(f"\n{result_head}\n")
+                    break
+            self.lines.append("</details><br>\n")
+
+
+class CheatSheetDocument(Document):
+
+    def __init__(self, strings):
+        super().__init__(strings)
+        self.label = None
+
+    def feed(self, token, record, first_occurrence):
+        if record["kind"] in ("hint", "db_metadata"):
+            return
+        if not first_occurrence: # When a variant produces a different token than the first query,
+            return               # the next episode needs to be accessed through the two tokens. In
+                                 # records.json, the episode is associated with these two tokens.
+                                 # In cheat_sheet.md, this duplication is avoided.
+        counter = record["task_number"]
+        if counter == 1:
+            if record["kind"] == "episode":
+                self.lines.append(f"## {self.strings['adventure_label']}\n")
+                self.label = self.strings['episode_label']
+            else:
+                self.lines.append(f"## {self.strings['exercises_label']}\n")
+                self.label = self.strings['exercise_label']
+        self.lines.append(f"### {self.label} {counter}\n")
+        self.lines.append(f"**Token.** {token}.\n")
+        self.lines.append(record['statement'].replace("\\n", "\n"))
+        if record.get("formula"):
+            if tweak := record.get("tweak", ""):
+                tweak = f" ({self.strings['tweak_instruction'].format(repl=tweak)})"
+            formula = record["formula"].replace("{{x}}", "(0)")
+            self.lines.append(f"\n**{self.strings['formula_label']}**{tweak}. `{formula}`\n")
+        for solution in record["solutions"]:
+            if isinstance(solution, str):
+                self.lines.append(f"{solution}\n")
+            else:
+                if intro := solution.get("intro"):
+                    self.lines.append(f"{intro}\n")
+                self.lines.append(f"```sql\n{solution['query']}\n```\n")
+
+    def result(self):
+        if self.lines:
+            self.lines.insert(0, f"# Cheat sheet\n")
+        return super().result()
+
+
+class CheckListDocument(Document):
+    """
+    For every query (including variants), a dictionary with the following keys:
+    - `id`: a concatenation of the activity number, task number, and a counter starting at 0;
+    - `query`: the raw SQL query to execute, deprived from any reference to a hash value;
+    - `formula`: the formula to inject in the query;
+    - `columns`: the expected column names;
+    - `tweak`: the JavaScript tweak to apply to the query, if any;
+    - `ok`: a boolean indicating whether the query is a solution or a hint;
+    - `token`: the expected token.
+    """
+
+    sub_spaces = re.compile(r"\s+").sub
+    sub_hashes = re.compile(r"(?mi)^ +, .*\b(hash|as token)\b.*\n?").sub
+
+    def __init__(self, strings):
+        super().__init__(strings)
+        self.entries = []
+        self.id_prefix = "UNDEFINED-UNDEFINED-"
+        self.counter = "UNDEFINED"
+        (self.formula, self.columns, self.tweak) = (None, None, None)
+        self.closed = False
+
+    def feed(self, token, record, first_occurrence):
+        if self.closed:
+            return
+        if record["kind"] in ("episode", "exercise"):
+            if not (formula := record.get("formula")):
+                self.closed = True  # The epilogue of an adventure has no formula
+                return
+            self.id_prefix = f"{record['activity_number']}-{record['task_number']}-"
+            self.counter = 0
+            self.formula = formula.replace("{{x}}", "(0)")
+            self.tweak = record.get("tweak_javascript")
             for solution in record["solutions"]:
                 if isinstance(solution, str):
-                    result.append(f"{solution}\n")
-                else:
-                    if intro := solution.get("intro"):
-                        result.append(f"{intro}\n")
-                    result.append(f"```sql\n{solution['query']}\n```\n")
-        if result:
-            result.insert(0, f"# Cheat sheet\n")
-            result.append("")
-            return "\n".join(result)
+                    continue
+                self.columns = solution["columns"]
+                self.append(solution["query"], "solution", solution["token"])
+        elif record["kind"] == "hint":
+            self.append(record["query"], "hint", token)
+
+    def append(self, query, kind, token):
+        query = self.sub_hashes("", query)
+        query = self.sub_spaces(" ", query).replace(" ,", ",")
+        self.entries.append({
+            "id": f"{self.id_prefix}{self.counter}",
+            "query": query,
+            "formula": self.formula,
+            "columns": self.columns,
+            "tweak": self.tweak,
+            "kind": kind,
+            "token": token
+        })
+        self.counter += 1
+
+    def result(self):
+        text = json.dumps(self.entries, ensure_ascii=False, indent=2)
+        return text.replace("\n      ", " ").replace("\n    ]", " ]")
+
+
+class TocsDocument(Document):
+    """The table of contents of each activity, i.e. its sections, their groups of tasks, and the numbers of these tasks."""
+
+    def __init__(self, strings):
+        super().__init__(strings)
+        self.tocs = {}
+        self.current_activity = None
+        self.current_section = None
+        self.current_task_title = None
+        self.current_section_data = None
+        self.current_task_group = None
+
+    def feed(self, token, record, first_occurrence):
+        if record["kind"] not in ("exercise", "episode"):
+            return
+
+        # Uncomment the following line to skip all but the first task of each episode
+        if record["kind"] == "episode" and record["task_number"] > 1:
+            return
+
+        activity_number = record["activity_number"]
+        task_number = record["task_number"]
+        (section_title, section_intro) = record["section_path"][1]
+        (task_title, task_intro) = ("", None)
+        if len(record["section_path"]) > 2:
+            (task_title, task_intro) = record["section_path"][2]
+            task_title = task_title.split(" (")[0]
+
+        # Start a new activity if needed
+        if self.current_activity != activity_number:
+            # Finalize previous section for previous activity
+            if self.current_activity is not None and self.current_section_data is not None:
+                self.tocs[self.current_activity].append(self.current_section_data)
+            self.current_activity = activity_number
+            if activity_number not in self.tocs:
+                self.tocs[activity_number] = []
+            self.current_section = None
+            self.current_section_data = None
+
+        # Start a new section if needed
+        if self.current_section != section_title:
+            # Finalize previous section
+            if self.current_section_data is not None:
+                self.tocs[self.current_activity].append(self.current_section_data)
+            # Start new section
+            self.current_section = section_title
+            self.current_section_data = {
+                "title": section_title,
+                "intro": section_intro or "",
+                "taskGroups": []
+            }
+            self.current_task_title = None
+            self.current_task_group = None
+
+        # Start a new task group if needed
+        if self.current_task_title != task_title:
+            self.current_task_title = task_title
+            group_title = task_title or self.strings["tasks_label"]
+            self.current_task_group = {
+                "groupTitle": group_title,
+                "tasks": []
+            }
+            self.current_section_data["taskGroups"].append(self.current_task_group)
+
+        # Add task number to current group
+        self.current_task_group["tasks"].append(task_number)
+
+    def result(self):
+        # Finalize the last section
+        if self.current_activity is not None and self.current_section_data is not None:
+            self.tocs[self.current_activity].append(self.current_section_data)
+        return self.tocs
+
+
+class ActivitiesDocument(Document):
+
+    def __init__(self, strings):
+        super().__init__(strings)
+        self.activities = {}
+        self.tocs = TocsDocument(strings)
+
+    def feed(self, token, record, first_occurrence):
+        self.tocs.feed(token, record, first_occurrence)
+        activities = self.activities
+        if record["kind"] in ("exercise", "episode"):
+            activity_number = self.activity_number = record["activity_number"]
+            activity = activities.get(activity_number, {})
+            if not activity:
+                activities[activity_number] = {
+                    "kind": "exercises" if record["kind"] == "exercise" else "adventure",
+                    "label": self.strings[f"{record['kind']}_collection_label"],
+                    "activity_number": activity_number,
+                    "title": record["section_path"][0][0],
+                    "activity_pitch": record["section_path"][0][1],
+                    "tasks": [],
+                    "task_count": 0,
+                    "hint_count": 0,
+                }
+            if activities[activity_number]["task_count"] == record["task_number"]:
+                return # Already added: occurs when one variant produces a different token than the first query
+            activities[activity_number]["task_count"] = record["task_number"]
+            activities[activity_number]["tasks"].append({
+                "access": (record["kind"] == "exercise" or record["task_number"] == 1) and token,
+                "reward": record["reward"],
+                "number": record["task_number"],
+                "salt": record["salt"],
+                "task_title": record["section_path"][-1][0],
+                "columns": MessageBuilder.extract_column_names_from_first_solution(record["solutions"])
+            })
+            if intro := record["section_path"][-1][1]:
+                activities[activity_number]["tasks"][-1]["task_intro"] = intro
+            if formula := record.get("formula"):  # This is not the last episode of an adventure
+                activities[activity_number]["tasks"][-1]["formula"] = formula
+            if tweak_javascript := record.get("tweak_javascript"):
+                activities[activity_number]["tasks"][-1]["tweak_javascript"] = tweak_javascript
+        elif record["kind"] == "hint":
+            activities[self.activity_number]["hint_count"] += 1
+
+    def result(self):
+        for (activity_number, toc) in zip(self.activities, self.tocs.result().values()):
+            self.activities[activity_number]["toc"] = json.dumps(toc, ensure_ascii=False)
+        return self.activities
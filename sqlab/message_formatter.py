@@ -1,12 +1,27 @@
-from copy import deepcopy
+from collections import ChainMap, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
 import json
-from .text_tools import TextWrapper, markdown_to_html, improved_text
+import multiprocessing
+import os
+import queue
+import threading
+from .cache import digest
+from .config import reload_config
+from .text_tools import TextWrapper, markdown_to_html, improved_text, commit_fragment_caches, open_fragment_caches
 from html import escape
 import re
 from textwrap import dedent
 
+PARALLEL_FORMATTING_THRESHOLD = 500  # below this number of messages, a process pool is not worth it
+MAX_CHUNK_SIZE = 200  # number of messages sent at once to a worker process
+
+# The formatter of a worker process, created by `init_worker()`.
+worker_format_message = None
+
 def create_message_formatter(config: dict) -> callable:
 
+    open_fragment_caches(config)  # the same paragraphs, solutions, etc. recur in many messages and builds
     strings = config["strings"]
     sub_mark = re.compile(r"(?s)<mark>(.*?)</mark>").sub
 
@@ -41,24 +56,26 @@ def create_message_formatter(config: dict) -> callable:
             text = sub_paragraph_heading(r"<p class='paragraph'><span class='subtitle'>\1</span>", text)
             return text
 
-        def format_solutions(data):
-            if data.get("solutions"):
-                acc = ["<div class='solutions'>"]
-                for x in data["solutions"]:
-                    if "solution" in x:
-                        acc.append("<div class='solution'>")
-                        if intro := x["solution"].get("intro"):
-                            acc.append(f"<div class='intro'>{format_text(intro)}</div>")
-                        acc.append(format_text(f"```sql\n{x['solution']['query']}\n```"))
-                        acc.append("</div>")
-                    elif "annotation" in x:
-                        acc.append(f"<div class='annotation'>{format_text(x['annotation'])}</div>")
-                acc.append("</div>")
-                data["solutions"] = "\n".join(acc)
+        def format_solutions(solutions: list) -> str:
+            acc = ["<div class='solutions'>"]
+            for x in solutions:
+                if "solution" in x:
+                    acc.append("<div class='solution'>")
+                    if intro := x["solution"].get("intro"):
+                        acc.append(f"<div class='intro'>{format_text(intro)}</div>")
+                    acc.append(format_text(f"```sql\n{x['solution']['query']}\n```"))
+                    acc.append("</div>")
+                elif "annotation" in x:
+                    acc.append(f"<div class='annotation'>{format_text(x['annotation'])}</div>")
+            acc.append("</div>")
+            return "\n".join(acc)
 
         def to_web(kind, data):
-            data = deepcopy(data)
-            format_solutions(data)
+            # Don't modify the data, which may be shared with other messages: override some of its fields.
+            overrides = {}
+            if data.get("solutions"):
+                overrides["solutions"] = format_solutions(data["solutions"])
+            data = ChainMap(overrides, data)
             task_data = {}
             if kind == "hint":
                 task_data["category"] = "specific-hint"
@@ -118,31 +135,31 @@ def create_message_formatter(config: dict) -> callable:
 
         preamble_accepted = strings["preamble_accepted"]
         
-        def format_formula(data):
-            if data.get("formula"):
-                if data["formula"]["tweak"]:
-                    data["formula"]["tweak"] = f" ({data['formula']['tweak']})"
-                data["formula"] = "**{label}**{tweak}.\n-- , {code}".format_map(data["formula"])
-        
-        def format_solutions(data):
-            if data.get("solutions"):
-                acc = [hr]
-                for x in data["solutions"]:
-                    if "solution" in x:
-                        if intro := x["solution"].get("intro"):
-                            acc.append(intro)
-                        acc.append(x["solution"]["query"])
-                    else:
-                        acc.append(x["annotation"])
-                acc.append(hr)
-                data["solutions"] = "\n\n".join(acc)
+        def format_formula(formula: dict) -> str:
+            tweak = f" ({formula['tweak']})" if formula["tweak"] else formula["tweak"]
+            return "**{label}**{tweak}.\n-- , {code}".format_map({**formula, "tweak": tweak})
+
+        def format_solutions(solutions: list) -> str:
+            acc = [hr]
+            for x in solutions:
+                if "solution" in x:
+                    if intro := x["solution"].get("intro"):
+                        acc.append(intro)
+                    acc.append(x["solution"]["query"])
+                else:
+                    acc.append(x["annotation"])
+            acc.append(hr)
+            return "\n\n".join(acc)
 
         def to_txt(kind, data):
-            data = deepcopy(data)
-            format_formula(data)
-            format_solutions(data)
+            # Don't modify the data, which may be shared with other messages: override some of its fields.
+            overrides = {}
+            if data.get("formula"):
+                overrides["formula"] = format_formula(data["formula"])
             if data.get("solutions"):
-                data["preamble"] = preamble_accepted.format(token=data.get("token"))
+                overrides["solutions"] = format_solutions(data["solutions"])
+                overrides["preamble"] = preamble_accepted.format(token=data.get("token"))
+            data = ChainMap(overrides, data)
             if kind == "hint":
                 template = "🟠 **{label} {task_number}**. {preamble}\n\n➥ {text}"
             elif kind == "exercise_task":
@@ -176,3 +193,96 @@ def create_message_formatter(config: dict) -> callable:
         return create_txt_formatter()
     else:
         raise ValueError(f"Unknown output format: {output_format}")
+
+
+def init_worker(cli_args: dict):
+    """Rebuild the formatter in a worker process: the configuration cannot be pickled."""
+    global worker_format_message
+    worker_format_message = create_message_formatter(reload_config(cli_args))
+
+
+def format_in_worker(messages: list) -> list:
+    formatted = [worker_format_message(message) for message in messages]
+    commit_fragment_caches()
+    return formatted
+
+
+def format_messages(config: dict, messages: dict) -> dict:
+    """Return a dictionary token -> formatted message, in the same order as the given messages."""
+    return dict(iter_formatted_messages(config, messages))
+
+
+def iter_formatted_messages(config: dict, messages: dict) -> Iterator[tuple[str, str]]:
+    """
+    Format lazily the given messages (token -> (kind, data)), in a process pool if they are
+    numerous enough and the configuration can be rebuilt from its command-line arguments. Yield
+    the couples (token, formatted message) in the same order as the given messages.
+
+    Many tokens share the same message (e.g., the correction of all the variants of an exercise):
+    each distinct message, recognized by identity or else by content, is formatted only once, and
+    kept only until its last token is yielded.
+    """
+    (distinct_messages, keys_by_id, token_keys) = ({}, {}, {})
+    for (token, message) in messages.items():
+        if (key := keys_by_id.get(id(message))) is None:
+            key = keys_by_id[id(message)] = digest(message)
+        distinct_messages.setdefault(key, message)
+        token_keys[token] = key
+    last_tokens = {key: token for (token, key) in token_keys.items()}
+    texts = iter_formatted_distinct_messages(config, list(distinct_messages.values()))
+    keys = iter(distinct_messages)  # in the same order as the texts
+    formatted = {}
+    for (token, key) in token_keys.items():
+        while key not in formatted:
+            formatted[next(keys)] = next(texts)
+        yield (token, formatted[key])
+        if last_tokens[key] == token:
+            del formatted[key]
+
+
+def iter_formatted_distinct_messages(config: dict, messages: list) -> Iterator[str]:
+    jobs = config.get("formatting_jobs") or os.cpu_count() or 1
+    if jobs == 1 or len(messages) < PARALLEL_FORMATTING_THRESHOLD or "cli_args" not in config:
+        format_message = create_message_formatter(config)
+        for message in messages:
+            yield format_message(message)
+        commit_fragment_caches()
+        return
+    chunk_size = max(1, min(len(messages) // (4 * jobs), MAX_CHUNK_SIZE))
+    # The workers are spawned rather than forked, since the caller may be a background thread of a
+    # process holding SQLite connections (cf. `iter_in_background()`).
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, initializer=init_worker, initargs=(config["cli_args"],)) as executor:
+        pending = deque()  # a bounded number of chunks is submitted ahead of the consumer
+        for i in range(0, len(messages), chunk_size):
+            pending.append(executor.submit(format_in_worker, messages[i:i + chunk_size]))
+            if len(pending) > 2 * jobs:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_in_background(iterable: Iterable, max_ahead: int) -> Iterator:
+    """
+    Consume the given iterable in a background thread, at most `max_ahead` items ahead of the
+    caller. This allows, e.g., to format the next messages while the previous ones are encrypted
+    and inserted by the database (which releases the GIL).
+    """
+    items = queue.Queue(maxsize=max_ahead)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((True, item))
+            items.put((False, None))
+        except BaseException as e:
+            items.put((False, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        (has_item, item) = items.get()
+        if not has_item:
+            if item is not None:
+                raise item
+            return
+        yield item
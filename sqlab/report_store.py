@@ -0,0 +1,217 @@
+"""
+Embedded analytical store for the students' logs, backed by an SQLite file.
+
+The parsed log events are loaded into indexed tables, and `report.json` is produced by aggregate
+queries. The file is kept after the report, so that ad-hoc questions can later be answered without
+re-parsing the logs, e.g.:
+
+    sqlite3 output/report.sqlite "SELECT day, count(*) FROM event GROUP BY day"
+"""
+
+import sqlite3
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE task (
+    token TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    query TEXT,
+    formula TEXT
+);
+CREATE TABLE event (
+    token TEXT NOT NULL,
+    day TEXT NOT NULL,
+    action TEXT NOT NULL CHECK (action IN ('decrypted', 'produced')),
+    n INTEGER NOT NULL DEFAULT 1 -- greater than 1 for the events loaded from a partial aggregate
+);
+CREATE INDEX event_token ON event (token, action, day);
+CREATE INDEX event_day ON event (day, token);
+CREATE TABLE error (
+    category TEXT NOT NULL,
+    message TEXT,
+    n INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX error_category ON error (category, message);
+"""
+
+SPIKE_RATIO = 2.0  # minimal ratio between the events of a token on a day and its daily average
+
+
+class ReportStore:
+
+    def __init__(self, path: Path):
+        path.unlink(missing_ok=True)  # The store is rebuilt from scratch on each report.
+        self.path = path
+        self.cnx = sqlite3.connect(path)
+        self.cnx.executescript(SCHEMA)
+
+    def add_task(self, token: str, kind: str, query: str = None, formula: str = None):
+        """Register a token. The first registration wins."""
+        self.cnx.execute("INSERT OR IGNORE INTO task VALUES (?, ?, ?, ?)", (token, kind, query, formula))
+
+    def add_event(self, token: str, day: str, action: str):
+        """Record that the given token has been either "produced" or "decrypted" on the given day."""
+        self.cnx.execute("INSERT INTO event (token, day, action) VALUES (?, ?, ?)", (token, day, action))
+
+    def add_error(self, category: str, message: str = None):
+        """Record a failed replay. Categories: "sql", "timeout", "no_token", "empty_result"."""
+        self.cnx.execute("INSERT INTO error (category, message) VALUES (?, ?)", (category, message))
+
+    def compile_report(self) -> dict:
+        """Aggregate the events into the dictionary dumped as `report.json`."""
+        report = {}
+        query = "SELECT token, kind, query, formula FROM task ORDER BY rowid"
+        for (token, kind, task_query, formula) in self.cnx.execute(query):
+            report[token] = {"kind": kind}
+            if task_query is not None:
+                report[token]["query"] = task_query
+            if formula is not None:
+                report[token]["formula"] = formula
+            report[token].update({"hits": 0, "produced_at": {}, "decrypted_at": {}})
+        query = """
+            SELECT token, action, day, sum(n)
+            FROM event
+            GROUP BY token, action, day
+            ORDER BY token, action, day
+        """
+        for (token, action, day, n) in self.cnx.execute(query):
+            report[token][f"{action}_at"][day] = n
+            report[token]["hits"] += n
+        query = """
+            SELECT task.token || ' (' || task.kind || ')', coalesce(sum(event.n), 0) AS hits
+            FROM task LEFT JOIN event USING (token)
+            GROUP BY task.token
+            ORDER BY hits DESC, min(task.rowid)
+        """
+        report["hits"] = dict(self.cnx.execute(query))
+        query = """
+            SELECT message, sum(n)
+            FROM error
+            WHERE category = ?
+            GROUP BY message
+            ORDER BY sum(n) DESC, message
+        """
+        report["sql_errors"] = dict(self.cnx.execute(query, ("sql",)))
+        report["timeout_errors"] = dict(self.cnx.execute(query, ("timeout",)))  # query -> count
+        for category in ("no_token", "empty_result"):
+            query = "SELECT coalesce(sum(n), 0) FROM error WHERE category = ?"
+            report[f"{category}_errors"] = self.cnx.execute(query, (category,)).fetchone()[0]
+        report["spikes"] = {}  # day -> {"token (kind)": count}
+        for (day, token, kind, n, _) in self.tokens_spiking_on():
+            report["spikes"].setdefault(day, {})[f"{token} ({kind})"] = n
+        return report
+
+    def resolve_unknown_tokens(self) -> list[tuple[str, str]]:
+        """
+        Register as "unknown" the decrypted tokens missing from the token table, as a single log
+        analysis does. Return the (token, query) couples of those which have been produced too,
+        by the query registered with them. This is used after merging the partial aggregates of
+        the shards, since a token may be produced in one shard and decrypted in another.
+        """
+        decrypted = "SELECT token FROM event WHERE action = 'decrypted'"
+        query = f"SELECT token, query FROM task WHERE kind = 'TODO' AND token IN ({decrypted}) ORDER BY rowid"
+        result = self.cnx.execute(query).fetchall()
+        self.cnx.execute(f"UPDATE task SET kind = 'unknown', query = NULL WHERE kind = 'TODO' AND token IN ({decrypted})")
+        self.cnx.execute(f"""
+            INSERT INTO task (token, kind)
+            SELECT token, 'unknown'
+            FROM event
+            WHERE action = 'decrypted' AND token NOT IN (SELECT token FROM task)
+            GROUP BY token
+            ORDER BY min(rowid)
+        """)
+        return result
+
+    def tokens_spiking_on(self, day: str = None, ratio: float = SPIKE_RATIO) -> list[tuple]:
+        """
+        Return the tokens whose number of events on the given day (by default, on any day) is at
+        least `ratio` times their average daily number of events, as a list of (day, token, kind,
+        count, average) sorted by day and decreasing count.
+        """
+        query = """
+            WITH daily AS (
+                SELECT token, day, sum(n) AS n
+                FROM event
+                GROUP BY token, day
+            ), average AS (
+                SELECT token, avg(n) AS mean
+                FROM daily
+                GROUP BY token
+            )
+            SELECT daily.day, token, task.kind, daily.n, average.mean
+            FROM daily
+            JOIN average USING (token)
+            LEFT JOIN task USING (token)
+            WHERE coalesce(?, daily.day) = daily.day AND daily.n >= ? * average.mean
+            ORDER BY daily.day, daily.n DESC, token
+        """
+        return self.cnx.execute(query, (day, ratio)).fetchall()
+
+    def dump_partial(self) -> dict:
+        """
+        Return the content of the store as a partial aggregate, i.e. a JSON-serializable dictionary
+        which can be merged with others by `merge_partials()`, then loaded by `load_partial()`.
+        """
+        partial = {"tasks": {}, "events": {}, "errors": {}}
+        query = "SELECT token, kind, query, formula FROM task ORDER BY rowid"
+        for (token, kind, task_query, formula) in self.cnx.execute(query):
+            partial["tasks"][token] = [kind, task_query, formula]
+        query = "SELECT token, action, day, sum(n) FROM event GROUP BY token, action, day"
+        for (token, action, day, n) in self.cnx.execute(query):
+            partial["events"].setdefault(token, {}).setdefault(action, {})[day] = n
+        query = "SELECT category, message, sum(n) FROM error GROUP BY category, message"
+        for (category, message, n) in self.cnx.execute(query):
+            partial["errors"].setdefault(category, {})[message or ""] = n  # JSON keys are strings
+        return partial
+
+    def load_partial(self, partial: dict):
+        """Add the content of the given partial aggregate to the store."""
+        for (token, (kind, query, formula)) in partial["tasks"].items():
+            self.add_task(token, kind, query, formula)
+        self.cnx.executemany(
+            "INSERT INTO event VALUES (?, ?, ?, ?)",
+            (
+                (token, day, action, n)
+                for (token, actions) in partial["events"].items()
+                for (action, days) in actions.items()
+                for (day, n) in days.items()
+            )
+        )
+        self.cnx.executemany(
+            "INSERT INTO error VALUES (?, ?, ?)",
+            (
+                (category, message or None, n)
+                for (category, messages) in partial["errors"].items()
+                for (message, n) in messages.items()
+            )
+        )
+
+    def commit(self):
+        """Make the events recorded so far visible to the other connections."""
+        self.cnx.commit()
+
+    def close(self):
+        self.cnx.commit()
+        self.cnx.close()
+
+
+def merge_partials(*partials: dict) -> dict:
+    """
+    Merge the given partial aggregates into a new one. The counts are summed and, as in the store,
+    the first registration of a token wins. The operation is associative, which allows the shards
+    to be reduced in any grouping.
+    """
+    result = {"tasks": {}, "events": {}, "errors": {}}
+    for partial in partials:
+        for (token, task) in partial["tasks"].items():
+            result["tasks"].setdefault(token, task)
+        for (token, actions) in partial["events"].items():
+            for (action, days) in actions.items():
+                counts = result["events"].setdefault(token, {}).setdefault(action, {})
+                for (day, n) in days.items():
+                    counts[day] = counts.get(day, 0) + n
+        for (category, messages) in partial["errors"].items():
+            counts = result["errors"].setdefault(category, {})
+            for (message, n) in messages.items():
+                counts[message] = counts.get(message, 0) + n
+    return result
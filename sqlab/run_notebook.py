@@ -1,19 +1,286 @@
+import html
+import queue
 import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import nbformat
 from nbconvert.preprocessors import CellExecutionError, ExecutePreprocessor
 
-from .text_tools import FAIL, OK, RESET, WARNING, SQLFormatter
+from .cache import NullCache, digest, open_cache
+from .text_tools import FAIL, OK, RESET, WARNING, SQLFormatter, separate_label_salt_and_text
 
-def run_notebook(config: dict) -> bool:
+EXECUTION_CACHE_VERSION = 1  # to be incremented when the cached outputs would differ
+DEFAULT_DISPLAY_LIMIT = 10  # same as jupysql's SqlMagic.displaylimit
+
+# Notebooks executed and written by the current process, with their modification time. This allows
+# the builds of a batch sharing the same notebook to execute it only once.
+executed_notebooks = {}
+
+def ask(question: str) -> str:
+    """Ask a question on the console. In a non-interactive build (e.g., a batch), take the default answer."""
+    try:
+        return input(question)
+    except EOFError:
+        print()
+        return ""
+
+def is_read_only_sql(
+    source: str,
+    sub_comments=re.compile(r"(?s)/\*.*?\*/|--[^\n]*").sub,
+    search_first_keyword=re.compile(r"\w+").search,
+    search_side_effect=re.compile(r"(?i)\b(insert|update|delete|merge|create|drop|alter|truncate|rename|grant|revoke|call|copy|into|set|lock|nextval|setval)\b").search,
+) -> bool:
+    """
+    Tell whether a cell is a plain `%%sql` cell without any side effect on the database or the
+    kernel, i.e., whose outputs can be reused as long as the cells before it are unchanged.
+    The test is conservative: e.g., a SELECT mentioning `update` in a string literal is rejected.
+    """
+    if not source.startswith("%%sql\n"):  # no magic arguments, like `--save` or `result <<`
+        return False
+    query = sub_comments("", source[len("%%sql\n"):])
+    first_keyword = search_first_keyword(query)
+    if not first_keyword or first_keyword[0].lower() not in ("select", "with"):
+        return False
+    return not search_side_effect(query)
+
+
+def execution_keys(cells: list, db_fingerprint: str) -> list:
+    """
+    Calculate the cache key of each cell, chained over the sources of all the previous cells, and
+    the fingerprint of the database they run on. Editing a cell thus invalidates all the next ones.
+    The cells whose outputs must not be reused get a key of None.
+    """
+    keys = []
+    key = digest(EXECUTION_CACHE_VERSION, db_fingerprint)
+    for cell in cells:
+        key = digest(key, cell.cell_type, cell.source)
+        keys.append(key if cell.cell_type == "code" and is_read_only_sql(cell.source) else None)
+    return keys
+
+
+class CachingExecutePreprocessor(ExecutePreprocessor):
+    """Execute a notebook, except for the cells whose outputs are provided in `cached_outputs`."""
+
+    def __init__(self, cached_outputs: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.cached_outputs = cached_outputs  # cell index -> list of outputs
+
+    def preprocess_cell(self, cell, resources, index):
+        if (outputs := self.cached_outputs.get(index)) is not None:
+            cell.outputs = [nbformat.from_dict(output) for output in outputs]
+            return (cell, resources)
+        return super().preprocess_cell(cell, resources, index)
+
+
+def render_html_table(headers: list[str], rows: list[tuple], display_limit: Optional[int]) -> str:
+    """Render the result of a query as jupysql does, truncated to the given number of rows."""
+    lines = ["<table>", "    <thead>", "        <tr>"]
+    lines.extend(f"            <th>{html.escape(str(header))}</th>" for header in headers)
+    lines.extend(["        </tr>", "    </thead>", "    <tbody>"])
+    for row in rows[:display_limit]:
+        lines.append("        <tr>")
+        lines.extend(f"            <td>{html.escape(str(value))}</td>" for value in row)
+        lines.append("        </tr>")
+    lines.extend(["    </tbody>", "</table>"])
+    return "\n".join(lines)
+
+
+def is_jupysql_setup(source: str) -> bool:
+    """Tell whether a code cell only loads, connects or configures jupysql, e.g. `%load_ext sql`."""
+    lines = [line for line in source.splitlines() if line.strip() and not line.startswith("#")]
+    prefixes = ("%load_ext sql", "%reload_ext sql", "%sql ", "%config SqlMagic")
+    return bool(lines) and all(line.startswith(prefixes) for line in lines)
+
+
+class DirectSqlExecutePreprocessor(CachingExecutePreprocessor):
+    """
+    Execute the `%%sql` cells through the sqlab Database object, and render their outputs in HTML as
+    jupysql would. Only the Python cells are sent to a kernel, which is not started if there are none.
+    The jupysql setup cells are skipped, except for the display limit they may configure.
+    """
+
+    def __init__(self, db, cached_outputs: dict, **kwargs):
+        super().__init__(cached_outputs, **kwargs)
+        self.db = db
+        self.display_limit = DEFAULT_DISPLAY_LIMIT
+
+    def needs_kernel(self, cell) -> bool:
+        if cell.cell_type != "code" or not cell.source.strip():
+            return False
+        if cell.source.startswith("raise EOFError") or is_jupysql_setup(cell.source):
+            return False
+        return not cell.source.startswith("%%sql\n")
+
+    def preprocess(self, nb, resources=None, km=None):
+        if any(self.needs_kernel(cell) for (index, cell) in enumerate(nb.cells) if index not in self.cached_outputs):
+            return super().preprocess(nb, resources, km)
+        self.nb = nb
+        for (index, cell) in enumerate(nb.cells):
+            self.preprocess_cell(cell, resources, index)
+        return (nb, resources)
+
+    def preprocess_cell(self, cell, resources, index):
+        if index in self.cached_outputs or self.needs_kernel(cell):
+            return super().preprocess_cell(cell, resources, index)
+        if cell.cell_type != "code":
+            return (cell, resources)
+        if cell.source.startswith("raise EOFError"):  # end of the notebook
+            raise CellExecutionError("", "EOFError", "")
+        if is_jupysql_setup(cell.source):
+            if m := re.search(r"(?m)^%config SqlMagic\.displaylimit *= *(\d+|None)", cell.source):
+                self.display_limit = (0 if m[1] == "None" else int(m[1])) or None  # 0 or None: no limit
+            return (cell, resources)
+        if cell.source.startswith("%%sql\n"):
+            cell.outputs = self.execute_sql(self.render_template(cell.source[len("%%sql\n"):], index))
+        return (cell, resources)
+
+    def render_template(self, query: str, index: int) -> str:
+        """Substitute the `{{name}}` placeholders with the values of the variables of the kernel."""
+        def kernel_value(m):
+            if not self.kc:
+                raise CellExecutionError(query, "NameError", f"name '{m[1]}' is not defined")
+            probe = nbformat.v4.new_code_cell(f"print({m[1]}, end='')")
+            self.execute_cell(probe, index, store_history=False)
+            self.nb.cells[index] = cell  # `execute_cell()` has replaced the current cell with the probe
+            return "".join(output.get("text", "") for output in probe.outputs if output.output_type == "stream")
+        cell = self.nb.cells[index]
+        return re.sub(r"\{\{\s*(\w+)\s*\}\}", kernel_value, query)
+
+    def execute_sql(self, query: str) -> list:
+        """Execute the statements of the given SQL text, and return the outputs of the last one."""
+        statements = [s for statement in re.split(r";\s*\n+", query) if (s := statement.strip())]
+        if not statements:
+            return []
+        cursor = self.db.cnx.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+                (description, rows) = (cursor.description, cursor.fetchall() if cursor.description else [])
+            row_count = cursor.rowcount
+            self.db.cnx.commit()
+        except Exception as e:
+            self.db.cnx.rollback()
+            raise CellExecutionError(f"{query}\n{type(e).__name__}: {e}", type(e).__name__, str(e)) from e
+        finally:
+            cursor.close()
+        if not description:
+            return [nbformat.v4.new_output("stream", name="stdout", text=f"{row_count} rows affected.\n")]
+        table = render_html_table([column[0] for column in description], rows, self.display_limit)
+        return [nbformat.v4.new_output("execute_result", data={"text/html": table})]
+
+
+def split_into_units(cells: list, labels_to_kinds: dict) -> tuple[list[int], list[list[int]]]:
+    """
+    Partition the indexes of the cells preceding the end of the notebook (if any) into a prefix and
+    independent units: each exercise alone, and each adventure (i.e., a sequence of episodes up to
+    the next heading of level 1 or 2) as a whole.
+    """
+    (prefix, units) = ([], [])
+    current = prefix
+    in_adventure = False
+    for (index, cell) in enumerate(cells):
+        if cell.cell_type == "code" and cell.source.startswith("raise EOFError"):
+            break
+        if cell.cell_type == "markdown":
+            if re.match(r"#{1,2} ", cell.source):
+                in_adventure = False
+            else:
+                (label, _, _) = separate_label_salt_and_text(cell.source)
+                kind = labels_to_kinds.get(label.lower())
+                if kind == "exercise" or (kind == "episode" and not in_adventure):
+                    current = []
+                    units.append(current)
+                    in_adventure = (kind == "episode")
+        current.append(index)
+    return (prefix, units)
+
+
+def run_units_in_parallel(nb, resources: dict, db, cached_outputs: dict, jobs: int, labels_to_kinds: dict):
+    """
+    Execute the prefix of the notebook on the given database, then its independent units in a pool
+    of threads, each on a clone of the database in the state left by the prefix. The units whose
+    queries are all read-only share the clones, the others get a clone of their own. The outputs
+    are written in the cells of the notebook. Raise the first error in the order of the notebook.
+    """
+    (prefix, units) = split_into_units(nb.cells, labels_to_kinds)
+
+    def run_cells(unit_db, indexes, display_limit=DEFAULT_DISPLAY_LIMIT):
+        sub_nb = nbformat.NotebookNode({**nb, "cells": [nb.cells[i] for i in indexes]})  # same cell objects
+        sub_cached_outputs = {j: cached_outputs[i] for (j, i) in enumerate(indexes) if i in cached_outputs}
+        runner = DirectSqlExecutePreprocessor(unit_db, sub_cached_outputs, kernel_name='python3', timeout=None)
+        runner.display_limit = display_limit
+        runner.preprocess(sub_nb, resources)
+        return runner.display_limit
+
+    display_limit = run_cells(db, prefix)  # may configure the display limit
+    is_mutating = [
+        any(nb.cells[i].cell_type == "code" and nb.cells[i].source.startswith("%%sql") and not is_read_only_sql(nb.cells[i].source) for i in unit)
+        for unit in units
+    ]
+    shared_count = min(jobs, is_mutating.count(False))
+    try:
+        clones = db.create_clones(shared_count + is_mutating.count(True))
+    except NotImplementedError as e:
+        print(f"{WARNING}{e} Running the {len(units)} units sequentially.{RESET}")
+        for unit in units:
+            run_cells(db, unit, display_limit)
+        return
+    print(f"Running {len(units)} independent units with {jobs} jobs on {len(clones)} database clones...")
+    shared_clones = queue.SimpleQueue()
+    for clone in clones[:shared_count]:
+        shared_clones.put(clone)
+    own_clones = dict(zip((i for (i, mutating) in enumerate(is_mutating) if mutating), clones[shared_count:]))
+
+    def run_unit(unit_index):
+        if unit_index in own_clones:
+            return run_cells(own_clones[unit_index], units[unit_index], display_limit)
+        clone = shared_clones.get()
+        try:
+            return run_cells(clone, units[unit_index], display_limit)
+        finally:
+            shared_clones.put(clone)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(run_unit, unit_index) for unit_index in range(len(units))]
+    finally:
+        db.drop_clones(clones)
+    for future in futures:
+        if error := future.exception():
+            raise error
+
+
+def run_notebook(config: dict, db_fingerprint: Optional[str] = None, db=None) -> bool:
     ipynb_path = config["source_path"]
     records_path = config["records_path"]
+    if executed_notebooks.get(ipynb_path.resolve()) == ipynb_path.stat().st_mtime:
+        print(f"{OK}The notebook '{ipynb_path}' has just been run by a previous build.{RESET}")
+        return True
     if records_path.is_file() and ipynb_path.stat().st_mtime < records_path.stat().st_mtime:
-        if input(f"{WARNING}The notebook is older than 'records.json'. Run and update it anyway (y/)? {RESET}").lower() != 'y':
+        if ask(f"{WARNING}The notebook is older than 'records.json'. Run and update it anyway (y/)? {RESET}").lower() != 'y':
             return True
     nb = nbformat.read(ipynb_path, as_version=4)
+
+    # Retrieve the outputs of the read-only SQL cells unchanged since the last execution, provided
+    # that the database has been built the same way. Without fingerprint, execute all the cells.
+    cache = open_cache(config, "execute") if db_fingerprint else NullCache()
+    db_fingerprint = f"{config['notebook_runner']}:{db_fingerprint}"  # the runners' outputs differ slightly
+    cached_outputs = {}
+    for (index, key) in enumerate(execution_keys(nb.cells, db_fingerprint)):
+        if key and (outputs := cache.get(key)) is not None:
+            cached_outputs[index] = outputs
+    if cached_outputs:
+        print(f"Reusing the outputs of {len(cached_outputs)} unchanged SQL cells out of {len(nb.cells)} cells.")
+
     print(f"Running '{ipynb_path}'...")
-    run = ExecutePreprocessor(kernel_name='python3', timeout=None).preprocess
+    if config["notebook_runner"] == "direct" and db is not None and config["notebook_jobs"] > 1:
+        labels_to_kinds = {v.lower(): k[:-6] for (k, v) in config["strings"].items() if k.endswith("_label")}
+        run = lambda nb, resources: run_units_in_parallel(nb, resources, db, cached_outputs, config["notebook_jobs"], labels_to_kinds)
+    elif config["notebook_runner"] == "direct" and db is not None:
+        run = DirectSqlExecutePreprocessor(db, cached_outputs, kernel_name='python3', timeout=None).preprocess
+    else:
+        run = CachingExecutePreprocessor(cached_outputs, kernel_name='python3', timeout=None).preprocess
     success = True
     try:
         run(nb, {"metadata": {"path": ipynb_path.parent}})
@@ -21,7 +288,7 @@ def run_notebook(config: dict) -> bool:
         if not "EOFError" in str(e):
             print(f"{FAIL}Error: {e}{RESET}")
             success = False
-    if success or input("Updating the notebook anyway (y/)? ").lower() == 'y':
+    if success or ask("Updating the notebook anyway (y/)? ").lower() == 'y':
         if config["reformat_sql"]:
             print(f"Formatting SQL queries in '{ipynb_path}'...")
             format_sql = SQLFormatter(config)
@@ -32,6 +299,7 @@ def run_notebook(config: dict) -> bool:
                         content = cell.source[len(magic_header):]
                         (comment, query, end_comment, *whatever) = re.split(r"(?m)((?:^(?!--).*\n?)+)", content, maxsplit=1) + ["", ""]
                         cell.source = f"{magic_header}{comment}{format_sql(query)}\n{end_comment}".rstrip()
+            format_sql.commit()
                 
         # Clean up the notebook.
         for cell in nb.cells:
@@ -49,9 +317,18 @@ def run_notebook(config: dict) -> bool:
                             if output["data"]["text/plain"].startswith("+--"):
                                 output["data"].pop("text/plain")
 
+        # Store the outputs of the read-only SQL cells, keyed on their final (reformatted) sources.
+        if success:
+            for (cell, key) in zip(nb.cells, execution_keys(nb.cells, db_fingerprint)):
+                if key and not any(output.get("output_type") == "error" for output in cell.outputs):
+                    cache.set(key, cell.outputs)
+            cache.commit()
+
         nbformat.write(nb, ipynb_path)
         print(f"{OK}Notebook updated.{RESET}")
         subprocess.run(["jupyter", "trust", ipynb_path], check=True)
         print(f"{OK}Notebook trusted.{RESET}")
+        if success:
+            executed_notebooks[ipynb_path.resolve()] = ipynb_path.stat().st_mtime
 
     return success
@@ -1,10 +1,17 @@
+import functools
+import os
 import re
 import textwrap
+import markdown2
 from markdown2 import Markdown
 import sqlparse
 
+from .cache import NullCache, digest, open_cache
+
 md = Markdown(extras=["fenced-code-blocks", "latex", "tables", "cuddled-lists"])
 
+FRAGMENT_CACHE_VERSION = 1  # to be incremented when a cached function changes its output
+
 # ANSI color codes
 OK = "\033[92m"
 WARNING = "\033[1m\033[38;5;166m"
@@ -20,6 +27,53 @@ sub_item = re.compile(r"(?m)^- (.+)").sub
 sub_br = re.compile(r"<br>\n?").sub
 sub_mark = re.compile(r"(?s)<mark>(.*?)</mark>").sub
 
+class FragmentCache:
+    """
+    Memoize a pure function of a text fragment, in a bounded memory cache backed by the disk
+    cache once `open_fragment_caches()` has been called. The disk cache buffers a bounded number
+    of new results, which are written on disk at the latest by `commit_fragment_caches()`.
+    """
+
+    disk = NullCache()  # shared by all the instances, since a single connection may write the file
+    disk_owner = None  # (process id, cache path) of the disk cache
+
+    def __init__(self, render: callable, memory_size: int = 4096):
+        self.render = render
+        self.salt = (FRAGMENT_CACHE_VERSION, render.__name__, markdown2.__version__)
+        self.lookup = functools.lru_cache(maxsize=memory_size)(self.lookup_on_disk)
+        functools.update_wrapper(self, render)
+
+    def __call__(self, text: str) -> str:
+        return self.lookup(text)
+
+    def lookup_on_disk(self, text: str) -> str:
+        key = digest(*self.salt, text)
+        if (result := FragmentCache.disk.get(key)) is None:
+            result = self.render(text)
+            FragmentCache.disk.set(key, result)
+        return result
+
+
+def open_fragment_caches(config: dict):
+    """
+    Back the fragment caches with the disk cache of the given configuration, if any. The disk cache
+    is reopened when the cache path changes (e.g., between the builds of a batch), or in a forked
+    process, which must not use the SQLite connection of its parent.
+    """
+    owner = (os.getpid(), config.get("cache_path"))
+    if FragmentCache.disk_owner == owner:
+        return
+    if FragmentCache.disk_owner and FragmentCache.disk_owner[0] == owner[0]:
+        FragmentCache.disk.close()  # a connection inherited from the parent is just dropped
+    FragmentCache.disk = open_cache(config, "fragments")
+    FragmentCache.disk_owner = owner
+
+
+def commit_fragment_caches():
+    FragmentCache.disk.commit()
+
+
+@FragmentCache
 def markdown_to_html(s: str) -> str:
     s = s.strip()
     s = s.replace("\u00A0", "&nbsp;")
@@ -59,6 +113,7 @@ map_mono = map_chars(sub_mono, "𝙰𝙱𝙲𝙳𝙴𝙵𝙶𝙷𝙸𝙹𝙺𝙻
 map_italic = map_chars(sub_italic, "𝘈𝘉𝘊𝘋𝘌𝘍𝘎𝘏𝘐𝘑𝘒𝘓𝘔𝘕𝘖𝘗𝘘𝘙𝘚𝘛𝘜𝘝𝘞𝘟𝘠𝘡𝘢𝘣𝘤𝘥𝘦𝘧𝘨𝘩𝘪𝘫𝘬𝘭𝘮𝘯𝘰𝘱𝘲𝘳𝘴𝘵𝘶𝘷𝘸𝘹𝘺𝘻𝟢𝟣𝟤𝟥𝟦𝟧𝟨𝟩𝟪𝟫")
 map_bold = map_chars(sub_bold, "𝗔𝗕𝗖𝗗𝗘𝗙𝗚𝗛𝗜𝗝𝗞𝗟𝗠𝗡𝗢𝗣𝗤𝗥𝗦𝗧𝗨𝗩𝗪𝗫𝗬𝗭𝗮𝗯𝗰𝗱𝗲𝗳𝗴𝗵𝗶𝗷𝗸𝗹𝗺𝗻𝗼𝗽𝗾𝗿𝘀𝘁𝘂𝘃𝘄𝘅𝘆𝘇𝟬𝟭𝟮𝟯𝟰𝟱𝟲𝟳𝟴𝟵")
 
+@FragmentCache
 def improved_text(s: str) -> str:
     s = sub_code_block(r"\2", s)
     s = map_mono(s)
@@ -92,12 +147,43 @@ class TextWrapper:
 
 
 class SQLFormatter:
-    def __init__(self, config: dict):
+    """
+    Format the queries with sqlparse, then apply the substitutions of `sqlparse_subs`. Since sqlparse
+    is slow, the results are memoized in a bounded memory cache, backed by the disk cache (if any).
+    The keys include a hash of the settings, so that changing them invalidates the stored results.
+    """
+
+    def __init__(self, config: dict, memory_size: int = 4096):
         self.kwargs = config.get("sqlparse_kwargs", {})
         subs = config.get("sqlparse_subs", {})
         self.subs = [(re.compile(regex), repl) for (regex, repl) in subs.values()]
+        self.settings_hash = digest(self.kwargs, [(regex, self.describe(repl)) for (regex, repl) in subs.values()])
+        self.cache = open_cache(config, "sql_format")
+        self.format_through_caches = functools.lru_cache(maxsize=memory_size)(self.format_through_disk_cache)
+
+    @staticmethod
+    def describe(repl) -> object:
+        """Return a serializable description of a replacement, using the bytecode of the functions."""
+        if callable(repl):
+            code = repl.__code__
+            return (code.co_code.hex(), repr(code.co_consts), code.co_names)
+        return repl
 
     def __call__(self, sql: str) -> str:
+        return self.format_through_caches(sql)
+
+    def format_through_disk_cache(self, sql: str) -> str:
+        key = digest(self.settings_hash, sql)
+        if (formatted := self.cache.get(key)) is None:
+            formatted = self.format(sql)
+            self.cache.set(key, formatted)
+        return formatted
+
+    def commit(self):
+        """Persist the queries formatted since the last commit."""
+        self.cache.commit()
+
+    def format(self, sql: str) -> str:
         sql = sqlparse.format(sql, **self.kwargs)
         for regex, repl in self.subs:
             sql = regex.sub(repl, sql)
@@ -121,21 +207,73 @@ def separate_query_formula_and_salt(
 def split_sql_source(
     source: str,
     sub_comment_sections=re.compile(r"(?m)(^-- )(_.+\._)").sub,
-    match_comments=re.compile(
-        r"""(?xm) # Verbose, multiline
-        (?:^--\s(?:(\w+)\.[ ]?)?(.*\n))?  # Capture the first line of the optional comment with its optional label
-        ((?:^--\s.*\n)*)  # Capture the rest of the optional comment
-        ((?:^.*\n*)+?)  # Capture the SQL query
-        (?:^-->\s.*\[(\d+)\]\s*)?$  # Capture the optional redirection comment
+    match_label=re.compile(r"(\w+)\.[ ]?").match,
+    match_newlines=re.compile(r"\n*").match,
+    match_spaces=re.compile(r"\s*").match,
+    finditer_dashes=re.compile(r"(?m)^--").finditer,
+) -> tuple[str, str, str, str]:
+    """
+    Split the source of a %%sql cell into its label, its comment, its query and the salt of its
+    redirection comment (the last three being optional):
+
+        -- Label. First line of the comment
+        -- Rest of the comment
+        SELECT ...
+        --> Episode [042]
+
+    The source is tokenized line by line, in linear time.
     """
-    ).match
-) -> tuple[str, str, str]:
     content = sub_comment_sections(r"\1<br>\2", source)
-    m = match_comments(content)
-    (label, comment_1, comment_2, query, redirection) = m.groups()
-    comment = (comment_1 or "") + comment_2
-    comment = re.sub(r"(?m)\s*\n?^--\s*", " ", comment).strip()
-    return ((label or ""), comment, query.strip(), (redirection or ""))
+
+    def comment_line_end(start: int) -> int:
+        """
+        Return the end of the comment line starting at the given position, or -1. Note that the
+        whitespace after "--" may be a newline, in which case the next line is part of the comment.
+        """
+        if content.startswith("--", start) and content[start + 2 : start + 3].isspace():
+            return content.find("\n", start + 3) + 1 or -1
+        return -1
+
+    def redirection_salt(start: int) -> str:
+        """Return the salt of the redirection comment starting at the given position, or ""."""
+        if content.startswith("-->", start) and content[start + 3 : start + 4].isspace():
+            end = content.find("\n", start + 4)
+            line = content[start + 4 : end if end >= 0 else len(content)].rstrip()
+            if line.endswith("]") and (i := line.rfind("[")) >= 0 and line[i + 1 : -1].isdecimal():
+                return line[i + 1 : -1]
+        return ""
+
+    # The comment, whose first line may start with a label.
+    (label, comment, start) = ("", "", 0)
+    if (end := comment_line_end(0)) > 0:
+        pos = 3
+        if m := match_label(content, pos, end):
+            (label, pos) = (m[1], m.end())
+        start = end
+        while (end := comment_line_end(start)) > 0:
+            start = end
+        comment = content[pos : start]
+        # Replace each "--" starting a line, with the whitespace around it, by a single space.
+        (chunks, pos) = ([], 0)
+        for m in finditer_dashes(comment):
+            if m.start() < pos:
+                continue
+            chunks.extend([comment[pos : m.start()].rstrip(), " "])
+            pos = match_spaces(comment, m.end()).end()
+        chunks.append(comment[pos:])
+        comment = "".join(chunks).strip()
+
+    # The query, possibly followed by a redirection comment, which cannot start on its first line.
+    # The lines following the redirection comment are ignored.
+    (query_start, query_end, redirection) = (start, len(content), "")
+    pos = start
+    while (end := content.find("\n", pos)) >= 0:
+        pos = match_newlines(content, end).end()
+        if redirection := redirection_salt(pos):
+            query_end = pos
+            break
+    query = content[query_start : query_end].strip()
+    return (label, comment, query, redirection)
 
 def separate_label_salt_and_text(
     source: str,
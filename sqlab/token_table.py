@@ -2,6 +2,7 @@ from pathlib import Path
 import csv
 from dataclasses import dataclass, fields
 import re
+from typing import Optional
 
 @dataclass
 class Item:
@@ -21,6 +22,30 @@ class TokenTable:
             self.init_table_from_path(records_or_path)
         else:
             self.init_table_from_records(records_or_path)
+        self.init_index()
+
+    def init_index(self):
+        """
+        Index the items by token for constant-time lookups. The tokens are normalized as integers,
+        since they are read as such from a TSV file, but as strings from the records. When a token
+        occurs several times, the first item wins.
+        """
+        self.items_by_token = {}
+        for item in self.token_table:
+            self.items_by_token.setdefault(int(item.token), item)
+
+    def get(self, token) -> Optional[Item]:
+        """Return the item of the given token (an integer or a numeric string), or None if unknown."""
+        try:
+            return self.items_by_token.get(int(token))
+        except ValueError:
+            return None
+
+    def __contains__(self, token) -> bool:
+        return self.get(token) is not None
+
+    def __iter__(self):
+        return iter(self.token_table)
 
     def init_table_from_path(self, path):
         with open(path) as f:
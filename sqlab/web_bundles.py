@@ -0,0 +1,76 @@
+"""
+Static bundles of the encrypted messages, for SQLab online. Instead of downloading and scanning the
+whole `sqlab_msg` table, the client hashes the token with SHA-256, reads in the manifest the shard
+named after the first hexadecimal digits of the hash, fetches it (precompressed with gzip and, if
+the brotli module is available, brotli), and looks the full hash up in it. The messages are
+encrypted exactly as in `sqlab_msg`: the bundles reveal nothing more than the database.
+"""
+
+import contextlib
+import gzip
+import hashlib
+import importlib
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from .text_tools import OK, RESET
+
+BUNDLE_FORMAT_VERSION = 1
+
+
+def token_digest(token: str) -> str:
+    """Hash a token normalized as an integer in decimal notation (e.g., without leading zeros)."""
+    return hashlib.sha256(str(int(token)).encode("utf8")).hexdigest()
+
+
+class WebBundleWriter:
+
+    def __init__(self, config: dict):
+        self.bundle_dir = Path(config["web_bundle_path"])
+        self.prefix_length = config["web_bundle_prefix_length"]
+        self.shards = defaultdict(dict)  # digest prefix -> {token digest: encrypted message}
+
+    def add(self, token: str, encrypted: str):
+        """
+        Add a message, encrypted as an SQL literal by the database: either quoted (SQLite,
+        PostgreSQL), or hexadecimal (MySQL, e.g. 0x3f2a...). The quotes are not bundled.
+        """
+        if len(encrypted) >= 2 and encrypted[0] == encrypted[-1] == "'":
+            encrypted = encrypted[1:-1]
+        digest = token_digest(token)
+        self.shards[digest[:self.prefix_length]][digest] = encrypted
+
+    def write(self) -> Path:
+        """Write the shards, their compressed variants and the manifest. Return the path of the latter."""
+        compressors = {"gzip": (".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0))}
+        with contextlib.suppress(ImportError):
+            brotli = importlib.import_module("brotli")
+            compressors["br"] = (".br", lambda data: brotli.compress(data, quality=11))
+        self.bundle_dir.mkdir(parents=True, exist_ok=True)
+        for path in self.bundle_dir.glob("messages_*.json*"):  # the shards of a previous build
+            path.unlink()
+        manifest = {
+            "version": BUNDLE_FORMAT_VERSION,
+            "digest": "sha256",
+            "prefix_length": self.prefix_length,
+            "encodings": list(compressors),
+            "shards": {},
+        }
+        for (prefix, entries) in sorted(self.shards.items()):
+            data = json.dumps(dict(sorted(entries.items())), separators=(",", ":")).encode("utf8")
+            path = self.bundle_dir / f"messages_{prefix}.json"
+            path.write_bytes(data)
+            for (suffix, compress) in compressors.values():
+                path.with_name(path.name + suffix).write_bytes(compress(data))
+            manifest["shards"][prefix] = {
+                "path": path.name,
+                "count": len(entries),
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+        manifest_path = self.bundle_dir / "manifest.json"
+        manifest_path.write_text(json.dumps(manifest, indent=2), encoding="utf8")
+        count = sum(len(entries) for entries in self.shards.values())
+        print(f"{OK}{count} messages bundled in {len(self.shards)} shards ({', '.join(compressors)}) in '{self.bundle_dir}'.{RESET}")
+        return manifest_path
@@ -0,0 +1,52 @@
+import unittest
+from pathlib import Path
+
+from sqlab.batch import group_builds, shared_resources
+
+
+def config(dbms: str, database: str, dump: str, notebook: str = None) -> dict:
+    result = {
+        "sqlab_dbms_module": dbms,
+        "cnx": {"host": "localhost", "port": "5432", "database": database},
+        "sql_dump_path": Path(dump),
+    }
+    if notebook:
+        result["source_path"] = Path(notebook)
+    return result
+
+
+class TestGroupBuilds(unittest.TestCase):
+
+    def group(self, *configs: dict) -> list[list[int]]:
+        builds = [{"id": i, "resources": shared_resources(config)} for (i, config) in enumerate(configs)]
+        return [[build["id"] for build in group] for group in group_builds(builds)]
+
+    def test_in_memory_sqlite_databases_not_shared(self):
+        self.assertEqual(self.group(
+            config("sqlite", ":memory:", "fr/output/dump.sql"),
+            config("sqlite", ":memory:", "en/output/dump.sql"),
+        ), [[0], [1]])
+
+    def test_sqlite_dump_shared(self):
+        self.assertEqual(self.group(
+            config("sqlite", "fr", "output/dump.sql"),
+            config("sqlite", "en", "output/../output/dump.sql"),
+        ), [[0, 1]])
+
+    def test_server_database_shared(self):
+        self.assertEqual(self.group(
+            config("postgresql", "sqlab", "fr/output/dump.sql"),
+            config("postgresql", "sqlab", "en/output/dump.sql"),
+            config("postgresql", "other", "de/output/dump.sql"),
+        ), [[0, 1], [2]])
+
+    def test_groups_merged_by_notebook(self):
+        self.assertEqual(self.group(
+            config("postgresql", "a", "a.sql", "notebook.ipynb"),
+            config("mysql", "b", "b.sql"),
+            config("sqlite", ":memory:", "c.sql", "notebook.ipynb"),
+        ), [[1], [0, 2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
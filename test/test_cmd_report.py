@@ -0,0 +1,216 @@
+import contextlib
+import io
+import re
+import sqlite3
+import tempfile
+import unittest
+from decimal import Decimal
+from pathlib import Path
+
+from sqlab.cmd_report import LogAnalyzer, reduce_partials, tail_csv
+from sqlab.report_store import ReportStore
+from sqlab.token_table import TokenTable
+
+SALT_QUERY = "SELECT foo, salt_011(sum(nn(hash)) OVER ()) AS token FROM t"
+
+
+class StubDatabase:
+    """Replay any query as if it produced the given token."""
+
+    def __init__(self, token: int):
+        self.token = token
+
+    def execute_select(self, query):
+        return (["foo", "token"], [None, None], [(1, self.token)])
+
+
+class EchoDatabase:
+    """Replay a query as if it produced the number ending it."""
+
+    def execute_select(self, query):
+        return (["foo", "token"], [None, None], [(1, int(re.search(r"(\d+)\s*$", query)[1]))])
+
+
+class FailingDatabase:
+    """Fail like a SQLite database, whose errors have no `msg` attribute (contrary to MySQL's)."""
+
+    def execute_select(self, query):
+        try:
+            raise sqlite3.OperationalError("no such column: 'foo'")
+        except sqlite3.OperationalError as e:
+            raise RuntimeError(f"Error executing query: {query}") from e
+
+
+class TestTailCsv(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = Path(self.tmp_dir.name, "logs.csv")
+        self.log_path.write_text("timestamp,query\n2024-10-01 10:00,SELECT 1\n", encoding="utf8")
+        self.tail = tail_csv(self.log_path, poll_interval=0)
+
+    def tearDown(self):
+        self.tail.close()
+        self.tmp_dir.cleanup()
+
+    def append(self, text: str):
+        with self.log_path.open("a", encoding="utf8", newline="") as file:
+            file.write(text)
+
+    def test_header_skipped_and_rows_appended(self):
+        self.assertEqual(next(self.tail), [("2024-10-01 10:00", "SELECT 1")])
+        self.assertEqual(next(self.tail), [])
+        self.append("2024-10-01 10:01,SELECT 2\n2024-10-01 10:02,SELECT 3\n")
+        self.assertEqual(next(self.tail), [("2024-10-01 10:01", "SELECT 2"), ("2024-10-01 10:02", "SELECT 3")])
+
+    def test_incomplete_row_waits_for_its_end(self):
+        next(self.tail)
+        self.append("2024-10-01 10:01,SELECT")
+        self.assertEqual(next(self.tail), [])
+        self.append(" 2\n")
+        self.assertEqual(next(self.tail), [("2024-10-01 10:01", "SELECT 2")])
+
+    def test_quoted_newlines_do_not_end_a_row(self):
+        next(self.tail)
+        self.append('2024-10-01 10:01,"SELECT ""a""\nFROM t')
+        self.assertEqual(next(self.tail), [])
+        self.append('\n"\n')
+        self.assertEqual(next(self.tail), [("2024-10-01 10:01", 'SELECT "a"\nFROM t\n')])
+
+    def test_blank_and_short_rows_skipped(self):
+        next(self.tail)
+        self.append('\n2024-10-01 10:01\n2024-10-01 10:02,"SELECT 2')
+        self.assertEqual(next(self.tail), [])
+        self.append('"\n\n2024-10-01 10:03,SELECT 3\n')
+        self.assertEqual(next(self.tail), [("2024-10-01 10:02", "SELECT 2"), ("2024-10-01 10:03", "SELECT 3")])
+
+    def test_truncated_file_read_again_from_the_start(self):
+        next(self.tail)
+        self.append("2024-10-01 10:01,SELECT 2\n")
+        next(self.tail)
+        self.log_path.write_text("timestamp,query\n2024-10-02,SELECT 4\n", encoding="utf8")
+        self.assertEqual(next(self.tail), [("2024-10-02", "SELECT 4")])
+
+
+class TestLogAnalyzer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp_dir.name)
+        token_table_path = tmp / "token_table.tsv"
+        token_table_path.write_text("token\tactivity\tsource\ttarget\taction\tsalt\n1011\t0\t1\t0\tmove\t011\n")
+        ignored_tokens_path = tmp / "ignored_tokens.txt"
+        ignored_tokens_path.write_text("")
+        self.config = {"ignored_tokens_path": ignored_tokens_path}
+        self.token_table = TokenTable(token_table_path)
+        self.store = ReportStore(tmp / "report.sqlite")
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def analyze(self, token: int, *calls: list) -> LogAnalyzer:
+        analyze = LogAnalyzer(self.config, StubDatabase(token), self.store, self.token_table)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for queries in calls:
+                analyze([("2024-10-01 10:00", query) for query in queries])
+        return analyze
+
+    def test_unknown_token_produced_then_decrypted_in_the_same_call(self):
+        analyze = self.analyze(4242, [SALT_QUERY, "SELECT decrypt(4242)"])
+        self.assertEqual(analyze.todo_count, 1)
+
+    def test_unknown_token_produced_then_decrypted_in_later_calls(self):
+        analyze = self.analyze(4242, [SALT_QUERY], [], ["SELECT decrypt(4242)"])
+        self.assertEqual(analyze.todo_count, 1)
+
+    def test_unknown_token_decrypted_then_produced_in_later_calls(self):
+        analyze = self.analyze(4242, ["SELECT decrypt(04242)"], [SALT_QUERY])
+        self.assertEqual(analyze.todo_count, 1)
+
+    def test_unknown_token_reported_once(self):
+        analyze = self.analyze(4242, [SALT_QUERY], ["SELECT decrypt(4242)"], [SALT_QUERY, "SELECT decrypt(4242)"])
+        self.assertEqual(analyze.todo_count, 1)
+
+    def test_produced_token_normalized(self):
+        for token in (Decimal("1011"), "0001011", 1011.0):
+            with self.subTest(token=token):
+                analyze = self.analyze(token, [SALT_QUERY], ["SELECT decrypt(1011)"])
+                self.assertEqual(analyze.todo_count, 0)
+        self.assertEqual(self.store.compile_report()["1011"]["produced_at"], {"2024-10-01": 3})
+
+    def test_sql_error_recorded(self):
+        analyze = LogAnalyzer(self.config, FailingDatabase(), self.store, self.token_table)
+        analyze([("2024-10-01 10:00", SALT_QUERY)])
+        self.assertEqual(self.store.compile_report()["sql_errors"], {"no such column: '...'": 1})
+
+    def test_known_token_not_reported(self):
+        analyze = self.analyze(1011, [SALT_QUERY], ["SELECT decrypt(1011)"])
+        self.assertEqual(analyze.todo_count, 0)
+
+
+class TestShardedLogs(unittest.TestCase):
+
+    SHARDS = [
+        [
+            ("2024-10-01 10:00", f"{SALT_QUERY} WHERE foo = 1011"),
+            ("2024-10-01 10:01", "SELECT decrypt(1011)"),
+            ("2024-10-01 10:02", f"{SALT_QUERY} WHERE foo = 4242"),  # decrypted in the other shard
+            ("2024-10-01 10:03", f"{SALT_QUERY} WHERE foo = 6464"),  # never decrypted
+            ("2024-10-01 10:04", f"{SALT_QUERY} WHERE foo = 7575"),
+            ("2024-10-01 10:05", "SELECT decrypt(7575)"),
+        ],
+        [
+            ("2024-10-02 11:00", "SELECT decrypt(04242)"),
+            ("2024-10-02 11:02", "SELECT decrypt(5353)"),  # never produced
+            ("2024-10-02 11:03", f"{SALT_QUERY} WHERE foo = 1011"),
+        ],
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmp_dir.name)
+        token_table_path = self.tmp / "token_table.tsv"
+        token_table_path.write_text("token\tactivity\tsource\ttarget\taction\tsalt\n1011\t0\t1\t0\tmove\t011\n")
+        ignored_tokens_path = self.tmp / "ignored_tokens.txt"
+        ignored_tokens_path.write_text("")
+        self.config = {"ignored_tokens_path": ignored_tokens_path}
+        self.token_table = TokenTable(token_table_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def analyze(self, name: str, rows: list, **kwargs) -> tuple[ReportStore, LogAnalyzer]:
+        store = ReportStore(self.tmp / f"{name}.sqlite")
+        store.add_task("1011", "exercise 1, solution")
+        analyze = LogAnalyzer(self.config, EchoDatabase(), store, self.token_table, **kwargs)
+        analyze(rows)
+        return (store, analyze)
+
+    def test_reduced_report_equals_single_log_report(self):
+        with contextlib.redirect_stdout(io.StringIO()) as single_output:
+            (store, analyze) = self.analyze("single", [row for shard in self.SHARDS for row in shard])
+        expected = (store.compile_report(), analyze.todo_count)
+        store.close()
+
+        partials = []
+        for (i, rows) in enumerate(self.SHARDS):
+            (store, _) = self.analyze(f"shard_{i}", rows, defer_unknown_tokens=True)
+            partials.append(store.dump_partial())
+            store.close()
+        store = ReportStore(self.tmp / "reduced.sqlite")
+        with contextlib.redirect_stdout(io.StringIO()) as reduced_output:
+            todo_count = reduce_partials(store, partials)
+        actual = (store.compile_report(), todo_count)
+        store.close()
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(todo_count, 2)  # 4242 and 7575
+        self.assertEqual(actual[0]["5353"]["kind"], "unknown")
+        self.assertEqual(actual[0]["6464"]["kind"], "TODO")
+        unknown_tokens = lambda output: sorted(re.findall(r"Unknown token (\d+)", output.getvalue()))
+        self.assertEqual(unknown_tokens(reduced_output), unknown_tokens(single_output))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import io
+import signal
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sqlab.cmd_shell import Shell
+from sqlab.dbms.sqlite.database import Database
+
+
+class TestShell(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database({"dbms": "SQLite", "cnx": {}})
+        with mock.patch("builtins.print"):
+            self.db.connect()
+        self.db.cnx.execute("CREATE TABLE t (x INTEGER)")
+        self.db.cnx.executemany("INSERT INTO t VALUES (?)", ((i,) for i in range(100)))
+        self.shell = Shell(self.db)
+        self.shell.stdout = io.StringIO()
+        self.shell.worker.submit(lambda: None).result()  # start the worker thread
+
+    def tearDown(self):
+        self.shell.worker.shutdown()
+        self.db.close()
+
+    def run_command(self, command: str) -> str:
+        """Run the given command, wait for the worker to be idle, and return the output."""
+        self.shell.stdout = io.StringIO()
+        self.shell.onecmd(command)
+        self.shell.worker.submit(lambda: None).result()
+        return self.shell.stdout.getvalue()
+
+    def test_pages_displayed_on_demand(self):
+        self.shell.page_size = 40
+        with mock.patch.object(self.shell, "read_input", side_effect=["", ""]) as read_input:
+            output = self.run_command("SELECT x FROM t;")
+        self.assertEqual(read_input.call_count, 2)  # before the second and third pages only
+        self.assertIn("100 rows in set", output)
+
+    def test_quitting_the_pager_releases_the_cursor(self):
+        self.shell.page_size = 10
+        with mock.patch.object(self.db, "close_streaming_cursor", wraps=self.db.close_streaming_cursor) as close:
+            with mock.patch.object(self.shell, "read_input", side_effect=["", "q"]):
+                output = self.run_command("SELECT x FROM t;")
+            close.assert_called_once()
+        self.assertIn("20 rows displayed, the remaining ones have not been fetched", output)
+        self.assertNotIn("20\n", output)  # the first row of the third page
+        self.assertIn("1 row in set", self.run_command("SELECT count(*) FROM t;"))
+
+    def press_ctrl_c_when(self, event: threading.Event):
+        """Send SIGINT to the main thread, waiting for the result of the worker, once the event is set."""
+        main_thread_id = threading.get_ident()
+
+        def press():
+            event.wait()
+            time.sleep(0.1)  # let the main thread wait for the result
+            signal.pthread_kill(main_thread_id, signal.SIGINT)
+
+        threading.Thread(target=press, daemon=True).start()
+
+    def test_ctrl_c_cancels_the_query(self):
+        started = threading.Event()
+        self.db.cnx.create_function("mark_started", 0, lambda: started.set())
+        query = "SELECT count(*) FROM (WITH RECURSIVE c(x) AS (SELECT mark_started() UNION ALL SELECT x + 1 FROM c) SELECT x FROM c);"
+        self.press_ctrl_c_when(started)
+        self.assertIn("Query cancelled.", self.run_command(query))
+        self.assertIn("1 row in set", self.run_command("SELECT count(*) FROM t;"))
+
+    def test_ctrl_c_releases_the_cursor_of_a_query_completed_anyway(self):
+        (started, cancelled) = (threading.Event(), threading.Event())
+        self.db.cnx.create_function("wait_for_cancel", 0, lambda: started.set() or cancelled.wait() and 1)
+        self.press_ctrl_c_when(started)
+        with mock.patch.object(self.db, "cancel", side_effect=cancelled.set):  # too late: the query completes
+            with mock.patch.object(self.db, "close_streaming_cursor", wraps=self.db.close_streaming_cursor) as close:
+                self.assertIn("Query cancelled.", self.run_command("SELECT wait_for_cancel() AS x;"))
+                close.assert_called_once()
+        self.assertIn("1 row in set", self.run_command("SELECT count(*) FROM t;"))
+
+    def test_slowest_queries_in_decreasing_order(self):
+        self.assertIn("No query timed yet.", self.run_command("slowest"))
+        for (query, execution_time, fetch_time) in [("SELECT 1", 0.5, 0.0), ("SELECT\n  2", 0.25, 2.0), ("SELECT 3", 1.0, 0.5)]:
+            self.shell.record_query_time(query, execution_time, fetch_time, 1)
+        output = self.run_command("slowest 2")
+        self.assertRegex(output, r"(?s)^ +1\. \S*2\.250 s.*\n +SELECT 2\n +2\. 1\.500 s.*\n +SELECT 3\n$")
+
+    def test_timing_recorded(self):
+        self.shell.timing = True
+        output = self.run_command("SELECT count(*) FROM t;")
+        self.assertRegex(output, r"1 row in set \(execution: \d+\.\d{3} s, fetch: \d+\.\d{3} s\)")
+        self.assertEqual([query for (*_, query) in self.shell.query_times], ["SELECT count(*) FROM t"])
+
+
+if __name__ == "__main__":
+    unittest.main()
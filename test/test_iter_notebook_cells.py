@@ -0,0 +1,96 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlab.cmd_parse import iter_notebook_cells
+
+HTML_TABLE = "<table>\n    <tr>\n        <th>foo</th>\n        <th>token</th>\n    </tr>\n    <tr>\n        <td>bar</td>\n        <td>4547</td>\n    </tr>\n</table>"
+
+NOTEBOOK = {
+    "cells": [
+        {
+            "cell_type": "markdown",
+            "id": "a1",
+            "metadata": {"tags": ["cell_type"]},
+            "source": ["# Title\n", "Pitch with unicode: é, \\u2603, \"quotes\" and [brackets], {braces}."],
+        },
+        {
+            "cell_type": "code",
+            "execution_count": 12,
+            "id": "a2",
+            "metadata": {},
+            "outputs": [
+                {"name": "stdout", "output_type": "stream", "text": ["1 rows affected.\n"]},
+                {
+                    "data": {
+                        "text/html": HTML_TABLE.splitlines(keepends=True),
+                        "text/plain": ["+-----+-------+\n", "| foo | token |\n"],
+                    },
+                    "execution_count": 12,
+                    "metadata": {},
+                    "output_type": "execute_result",
+                },
+                {"data": {"image/png": "iVBORw0KGgo" * 100}, "metadata": {}, "output_type": "display_data"},
+            ],
+            "source": ["%%sql\n", "SELECT foo, salt_042(sum(nn(A.hash)) OVER ()) AS token\n", "FROM bar"],
+        },
+        {"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": []},
+        {"cell_type": "raw", "metadata": {}, "source": "raw text"},
+    ],
+    "metadata": {"kernelspec": {"display_name": "Python 3", "language": "python", "name": "python3"}},
+    "nbformat": 4,
+    "nbformat_minor": 123456789,
+}
+
+EXPECTED_CELLS = [
+    {
+        "cell_type": "markdown",
+        "source": NOTEBOOK["cells"][0]["source"],
+    },
+    {
+        "cell_type": "code",
+        "outputs": [{}, {"data": {"text/html": HTML_TABLE.splitlines(keepends=True)}}, {}],
+        "source": NOTEBOOK["cells"][1]["source"],
+    },
+    {"cell_type": "code", "outputs": [], "source": []},
+    {"cell_type": "raw", "source": "raw text"},
+]
+
+
+class TestIterNotebookCells(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name, "notebook.ipynb")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def iter_cells(self, notebook, chunk_size, **kwargs):
+        self.path.write_text(json.dumps(notebook, **kwargs), encoding="utf8")
+        return list(iter_notebook_cells(self.path, chunk_size))
+
+    def test_chunk_sizes(self):
+        for chunk_size in (1, 2, 3, 7, 64, 1 << 20):
+            for kwargs in ({}, {"indent": 1, "ensure_ascii": False}, {"separators": (",", ":")}):
+                with self.subTest(chunk_size=chunk_size, **kwargs):
+                    self.assertEqual(self.iter_cells(NOTEBOOK, chunk_size, **kwargs), EXPECTED_CELLS)
+
+    def test_cells_not_first(self):
+        notebook = {"metadata": NOTEBOOK["metadata"], "nbformat": 4, "cells": NOTEBOOK["cells"]}
+        self.assertEqual(self.iter_cells(notebook, 5), EXPECTED_CELLS)
+
+    def test_no_cells(self):
+        self.assertEqual(self.iter_cells({"cells": []}, 3), [])
+        self.assertEqual(self.iter_cells({}, 3), [])
+
+    def test_truncated_notebook(self):
+        text = json.dumps(NOTEBOOK, indent=1)
+        self.path.write_text(text[:len(text) // 2], encoding="utf8")
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_notebook_cells(self.path, 16))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlab.report_store import ReportStore, merge_partials
+
+DAYS = ["2024-10-01", "2024-10-02", "2024-10-03"]
+TOKENS = ["1002", "2002", "4547", "8968"]
+
+
+def random_events(rng, count):
+    return [(rng.choice(TOKENS), rng.choice(DAYS), rng.choice(["decrypted", "produced"])) for _ in range(count)]
+
+
+def random_errors(rng, count):
+    return [rng.choice([("sql", "Unknown column '...'"), ("sql", "Syntax error"), ("no_token", None), ("timeout", "SELECT 1")]) for _ in range(count)]
+
+
+class TestMergePartials(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_counter = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def new_store(self):
+        self.store_counter += 1
+        return ReportStore(Path(self.tmp_dir.name, f"store_{self.store_counter}.sqlite"))
+
+    def fill_store(self, store, tasks, events, errors):
+        for (token, kind) in tasks:
+            store.add_task(token, kind)
+        for event in events:
+            store.add_event(*event)
+        for error in errors:
+            store.add_error(*error)
+
+    def random_partial(self, rng):
+        store = self.new_store()
+        tasks = [(token, rng.choice(["exercise 1", "unknown", "TODO"])) for token in rng.sample(TOKENS, 2)]
+        self.fill_store(store, tasks, random_events(rng, 20), random_errors(rng, 5))
+        partial = store.dump_partial()
+        store.close()
+        return partial
+
+    def test_associativity(self):
+        rng = random.Random(42)
+        for _ in range(20):
+            (a, b, c) = (self.random_partial(rng) for _ in range(3))
+            self.assertEqual(
+                merge_partials(merge_partials(a, b), c),
+                merge_partials(a, merge_partials(b, c)),
+            )
+            self.assertEqual(merge_partials(a, b, c), merge_partials(merge_partials(a, b), c))
+
+    def test_neutral_element(self):
+        rng = random.Random(0)
+        a = self.random_partial(rng)
+        self.assertEqual(merge_partials(a), a)
+        self.assertEqual(merge_partials(merge_partials(), a), a)
+
+    def test_first_registration_wins(self):
+        a = {"tasks": {"1002": ["exercise 1", None, None]}, "events": {}, "errors": {}}
+        b = {"tasks": {"1002": ["TODO", "SELECT 1", None]}, "events": {}, "errors": {}}
+        self.assertEqual(merge_partials(a, b)["tasks"]["1002"], ["exercise 1", None, None])
+
+    def test_reduced_report_equals_single_log_report(self):
+        rng = random.Random(1)
+        tasks = [(token, "exercise 1") for token in TOKENS]
+        shards = [(random_events(rng, 30), random_errors(rng, 6)) for _ in range(3)]
+
+        whole = self.new_store()
+        self.fill_store(whole, tasks, [e for (events, _) in shards for e in events], [e for (_, errors) in shards for e in errors])
+        expected = whole.compile_report()
+        whole.close()
+
+        partials = []
+        for (events, errors) in shards:
+            store = self.new_store()
+            self.fill_store(store, tasks, events, errors)
+            partials.append(store.dump_partial())
+            store.close()
+        reduced = self.new_store()
+        reduced.load_partial(merge_partials(*partials))
+        actual = reduced.compile_report()
+        reduced.close()
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(list(actual["hits"].items()), list(expected["hits"].items()))
+
+
+if __name__ == "__main__":
+    unittest.main()
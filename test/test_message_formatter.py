@@ -0,0 +1,141 @@
+import argparse
+import copy
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from sqlab.config import get_config
+from sqlab.message_formatter import PARALLEL_FORMATTING_THRESHOLD, format_messages, iter_formatted_messages, iter_in_background
+
+CONFIG_PY = """
+config = {
+    "dbms": "SQLite",
+    "cnx_path": "./cnx.ini",
+    "language": "en",
+    "ddl_path": "./ddl.sql",
+    "dataset_dir": "./dataset",
+    "relational_schema_dir": "./output",
+}
+"""
+
+CNX_INI = """
+[cnx]
+database = :memory:
+password =
+"""
+
+FORMULA = {"label": "Formula", "tweak": "replace (0) by 42", "code": "salt_042(sum(nn(hash)) OVER ()) AS token"}
+SOLUTIONS = [{"solution": {"intro": "A **join**.", "query": "SELECT a\nFROM t"}}, {"annotation": "Note the `JOIN`."}]
+CORRECTION = {"label": "Exercise", "task_number": 1, "token": 1011, "solutions": SOLUTIONS}  # shared by two tokens
+TXT_MESSAGES = {
+    "11": ("exercise_task", {"label": "Exercise", "task_number": 1, "statement": "Find _all_ the rows.", "formula": FORMULA}),
+    "1011": ("exercise_correction", CORRECTION),
+    "1012": ("exercise_correction", CORRECTION),
+    "9001": ("hint", {"label": "Hint", "task_number": 1, "preamble": "Almost there!", "text": "Check the `JOIN`."}),
+    "21": ("episode", {"label": "Episode", "task_number": 1, "context": "Once upon a time.", "statement_label": "Statement", "statement": "Find it.", "formula": {**FORMULA, "tweak": ""}}),
+    "2022": ("episode", {"label": "Episode", "task_number": 2, "token": 2022, "solutions": SOLUTIONS, "context": "Then.", "statement_label": "Statement", "statement": "Find more.", "formula": FORMULA}),
+    "3033": ("episode", {"label": "Episode", "task_number": 3, "token": 3033, "solutions": SOLUTIONS, "context": "The end.", "statement": ""}),
+}
+
+# The output of the formatter deep-copying each message before modifying it in place.
+DEEP_COPY_TXT_OUTPUT = {
+    '11': '⚪️ 𝗘𝘅𝗲𝗿𝗰𝗶𝘀𝗲 𝟭. Find 𝘢𝘭𝘭 the rows.\n\n𝗙𝗼𝗿𝗺𝘂𝗹𝗮 (replace (0) by 42).\n-- , salt_042(sum(nn(hash)) OVER ()) AS\ntoken',
+    '1011': '🟢 𝗘𝘅𝗲𝗿𝗰𝗶𝘀𝗲 𝟭. Correct (1011).\n\n----------------------------------------\n\nA 𝗷𝗼𝗶𝗻.\n\nSELECT a\nFROM t\n\nNote the 𝙹𝙾𝙸𝙽.\n\n----------------------------------------',
+    '1012': '🟢 𝗘𝘅𝗲𝗿𝗰𝗶𝘀𝗲 𝟭. Correct (1011).\n\n----------------------------------------\n\nA 𝗷𝗼𝗶𝗻.\n\nSELECT a\nFROM t\n\nNote the 𝙹𝙾𝙸𝙽.\n\n----------------------------------------',
+    '9001': '🟠 𝗛𝗶𝗻𝘁 𝟭. Almost there!\n\n➥ Check the 𝙹𝙾𝙸𝙽.',
+    '21': '⚪️ 𝗘𝗽𝗶𝘀𝗼𝗱𝗲 𝟭.\n\nOnce upon a time.\n\n𝗦𝘁𝗮𝘁𝗲𝗺𝗲𝗻𝘁. Find it.\n\n𝗙𝗼𝗿𝗺𝘂𝗹𝗮.\n-- , salt_042(sum(nn(hash)) OVER ()) AS\ntoken',
+    '2022': '🟢 𝗘𝗽𝗶𝘀𝗼𝗱𝗲 𝟮. Correct (2022).\n\n----------------------------------------\n\nA 𝗷𝗼𝗶𝗻.\n\nSELECT a\nFROM t\n\nNote the 𝙹𝙾𝙸𝙽.\n\n----------------------------------------\n\nThen.\n\n𝗦𝘁𝗮𝘁𝗲𝗺𝗲𝗻𝘁. Find more.\n\n𝗙𝗼𝗿𝗺𝘂𝗹𝗮 (replace (0) by 42).\n-- , salt_042(sum(nn(hash)) OVER ()) AS\ntoken',
+    '3033': '🟢 𝗘𝗽𝗶𝘀𝗼𝗱𝗲 𝟯. Correct (3033).\n\n----------------------------------------\n\nA 𝗷𝗼𝗶𝗻.\n\nSELECT a\nFROM t\n\nNote the 𝙹𝙾𝙸𝙽.\n\n----------------------------------------\n\nThe end.',
+}
+
+
+def hint(i: int) -> tuple:
+    return ("hint", {"label": "Hint", "task_number": i % 7, "preamble": "Almost there!", "text": f"**Hint** `{i}`."})
+
+
+def make_config(config_dir: Path, **cli_args) -> dict:
+    """Build a configuration from its files, as the command line does, to be reloaded by the workers."""
+    Path(config_dir, "config.py").write_text(CONFIG_PY)
+    Path(config_dir, "cnx.ini").write_text(CNX_INI)
+    cli_args = {"CONFIG_DIR": str(config_dir), "follow": False, "shards": None, "cache": None, "web": False, "json": False, "password": None, **cli_args}
+    return get_config(argparse.Namespace(**cli_args))
+
+
+class TestFormatMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = make_config(Path(self.tmp_dir.name))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_parallel_output_equals_serial_output(self):
+        messages = {str(i): hint(i) for i in range(2 * PARALLEL_FORMATTING_THRESHOLD)}
+        serial = format_messages({**self.config, "formatting_jobs": 1}, messages)
+        with mock.patch("sqlab.message_formatter.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as pool:
+            parallel = format_messages({**self.config, "formatting_jobs": 2}, messages)
+        pool.assert_called_once()
+        self.assertEqual(list(parallel.items()), list(serial.items()))
+
+    def test_output_equals_deep_copy_output(self):
+        config = {"markdown_to": "txt", "strings": {"preamble_accepted": "Correct ({token})."}, "column_width": 40, "formatting_jobs": 1}
+        messages = copy.deepcopy(TXT_MESSAGES)
+        self.assertEqual(format_messages(config, messages), DEEP_COPY_TXT_OUTPUT)
+        self.assertEqual(messages, TXT_MESSAGES)  # not modified
+
+
+class TestDistinctMessages(unittest.TestCase):
+
+    def test_each_distinct_message_formatted_once_in_order(self):
+        shared = hint(1)
+        messages = {"a": shared, "b": hint(2), "c": shared, "d": hint(1), "e": hint(3), "f": hint(2)}  # d: same content as a
+        calls = []
+
+        def format_message(message):
+            calls.append(message)
+            return message[1]["text"]
+
+        with mock.patch("sqlab.message_formatter.create_message_formatter", return_value=format_message):
+            formatted = list(iter_formatted_messages({"formatting_jobs": 1}, messages))
+        self.assertEqual([token for (token, _) in formatted], list(messages))
+        self.assertEqual([text for (_, text) in formatted], [message[1]["text"] for message in messages.values()])
+        self.assertEqual(calls, [hint(1), hint(2), hint(3)])
+
+
+class TestIterInBackground(unittest.TestCase):
+
+    def test_items_yielded_in_order(self):
+        self.assertEqual(list(iter_in_background(iter(range(100)), max_ahead=3)), list(range(100)))
+
+    def test_producer_bounded(self):
+        produced = []
+
+        def produce():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        items = iter_in_background(produce(), max_ahead=3)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.1)  # let the producer fill the queue
+        self.assertLessEqual(len(produced), 1 + 3 + 1)  # consumed, queued, and waiting to be queued
+        self.assertEqual(list(items), list(range(1, 100)))
+
+    def test_producer_exception_raised_after_the_previous_items(self):
+
+        def produce():
+            yield from range(3)
+            raise ValueError("formatting failed")
+
+        items = iter_in_background(produce(), max_ahead=10)
+        self.assertEqual([next(items) for _ in range(3)], [0, 1, 2])
+        with self.assertRaisesRegex(ValueError, "formatting failed"):
+            next(items)
+
+
+if __name__ == "__main__":
+    unittest.main()
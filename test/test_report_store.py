@@ -0,0 +1,43 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlab.report_store import ReportStore
+
+
+class TestTokensSpiking(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = ReportStore(Path(self.tmp_dir.name, "report.sqlite"))
+        self.store.add_task("1011", "exercise 1, solution")
+        self.store.add_task("2022", "exercise 2, solution")
+        for (token, day, count) in [
+            ("1011", "2024-10-01", 1),
+            ("1011", "2024-10-02", 1),
+            ("1011", "2024-10-03", 7),  # average: 3
+            ("2022", "2024-10-01", 2),
+            ("2022", "2024-10-02", 2),
+        ]:
+            for _ in range(count):
+                self.store.add_event(token, day, "produced")
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_tokens_spiking_on_a_day(self):
+        self.assertEqual(self.store.tokens_spiking_on("2024-10-03"), [("2024-10-03", "1011", "exercise 1, solution", 7, 3.0)])
+        self.assertEqual(self.store.tokens_spiking_on("2024-10-02"), [])
+        self.assertEqual(self.store.tokens_spiking_on("2024-10-02", ratio=0.3), [
+            ("2024-10-02", "2022", "exercise 2, solution", 2, 2.0),
+            ("2024-10-02", "1011", "exercise 1, solution", 1, 3.0),
+        ])
+
+    def test_spikes_reported(self):
+        report = self.store.compile_report()
+        self.assertEqual(report["spikes"], {"2024-10-03": {"1011 (exercise 1, solution)": 7}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import random
+import re
+import unittest
+
+from sqlab.cmd_parse import scan_html_table
+
+# The regex-based extractors replaced by scan_html_table(), kept as oracles.
+
+def legacy_token(table, search_token=re.compile(r"<th>token</th>\n(?:.+\n)*? *<td>(\d+)</td>\s+</tr>").search):
+    if m := search_token(table):
+        return m[1]
+
+def legacy_head(table):
+    n = table.count("<tr>") - 1
+    count_str = f"\nTotal: {n} row{'s'[:n^1]} affected."
+    return re.sub(r"(?s)(<table>\n(?:.*?<tr>.+?</tr>\n){,3}).*(</table>)", fr"\1\2{count_str}", table)
+
+def legacy_columns(table):
+    header_row = re.search(r"(?s)<tr>(.+?)</tr>", table).group(1)
+    columns = re.findall(r"<th>(?!token)(.+?)</th>", header_row)
+    if "hash" in columns:
+        columns = ["*"]
+    return columns
+
+
+def jupysql_table(columns, rows):
+    lines = ["<table>", "    <thead>", "        <tr>"]
+    lines.extend(f"            <th>{column}</th>" for column in columns)
+    lines.extend(["        </tr>", "    </thead>", "    <tbody>"])
+    for row in rows:
+        lines.append("        <tr>")
+        lines.extend(f"            <td>{value}</td>" for value in row)
+        lines.append("        </tr>")
+    lines.extend(["    </tbody>", "</table>"])
+    return "\n".join(lines)
+
+
+FRAGMENTS = [
+    "<table>\n", "</table>", "<tr>", "</tr>\n", "</tr>", "<th>token</th>\n", "<th>hash</th>", "<th>foo</th>",
+    "<th>tok\nen</th>", "<td>42</td>", "<td>4547</td>\n", "<td>x</td>", " ", "  ", "\n", "\n\n", "\t", "7", "a",
+]
+
+
+class TestScanHtmlTable(unittest.TestCase):
+
+    def assert_same_as_legacy(self, html):
+        scan = scan_html_table(html)
+        self.assertEqual(scan.token, legacy_token(html), repr(html))
+        self.assertEqual(scan.head, legacy_head(html), repr(html))
+        try:
+            expected_columns = legacy_columns(html)
+        except AttributeError:  # no header row
+            expected_columns = []
+        self.assertEqual(scan.columns, expected_columns, repr(html))
+        self.assertEqual(scan.row_count, html.count("<tr>") - 1)
+
+    def test_jupysql_tables(self):
+        rng = random.Random(42)
+        for row_count in (0, 1, 2, 3, 10):
+            for columns in (["foo", "token"], ["token", "foo"], ["hash", "bar", "token"], ["foo"]):
+                rows = [[rng.randrange(10000) for _ in columns] for _ in range(row_count)]
+                html = jupysql_table(columns, rows)
+                self.assert_same_as_legacy(html)
+                self.assert_same_as_legacy(f"{html}\n<span>1 row affected.</span>")
+
+    def test_examples(self):
+        html = jupysql_table(["foo", "token"], [["bar", 4547], ["baz", 1234]])
+        scan = scan_html_table(html)
+        self.assertEqual(scan.token, "4547")
+        self.assertEqual(scan.columns, ["foo"])
+        self.assertEqual(scan.row_count, 2)
+        self.assertTrue(scan.head.endswith("</table>\nTotal: 2 rows affected."))
+        self.assertEqual(scan_html_table("<th>token</th>\n<td>42</td>\n    </tr>").token, "42")
+
+    def test_random_fragments(self):
+        rng = random.Random(0)
+        for _ in range(20000):
+            html = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randrange(25)))
+            self.assert_same_as_legacy(html)
+
+    def test_large_outputs(self):
+        rng = random.Random(1)
+        cases = {
+            "100,000 rows": jupysql_table(["foo", "bar", "token"], [[rng.randrange(10**6) for _ in range(3)] for _ in range(100_000)]),
+            "token not ending a row": jupysql_table(["token", "foo"], [["1", "x"]] * 20_000),
+            "repeated token headers": "<th>token</th>\n" * 3_000 + "<td>x</td>\n" * 3_000,
+        }
+        for (name, html) in cases.items():
+            with self.subTest(name):
+                expected = (legacy_token(html), legacy_head(html), legacy_columns(html) if "<tr>" in html else [])
+                scan = scan_html_table(html)
+                self.assertEqual((scan.token, scan.head, scan.columns), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,16 @@
+import json
+import random
+import re
+import sqlite3
+import tempfile
+import time
 import unittest
-from sqlab.text_tools import repr_single, separate_query_formula_and_salt, split_sql_source, separate_label_salt_and_text
+from pathlib import Path
+from unittest import mock
+from sqlab.config import defaults
+from sqlab.cache import MAX_PENDING_VALUES, NullCache
+from sqlab.text_tools import repr_single, separate_query_formula_and_salt, split_sql_source, separate_label_salt_and_text, SQLFormatter
+from sqlab.text_tools import FragmentCache, open_fragment_caches, commit_fragment_caches, improved_text
 
 class TestReprSingle(unittest.TestCase):
 
@@ -115,6 +126,66 @@ class TestSplitSqlSource(unittest.TestCase):
         self.assertEqual(actual, ("label", "foo bar", "SELECT * FROM table", "042"))
 
 
+def legacy_split_sql_source(
+    source: str,
+    sub_comment_sections=re.compile(r"(?m)(^-- )(_.+\._)").sub,
+    match_comments=re.compile(
+        r"""(?xm) # Verbose, multiline
+        (?:^--\s(?:(\w+)\.[ ]?)?(.*\n))?  # Capture the first line of the optional comment with its optional label
+        ((?:^--\s.*\n)*)  # Capture the rest of the optional comment
+        ((?:^.*\n*)+?)  # Capture the SQL query
+        (?:^-->\s.*\[(\d+)\]\s*)?$  # Capture the optional redirection comment
+    """
+    ).match
+) -> tuple[str, str, str]:
+    """The regex-based implementation replaced by the tokenizer, kept as an oracle."""
+    content = sub_comment_sections(r"\1<br>\2", source)
+    m = match_comments(content)
+    (label, comment_1, comment_2, query, redirection) = m.groups()
+    comment = (comment_1 or "") + comment_2
+    comment = re.sub(r"(?m)\s*\n?^--\s*", " ", comment).strip()
+    return ((label or ""), comment, query.strip(), (redirection or ""))
+
+
+class TestSplitSqlSourceAgainstLegacy(unittest.TestCase):
+
+    FRAGMENTS = [
+        "-- ", "--", "--\n", "-->", "--> ", "-->\t", " ", "  ", "\t", "\n", "\n\n", "\r", "\u2003", "\x1c",
+        "label.", "label. ", "Label_2.", "[042]", "[", "]", "12", "\u0663", "SELECT", "x", "é", ".",
+        "-- _Section._ ", "_a._", "--> Episode [042]", "--> [7]  ", "\n-- ", "\n--> [1]\n",
+    ]
+
+    def test_random_sources(self):
+        rng = random.Random(0)
+        for _ in range(30000):
+            source = "".join(rng.choice(self.FRAGMENTS) for _ in range(rng.randrange(20)))
+            self.assertEqual(split_sql_source(source), legacy_split_sql_source(source), repr(source))
+
+    def test_random_lines(self):
+        rng = random.Random(1)
+        lines = ["-- comment", "-- label. comment", "--", "SELECT a", "FROM t", "", " ", "--> Episode [042]", "--> [1] x"]
+        for _ in range(10000):
+            source = "\n".join(rng.choice(lines) for _ in range(rng.randrange(12)))
+            self.assertEqual(split_sql_source(source), legacy_split_sql_source(source), repr(source))
+
+    def test_running_time_is_linear(self):
+        sources = {
+            "many comment lines": lambda n: "-- label. foo\n" + "-- comment line\n" * n + "SELECT a,\n" * n + "--> Episode [042]",
+            "spaces in a comment": lambda n: "-- foo" + " " * (10 * n) + "bar\nSELECT 1",
+            "many redirection-like lines": lambda n: "SELECT a\n" + "--> x [1] y\n" * n,
+        }
+        for (name, make_source) in sources.items():
+            durations = []
+            for n in (2_000, 8_000):
+                source = make_source(n)
+                t0 = time.perf_counter()
+                split_sql_source(source)
+                durations.append(time.perf_counter() - t0)
+            with self.subTest(name):
+                # Four times the size should take about four times as long, certainly not sixteen.
+                self.assertLess(durations[1], 10 * durations[0] + 0.01)
+
+
 class TestSeparateLabelSaltAndText(unittest.TestCase):
 
     def test_label_salt_and_no_text(self):
@@ -148,4 +219,115 @@ class TestSeparateLabelSaltAndText(unittest.TestCase):
         source = "Some text"
         actual = separate_label_salt_and_text(source)
         print(actual)
-        self.assertEqual(actual, ("", "", "Some text"))
\ No newline at end of file
+        self.assertEqual(actual, ("", "", "Some text"))
+
+
+class TestSQLFormatterCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {
+            "sqlparse_kwargs": defaults["sqlparse_kwargs"],
+            "sqlparse_subs": defaults["sqlparse_subs"],
+            "cache_path": Path(self.tmp_dir.name, "cache.sqlite"),
+        }
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_same_result_as_without_cache(self):
+        query = "select a.foo, count(*) as n from bar a join baz b on a.id = b.id group by a.foo"
+        expected = SQLFormatter({**self.config, "cache_path": None})(query)
+        self.assertEqual(SQLFormatter(self.config)(query), expected)
+        self.assertIn("FROM bar A", expected)
+
+    def test_queries_formatted_once_across_runs(self):
+        query = "select foo from bar where x = 1"
+        format_sql = SQLFormatter(self.config)
+        with mock.patch.object(SQLFormatter, "format", wraps=format_sql.format) as spy:
+            format_sql(query)
+            format_sql(query)
+            self.assertEqual(spy.call_count, 1)  # memory cache
+        format_sql.commit()
+        format_sql = SQLFormatter(self.config)
+        with mock.patch.object(SQLFormatter, "format", side_effect=AssertionError):
+            format_sql(query)  # disk cache
+
+    def test_uncommitted_results_do_not_lock_the_file(self):
+        SQLFormatter(self.config)("select foo from bar")
+        cnx = sqlite3.connect(self.config["cache_path"], timeout=0)
+        cnx.execute("INSERT INTO cache VALUES ('other', 'key', '0')")  # no "database is locked"
+        cnx.commit()
+        cnx.close()
+
+    def test_changed_settings_invalidate_the_cache(self):
+        query = "select foo from bar"
+        format_sql = SQLFormatter(self.config)
+        format_sql(query)
+        format_sql.commit()
+        subs = {**self.config["sqlparse_subs"], "capitalize_keywords": (r"\b(from)\b", lambda m: m[0].lower())}
+        self.assertNotEqual(SQLFormatter(self.config).settings_hash, SQLFormatter({**self.config, "sqlparse_subs": subs}).settings_hash)
+        kwargs = {**self.config["sqlparse_kwargs"], "keyword_case": "lower"}
+        format_sql = SQLFormatter({**self.config, "sqlparse_kwargs": kwargs})
+        self.assertIn("from bar", format_sql(query))
+
+
+class TestFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {"cache_path": Path(self.tmp_dir.name, "cache.sqlite")}
+        self.calls = []
+
+    def tearDown(self):
+        FragmentCache.disk.close()
+        FragmentCache.disk = NullCache()
+        FragmentCache.disk_owner = None
+        self.tmp_dir.cleanup()
+
+    def make_fragment_cache(self):
+        def shout(text):
+            self.calls.append(text)
+            return text.upper()
+        return FragmentCache(shout)
+
+    def test_rendered_once_across_runs(self):
+        open_fragment_caches(self.config)
+        shout = self.make_fragment_cache()
+        self.assertEqual([shout("a"), shout("b"), shout("a")], ["A", "B", "A"])
+        self.assertEqual(self.calls, ["a", "b"])
+        commit_fragment_caches()
+        shout = self.make_fragment_cache()  # e.g., in another build
+        self.assertEqual([shout("a"), shout("b"), shout("c")], ["A", "B", "C"])
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+    def test_reopened_for_another_cache_path(self):
+        open_fragment_caches(self.config)
+        self.make_fragment_cache()("a")
+        other_config = {"cache_path": Path(self.tmp_dir.name, "other.sqlite")}
+        open_fragment_caches(other_config)  # e.g., in the next build of a batch
+        self.make_fragment_cache()("b")
+        commit_fragment_caches()
+        for (config, text) in [(self.config, "A"), (other_config, "B")]:
+            cnx = sqlite3.connect(config["cache_path"])
+            self.assertEqual([json.loads(row[0]) for row in cnx.execute("SELECT value FROM cache")], [text])
+            cnx.close()
+
+    def test_without_disk_cache(self):
+        shout = self.make_fragment_cache()
+        self.assertEqual([shout("a"), shout("a")], ["A", "A"])
+        commit_fragment_caches()
+        self.assertEqual(self.make_fragment_cache()("a"), "A")
+        self.assertEqual(self.calls, ["a", "a"])
+
+    def test_pending_results_bounded(self):
+        open_fragment_caches(self.config)
+        shout = self.make_fragment_cache()
+        for i in range(2 * MAX_PENDING_VALUES + 1):
+            shout(str(i))
+            self.assertLess(len(FragmentCache.disk.pending), MAX_PENDING_VALUES)
+        self.assertEqual(len(FragmentCache.disk.pending), 1)  # the others have been written on disk
+
+    def test_improved_text(self):
+        self.assertEqual(improved_text("**Bold** and `mono`<br>\nend"), "𝗕𝗼𝗹𝗱 and 𝚖𝚘𝚗𝚘\nend")
+        self.assertEqual(improved_text.__name__, "improved_text")
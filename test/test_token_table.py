@@ -0,0 +1,80 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlab.cmd_report import describe, init_report
+from sqlab.report_store import ReportStore
+from sqlab.token_table import Item, TokenTable
+
+TSV = """token	activity	source	target	action	salt
+11	0	0	1	enter	N/A
+1011	0	1	0	move	011
+9001	0	1	1	hint	011
+21	1	0	1	enter	N/A
+2022	1	1	2	move	021
+"""
+
+RECORDS = {
+    "011": {
+        "kind": "exercise",
+        "task_number": 1,
+        "formula": "salt_011(sum(nn(hash)) OVER ()) AS token",
+        "solutions": [{"query": "SELECT foo FROM t", "token": "1011"}, "unused variant"],
+    },
+    "9001": {"kind": "hint", "task_number": 1, "query": "SELECT bar, salt_011(sum(nn(hash)) OVER ()) AS token FROM t"},
+    "db_metadata": {"kind": "db_metadata", "title": "Title", "pitch": "Pitch"},
+}
+
+
+class TestTokenTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tsv_path = Path(self.tmp_dir.name, "token_table.tsv")
+        self.tsv_path.write_text(TSV)
+        self.token_table = TokenTable(self.tsv_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookup_normalizes_the_tokens(self):
+        item = self.token_table.get(1011)
+        self.assertEqual(item, Item(1011, 0, 1, 0, "move", "011"))
+        self.assertIs(self.token_table.get("1011"), item)
+        self.assertIs(self.token_table.get("0001011"), item)
+        self.assertIsNone(self.token_table.get("1012"))
+        self.assertIsNone(self.token_table.get("not a token"))
+
+    def test_contains(self):
+        self.assertIn("0011", self.token_table)
+        self.assertIn(2022, self.token_table)
+        self.assertNotIn("2023", self.token_table)
+
+    def test_describe(self):
+        descriptions = [describe(item) for item in self.token_table]
+        self.assertEqual(descriptions, [
+            "exercise 1",
+            "exercise 1, solution",
+            "exercise 1, hint",
+            "adventure 1, episode 1",
+            "adventure 1, episode 1, solution",
+        ])
+
+    def test_report_tasks_carry_queries_and_formulas(self):
+        records_path = Path(self.tmp_dir.name, "records.json")
+        records_path.write_text(json.dumps(RECORDS))
+        store = ReportStore(Path(self.tmp_dir.name, "report.sqlite"))
+        init_report({"records_path": records_path}, self.token_table, store)
+        report = store.compile_report()
+        store.close()
+        self.assertEqual(report["1011"]["query"], "SELECT foo FROM t")
+        self.assertEqual(report["1011"]["formula"], "salt_011(sum(nn(hash)) OVER ()) AS token")
+        self.assertEqual(report["9001"]["query"], RECORDS["9001"]["query"])
+        self.assertNotIn("formula", report["9001"])
+        self.assertEqual(report["11"]["kind"], "exercise 1")
+        self.assertNotIn("query", report["11"])
+
+
+if __name__ == "__main__":
+    unittest.main()
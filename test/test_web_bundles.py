@@ -0,0 +1,74 @@
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlab.web_bundles import WebBundleWriter, token_digest
+
+
+class TestWebBundleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bundle_dir = Path(self.tmp_dir.name, "web_bundles")  # created by the first write
+        self.writer = WebBundleWriter({"web_bundle_path": self.bundle_dir, "web_bundle_prefix_length": 1})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self) -> dict:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return json.loads(self.writer.write().read_text(encoding="utf8"))
+
+    def read_entry(self, manifest: dict, token: str, suffix: str = "") -> str:
+        digest = token_digest(token)
+        path = self.bundle_dir / (manifest["shards"][digest[:1]]["path"] + suffix)
+        data = path.read_bytes()
+        if suffix == ".gz":
+            data = gzip.decompress(data)
+        return json.loads(data)[digest]
+
+    def test_token_digest_ignores_leading_zeros(self):
+        self.assertEqual(token_digest("0042"), token_digest("42"))
+        self.assertEqual(token_digest("42"), hashlib.sha256(b"42").hexdigest())
+
+    def test_quoted_and_hexadecimal_literals(self):
+        self.writer.add("1011", "'deadbeef'")  # SQLite
+        self.writer.add("1012", r"'\xdeadbeef'")  # PostgreSQL
+        self.writer.add("1013", "0xdeadbeef")  # MySQL
+        manifest = self.write()
+        self.assertEqual(self.read_entry(manifest, "1011"), "deadbeef")
+        self.assertEqual(self.read_entry(manifest, "1012"), r"\xdeadbeef")
+        self.assertEqual(self.read_entry(manifest, "1013"), "0xdeadbeef")
+
+    def test_shards_and_manifest(self):
+        tokens = [str(token) for token in range(1000, 1100)]
+        for token in tokens:
+            self.writer.add(token, f"'{token}'")
+        manifest = self.write()
+        self.assertEqual(manifest["prefix_length"], 1)
+        self.assertIn("gzip", manifest["encodings"])
+        self.assertEqual(sum(shard["count"] for shard in manifest["shards"].values()), len(tokens))
+        for (prefix, shard) in manifest["shards"].items():
+            data = (self.bundle_dir / shard["path"]).read_bytes()
+            self.assertEqual(shard["size"], len(data))
+            self.assertEqual(shard["sha256"], hashlib.sha256(data).hexdigest())
+            self.assertTrue(all(digest.startswith(prefix) for digest in json.loads(data)))
+        for token in tokens[:10]:
+            self.assertEqual(self.read_entry(manifest, token, ".gz"), token)
+
+    def test_stale_shards_removed(self):
+        self.bundle_dir.mkdir()  # by a previous build
+        stale_path = self.bundle_dir / "messages_z.json.gz"
+        stale_path.write_bytes(b"")
+        self.writer.add("1011", "'deadbeef'")
+        self.write()
+        self.assertFalse(stale_path.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()